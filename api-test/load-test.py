@@ -0,0 +1,77 @@
+#!/usr/bin/env python3.10
+"""
+load-test
+
+Script to measure narinfo throughput of a binary cache while slow clients
+download NAR files.
+
+Date: 18.10.2026
+"""
+
+import argparse
+import http.client
+import threading
+import time
+import urllib.parse
+
+def slow_download(url: urllib.parse.ParseResult, nar: str, rate: int, stop: threading.Event) -> None:
+    while not stop.is_set():
+        connection = http.client.HTTPConnection(url.hostname, url.port, timeout=60)
+        connection.request("GET", nar)
+        response = connection.getresponse()
+        while not stop.is_set() and response.read(rate // 10):
+            time.sleep(0.1)
+        connection.close()
+
+def narinfo_client(url: urllib.parse.ParseResult, narinfo: str, stop: threading.Event, results: list) -> None:
+    count = 0
+    latencies = []
+    while not stop.is_set():
+        start = time.monotonic()
+        connection = http.client.HTTPConnection(url.hostname, url.port, timeout=60)
+        try:
+            connection.request("GET", narinfo)
+            connection.getresponse().read()
+        except (OSError, http.client.HTTPException):
+            continue
+        finally:
+            connection.close()
+        latencies.append(time.monotonic() - start)
+        count += 1
+    results.append((count, latencies))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog='load-test', description='Binary cache load test')
+    parser.add_argument('url', help='Binary cache URL, e.g. http://localhost:5000')
+    parser.add_argument('narinfo', help='Path of an existing narinfo, e.g. /<storeHash>.narinfo')
+    parser.add_argument('nar', help='Path of an existing NAR, e.g. /nar/<fileHash>.nar.xz')
+    parser.add_argument('-c', '--clients', type=int, default=8, help='Number of concurrent narinfo clients')
+    parser.add_argument('-s', '--slow-downloads', type=int, default=2, help='Number of concurrent slow NAR downloads')
+    parser.add_argument('-r', '--rate', type=int, default=1024, help='Download rate of slow clients in bytes per second')
+    parser.add_argument('-d', '--duration', type=float, default=10, help='Test duration in seconds')
+    arguments = parser.parse_args()
+
+    url = urllib.parse.urlparse(arguments.url)
+    stop = threading.Event()
+    results = []
+    threads = [threading.Thread(target=slow_download, args=(url, arguments.nar, arguments.rate, stop), daemon=True)
+               for _ in range(arguments.slow_downloads)]
+    threads += [threading.Thread(target=narinfo_client, args=(url, arguments.narinfo, stop, results))
+                for _ in range(arguments.clients)]
+
+    for thread in threads:
+        thread.start()
+    time.sleep(arguments.duration)
+    stop.set()
+    for thread in threads[arguments.slow_downloads:]:
+        thread.join()
+
+    requests = sum(result[0] for result in results)
+    latencies = sorted(latency for result in results for latency in result[1])
+    print("narinfo requests: %d" % requests)
+    print("throughput: %.1f requests/s" % (requests / arguments.duration))
+    if latencies:
+        print("latency p50: %.1f ms, p99: %.1f ms" % (latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000))
+
+if __name__ == '__main__':
+    main()
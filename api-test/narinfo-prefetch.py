@@ -0,0 +1,157 @@
+#!/usr/bin/env python3.10
+"""
+narinfo-prefetch
+
+Local substituter proxy, which loads narinfos of given store paths from
+a binary cache by bulk requests and answers narinfo requests of Nix from
+memory. Other requests are forwarded to the binary cache.
+
+Date: 18.10.2026
+"""
+
+import argparse
+import base64
+import http.client
+import json
+import re
+import shutil
+import sys
+import threading
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# number of store hashes sent in one bulk request
+BATCH_SIZE = 1000
+
+class Upstream():
+    """
+    Class of the binary cache the proxy forwards requests to.
+
+    Attributes:
+        url: parsed binary cache URL
+        headers: headers sent with every request
+        local: thread local HTTP connections
+    """
+
+    def __init__(self, url: str, token: str | None):
+        self.url = urllib.parse.urlparse(url)
+        self.headers = {"Host": self.url.netloc}
+        if token:
+            self.headers["Authorization"] = "Basic " + base64.b64encode((":" + token).encode('utf-8')).decode('utf-8')
+        self.local = threading.local()
+
+    def connection(self) -> http.client.HTTPConnection:
+        if not getattr(self.local, 'connection', None):
+            connection_class = http.client.HTTPSConnection if self.url.scheme == 'https' else http.client.HTTPConnection
+            self.local.connection = connection_class(self.url.hostname, self.url.port, timeout=60)
+        return self.local.connection
+
+    # send request on the kept connection, reconnect once when the binary cache closed it
+    def request(self, method: str, path: str, body: bytes | None = None, headers: dict | None = None) -> http.client.HTTPResponse:
+        headers = {**self.headers, **(headers or {})}
+        for attempt in range(2):
+            try:
+                self.connection().request(method, self.url.path.rstrip('/') + path, body, headers)
+                return self.connection().getresponse()
+            except (OSError, http.client.HTTPException):
+                self.local.connection.close()
+                self.local.connection = None
+                if attempt:
+                    raise
+
+    def prefetch(self, store_hashes: list[str]) -> dict:
+        narinfos = {}
+        for i in range(0, len(store_hashes), BATCH_SIZE):
+            body = json.dumps(store_hashes[i:i + BATCH_SIZE]).encode('utf-8')
+            response = self.request("POST", "/narinfo", body, {"Content-Type": "application/json"})
+            data = response.read()
+            if response.status != 200:
+                print("ERROR: Bulk narinfo request failed with status %d." % response.status)
+                sys.exit(1)
+            narinfos.update(json.loads(data.decode('utf-8')))
+        return narinfos
+
+class PrefetchRequestHandler(BaseHTTPRequestHandler):
+    """
+    Class to handle Nix requests, narinfos of prefetched store paths are
+    answered from memory.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self) -> None:
+        # /{storeHash}.narinfo
+        if m := re.match(r"^/([a-z0-9]+)\.narinfo$", self.path):
+            narinfo = self.server.narinfos.get(m.group(1))
+            if narinfo is not None:
+                response = narinfo.encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/x-nix-narinfo")
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+                return
+
+            # prefetched store paths missing in the binary cache
+            if m.group(1) in self.server.store_hashes:
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+        self.forward("GET")
+
+    def do_HEAD(self) -> None:
+        self.forward("HEAD")
+
+    def forward(self, method: str) -> None:
+        headers = {name: self.headers[name] for name in ("Range", "If-Range") if self.headers[name]}
+        try:
+            response = self.server.upstream.request(method, self.path, headers=headers)
+        except (OSError, http.client.HTTPException):
+            self.send_response(502)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(response.status)
+        for name in ("Content-Type", "Content-Length", "Content-Range", "Accept-Ranges", "Last-Modified"):
+            if response.getheader(name):
+                self.send_header(name, response.getheader(name))
+        self.end_headers()
+        shutil.copyfileobj(response, self.wfile)
+        response.close()
+
+# read store hashes from /nix/store/<hash>-<name> paths or bare hashes, one per line
+def read_store_hashes(file) -> list[str]:
+    store_hashes = []
+    for line in file:
+        m = re.match(r"^(?:/nix/store/)?([a-z0-9]{32})", line.strip())
+        if m:
+            store_hashes.append(m.group(1))
+    return list(dict.fromkeys(store_hashes))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog='narinfo-prefetch', description='Prefetching substituter proxy')
+    parser.add_argument('url', help='Binary cache URL, e.g. https://<cache-name>.<hostname>')
+    parser.add_argument('paths', nargs='?', type=argparse.FileType('r'), default=sys.stdin,
+                        help='File with store paths, e.g. output of nix path-info -r (default stdin)')
+    parser.add_argument('-p', '--port', type=int, default=37515, help='Port the proxy listens on')
+    parser.add_argument('-t', '--token', help='Authentication token of a private binary cache')
+    arguments = parser.parse_args()
+
+    upstream = Upstream(arguments.url, arguments.token)
+    store_hashes = read_store_hashes(arguments.paths)
+    narinfos = upstream.prefetch(store_hashes)
+    print("Prefetched %d of %d narinfos." % (len(narinfos), len(store_hashes)))
+
+    server = ThreadingHTTPServer(("localhost", arguments.port), PrefetchRequestHandler)
+    server.upstream = upstream
+    server.narinfos = narinfos
+    server.store_hashes = set(store_hashes)
+    print("Substituter listening on http://localhost:%d" % arguments.port)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
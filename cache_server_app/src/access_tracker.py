@@ -0,0 +1,100 @@
+#!/usr/bin/env python3.10
+"""
+access_tracker
+
+Module containing the tracker of store path requests.
+
+Date: 18.10.2026
+"""
+
+import os
+import time
+import threading
+import cache_server_app.src.config as config
+from cache_server_app.src.database import CacheServerDatabase
+
+class AccessTracker():
+    """
+    Class to record last access time and number of NAR downloads of store
+    paths without writing to the database on every request.
+
+    Requests are aggregated in memory and written by a background thread
+    every flush interval in a single transaction, one row update per store
+    path. Once max_entries store paths are pending, the thread is woken to
+    flush them and requests of further store paths are dropped until it
+    did, so the memory used does not depend on the request rate.
+
+    Attributes:
+        interval: number of seconds between flushes
+        max_entries: maximum number of pending store paths, reaching it triggers a flush
+        pending: [last access timestamp, number of downloads] keyed by (cache name, store hash)
+        lock: lock guarding pending and counters
+        full: event waking the flushing thread before the interval elapsed
+        pid: process the flushing thread runs in
+        flushes: number of flushes written to the database
+        flushed: number of store path updates written to the database
+        dropped: number of requests not recorded because max_entries store paths were pending
+    """
+
+    def __init__(self, interval: float, max_entries: int):
+        self.interval = interval
+        self.max_entries = max_entries
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.full = threading.Event()
+        self.pid = None
+        self.flushes = 0
+        self.flushed = 0
+        self.dropped = 0
+
+    # record request of store path, download is True for NAR requests and False for narinfo requests
+    def record(self, cache_name: str, store_hash: str, download: bool = False) -> None:
+        with self.lock:
+            # the flushing thread is not inherited by forked worker processes
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.pending = {}
+                self.full = threading.Event()
+                threading.Thread(target=self.run, daemon=True).start()
+
+            entry = self.pending.get((cache_name, store_hash))
+            if entry:
+                entry[0] = int(time.time())
+                entry[1] += download
+            elif len(self.pending) < self.max_entries:
+                self.pending[(cache_name, store_hash)] = [int(time.time()), int(download)]
+                if len(self.pending) >= self.max_entries:
+                    self.full.set()
+            else:
+                self.dropped += 1
+
+    def flush(self) -> None:
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.full.clear()
+
+        if not pending:
+            return
+
+        CacheServerDatabase().update_store_path_access([(last_access, downloads, cache_name, store_hash)
+                                                        for (cache_name, store_hash), (last_access, downloads) in pending.items()])
+        with self.lock:
+            self.flushes += 1
+            self.flushed += len(pending)
+
+    def run(self) -> None:
+        full = self.full
+        while True:
+            full.wait(self.interval)
+            self.flush()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'access_tracker_pending': len(self.pending) if self.pid == os.getpid() else 0,
+                'access_tracker_flushes': self.flushes,
+                'access_tracker_flushed': self.flushed,
+                'access_tracker_dropped': self.dropped
+            }
+
+access_tracker = AccessTracker(config.access_flush_interval, config.access_tracker_size)
@@ -15,19 +15,177 @@ import uuid
 import asyncio
 import websockets
 import base64
+import hashlib
+import time
+import queue
+import select
+import socket
+import threading
+import cache_server_app.src.config as config
 
 from datetime import datetime, timezone
+from email.utils import formatdate
+from urllib.parse import parse_qs, urlsplit
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from cache_server_app.src.binary_cache import BinaryCache
 from cache_server_app.src.store_path import StorePath
 from cache_server_app.src.agent import Agent
+from cache_server_app.src.nar_upload import NarUpload
+from cache_server_app.src.narinfo_cache import narinfo_cache
+from cache_server_app.src.store_hash_filter import store_hash_filter
+from cache_server_app.src.store_path_index import store_path_index
+from cache_server_app.src.access_tracker import access_tracker
 
-class HTTPCacheServer(HTTPServer):
+# maximum number of store hashes looked up by one bulk narinfo request
+MAX_BULK_NARINFO = 10000
+
+# NAR files never change once stored under their file hash
+NAR_MAX_AGE = 365 * 24 * 3600
+
+class ThreadPoolMixIn():
+    """
+    Mixin class to handle HTTP requests in a bounded pool of worker threads.
+
+    Accepted connections wait in a bounded queue for a free worker, when
+    the queue is full the connection is answered with 503.
+
+    Attributes:
+        workers: number of worker threads
+        max_queued_requests: maximum number of connections waiting for a worker
+        reuse_port: whether the listening socket is shared by several processes
+        requests: queue of accepted connections
+        threads: worker threads
+    """
+
+    workers = config.http_workers
+    max_queued_requests = config.http_queue_size
+    request_queue_size = config.http_queue_size
+    reuse_port = False
+
+    def server_bind(self) -> None:
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def start_workers(self) -> None:
+        self.requests = queue.Queue(self.max_queued_requests)
+        self.threads = []
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.process_request_worker, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def process_request_worker(self) -> None:
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address) -> None:
+        try:
+            self.requests.put_nowait((request, client_address))
+        except queue.Full:
+            try:
+                request.sendall(b"HTTP/1.0 503 Service Unavailable\r\nContent-Length: 0\r\n\r\n")
+            except OSError:
+                pass
+            self.shutdown_request(request)
+
+    # stop listening and wait until the already accepted connections are handled
+    def server_close(self) -> None:
+        super().server_close()
+        threads = getattr(self, 'threads', [])
+        for _ in threads:
+            self.requests.put(None)
+        for thread in threads:
+            thread.join()
+
+class KeepAliveMixIn():
+    """
+    Mixin class to keep HTTP/1.1 connections open between requests.
+
+    A connection is closed after timeout seconds without a request, after
+    max_requests requests, or when it is idle while other connections wait
+    for a worker thread of the server.
+
+    Attributes:
+        timeout: number of seconds a connection waits for the next request
+        max_requests: maximum number of requests handled on one connection
+        requests_handled: number of requests handled on the connection
+    """
+
+    protocol_version = 'HTTP/1.1'
+    timeout = config.http_keepalive_timeout
+    # headers and body are written separately, Nagle's algorithm would delay every response on a kept connection
+    disable_nagle_algorithm = True
+    max_requests = config.http_keepalive_requests
+
+    # how often an idle connection checks for connections waiting for a worker thread
+    IDLE_POLL_INTERVAL = 0.1
+
+    def handle(self) -> None:
+        self.requests_handled = 0
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.wait_for_request():
+            self.handle_one_request()
+
+    # wait until the next request arrives, False when the connection should be closed instead
+    def wait_for_request(self) -> bool:
+        # a pipelined request may already be buffered
+        self.connection.settimeout(0)
+        try:
+            if self.rfile.peek(1):
+                return True
+        except BlockingIOError:
+            pass
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+        deadline = time.monotonic() + self.timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if select.select([self.connection], [], [], min(remaining, self.IDLE_POLL_INTERVAL))[0]:
+                return True
+            if not self.server.requests.empty():
+                return False
+
+    def parse_request(self) -> bool:
+        self.requests_handled += 1
+        return super().parse_request()
+
+    def send_response(self, code: int, message: str | None = None) -> None:
+        super().send_response(code, message)
+        if self.requests_handled >= self.max_requests and not self.close_connection:
+            self.send_header("Connection", "close")
+
+    # send response without body, the connection is closed when an unread request body may be left on it
+    def send_status(self, code: int) -> None:
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        if code >= 400 and not self.close_connection and (self.headers['Content-Length'] not in (None, '0') or self.headers['Transfer-Encoding']):
+            self.send_header("Connection", "close")
+        self.end_headers()
+
+class HTTPCacheServer(ThreadPoolMixIn, HTTPServer):
     def __init__(self, server_address, request_handler, websocket_handler):
         self.websocket_handler = websocket_handler
         super().__init__(server_address, request_handler)
+        self.start_workers()
 
-class CacheServerRequestHandler(BaseHTTPRequestHandler):
+class CacheServerRequestHandler(KeepAliveMixIn, BaseHTTPRequestHandler):
     """
     Class to handle cache-server HTTP requests.
     """
@@ -37,14 +195,12 @@ class CacheServerRequestHandler(BaseHTTPRequestHandler):
 
             cache = BinaryCache.get(m.group(1))
             if not cache:
-                self.send_response(400)
-                self.end_headers()
+                self.send_status(400)
                 return
             
             if cache.access == 'private':
                 if self.headers["Authorization"].split()[1] != cache.token:
-                    self.send_response(401)
-                    self.end_headers()
+                    self.send_status(401)
                     return
             
             # /api/v1/cache/{name}
@@ -56,6 +212,9 @@ class CacheServerRequestHandler(BaseHTTPRequestHandler):
                 self.end_headers()
                 self.wfile.write(response)
 
+            else:
+                self.send_status(400)
+
         # /api/v1/deploy/deployment/{uuid}
         elif m := re.match(r"^/api/v1/deploy/deployment/([a-z0-9]{8}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{12})\?", self.path):
             deploy_id = m.group(1)
@@ -76,8 +235,7 @@ class CacheServerRequestHandler(BaseHTTPRequestHandler):
             self.wfile.write(response)
 
         else:
-            self.send_response(400)
-            self.end_headers()
+            self.send_status(400)
 
     def do_POST(self) -> None:
 
@@ -85,13 +243,11 @@ class CacheServerRequestHandler(BaseHTTPRequestHandler):
 
             cache = BinaryCache.get(m.group(1))
             if not cache:
-                self.send_response(400)
-                self.end_headers()
+                self.send_status(400)
                 return
             
             if self.headers["Authorization"].split()[1] != cache.token:
-                self.send_response(401)
-                self.end_headers()
+                self.send_status(401)
                 return
 
             # /api/v1/cache/{name}/narinfo
@@ -107,15 +263,11 @@ class CacheServerRequestHandler(BaseHTTPRequestHandler):
 
             # /api/v1/cache/{name}/multipart-nar
             elif m := re.match(r"^/api/v1/cache/[a-z0-9]*/multipart-nar\?compression=(xz|zst)$", self.path):
-                id = uuid.uuid4()
+                upload = NarUpload.create(cache, m.group(1))
                 response = """{{
                     "narId": "{}",
                     "uploadId": "{}"
-                    }}""".format(id, id).encode('utf-8')
-                
-                new_file = os.path.join(cache.cache_dir, '{}.nar.{}'.format(id, m.group(1)))
-                with open(new_file, 'w') as nf: #create new file for uploading nar
-                    pass
+                    }}""".format(upload.id, upload.id).encode('utf-8')
 
                 self.send_response(200)
                 self.send_header("Content-Type", "application/json")
@@ -128,7 +280,13 @@ class CacheServerRequestHandler(BaseHTTPRequestHandler):
                 
                 content_length = int(self.headers['Content-Length'])
                 body = json.loads(self.rfile.read(content_length).decode('utf-8'))
-                upload_url = os.path.join(cache.url, m.group(1))
+
+                # every part of a multipart upload gets its own upload URL
+                query = parse_qs(urlsplit(self.path).query)
+                if 'partNumber' in query:
+                    upload_url = os.path.join(cache.url, m.group(1), str(int(query['partNumber'][0])))
+                else:
+                    upload_url = os.path.join(cache.url, m.group(1))
                 response = """{{
                     "uploadUrl": "{}"
                 }}""".format(upload_url).encode('utf-8')
@@ -145,11 +303,20 @@ class CacheServerRequestHandler(BaseHTTPRequestHandler):
                 body = json.loads(self.rfile.read(content_length).decode('utf-8'))
                 narinfo_create = body['narInfoCreate']
 
-                for f in os.listdir(cache.cache_dir):
-                    if m.group(1) in f:
-                        filename = f
+                upload = NarUpload.get(m.group(1))
+                if not upload or upload.cache.name != cache.name:
+                    self.send_status(400)
+                    return
 
-                StorePath(
+                if body.get('parts') and upload.has_parts() and not upload.assemble(body['parts']):
+                    self.send_status(400)
+                    return
+
+                if not upload.matches(narinfo_create['cFileHash'], narinfo_create['cFileSize']):
+                    self.send_status(400)
+                    return
+
+                path = StorePath(
                     id = uuid.uuid4(),
                     store_hash = narinfo_create['cStoreHash'],
                     store_suffix = narinfo_create['cStoreSuffix'],
@@ -159,37 +326,40 @@ class CacheServerRequestHandler(BaseHTTPRequestHandler):
                     nar_size = narinfo_create['cNarSize'],
                     deriver = narinfo_create['cDeriver'],
                     references = narinfo_create['cReferences'],
-                    cache = cache
-                ).save()
-
-                os.rename(
-                    os.path.join(cache.cache_dir, filename), 
-                    os.path.join(cache.cache_dir, '{}.nar{}'.format(body['narInfoCreate']['cFileHash'], os.path.splitext(filename)[1]))
+                    cache = cache,
+                    compression = upload.compression
                 )
+
+                # sign once on upload, narinfo requests serve the stored signature
+                path.signature = path.sign()
+                path.save()
+
+                cache.storage.store(upload.get_file(), path.file_hash, path.compression)
+                upload.delete()
                 
                 self.send_response(200)
                 self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", "0")
                 self.end_headers()
 
             # /api/v1/cache/{name}/multipart-nar/{narUuid}/abort
             elif m := re.match(r"^/api/v1/cache/[a-z0-9]+/multipart-nar/([a-z0-9]{8}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{12})/abort\?", self.path):
 
-                filename = None
-                for f in os.listdir(cache.cache_dir):
-                    if m.group(1) in f:
-                        filename = f
-
-                if filename == None:
-                    self.send_response(400)
-                    self.end_headers()
+                upload = NarUpload.get(m.group(1))
+                if not upload or upload.cache.name != cache.name:
+                    self.send_status(400)
                     return
-                
-                os.remove(os.path.join(cache.cache_dir, filename))
+
+                upload.delete()
 
                 self.send_response(200)
                 self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", "0")
                 self.end_headers()
 
+            else:
+                self.send_status(400)
+
         # /api/v2/deploy/activate
         elif m := re.match(r"^/api/v2/deploy/activate\?", self.path):
             content_length = int(self.headers['Content-Length'])
@@ -197,10 +367,15 @@ class CacheServerRequestHandler(BaseHTTPRequestHandler):
             agents = {}
 
             for agent, path in body['agents'].items():
-                if not Agent.get(agent):
-                    self.send_response(400)
-                    self.end_headers()
+                agent_object = Agent.get(agent)
+                if not agent_object:
+                    self.send_status(400)
                     return
+
+                # the deployed path of every agent is kept by garbage collector of the workspace binary cache
+                store_path = re.match(r"^/nix/store/([a-z0-9]{32})-", path)
+                if store_path and agent_object.workspace.cache:
+                    agent_object.workspace.cache.pin("deploy-{}".format(agent), store_path.group(1))
                 
                 deploy_id = str(uuid.uuid4())
                 agent_item = {
@@ -221,25 +396,163 @@ class CacheServerRequestHandler(BaseHTTPRequestHandler):
             self.wfile.write(response)
 
         else:
-            self.send_response(400)
-            self.end_headers()
+            self.send_status(400)
             
-class HTTPBinaryCache(HTTPServer):
-    def __init__(self, server_address, request_handler, cache: BinaryCache):
+class HTTPBinaryCache(ThreadPoolMixIn, HTTPServer):
+    def __init__(self, server_address, request_handler, cache: BinaryCache, reuse_port: bool = False):
         self.cache = cache
+        self.reuse_port = reuse_port
+        super().__init__(server_address, request_handler)
+        self.start_workers()
+
+    def get_cache(self, host: str | None) -> BinaryCache | None:
+        return self.cache
+
+class HTTPMultiBinaryCache(ThreadPoolMixIn, HTTPServer):
+    """
+    Class of HTTP server serving all binary caches, requests are routed
+    to binary caches by the <name>.<hostname> Host header.
+
+    Binary caches are loaded on first request and kept for ttl seconds,
+    so created, updated and deleted caches are picked up without restart.
+
+    Attributes:
+        ttl: number of seconds binary caches are kept loaded
+        caches: dictionary of (expiration, binary cache or None) by name
+        lock: lock guarding caches
+    """
+
+    def __init__(self, server_address, request_handler, ttl: float, reuse_port: bool = False):
+        self.ttl = ttl
+        self.reuse_port = reuse_port
+        self.caches = {}
+        self.lock = threading.Lock()
         super().__init__(server_address, request_handler)
+        self.start_workers()
+
+    def get_cache(self, host: str | None) -> BinaryCache | None:
+        if not host:
+            return None
 
-class BinaryCacheRequestHandler(BaseHTTPRequestHandler):
+        suffix = '.' + config.server_hostname
+        host = host.split(':')[0].lower()
+        if not host.endswith(suffix):
+            return None
+        name = host[:-len(suffix)]
+
+        with self.lock:
+            entry = self.caches.get(name)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+
+        # missing caches are remembered as well, so unknown hosts do not query the database
+        cache = BinaryCache.get(name)
+        now = time.monotonic()
+        with self.lock:
+            if len(self.caches) > 1024:
+                self.caches = {key: value for key, value in self.caches.items() if value[0] > now}
+            self.caches[name] = (now + self.ttl, cache)
+        return cache
+
+class BinaryCacheRequestHandler(KeepAliveMixIn, BaseHTTPRequestHandler):
     """
     Class to handle binary cache HTTP requests.
     """
 
+    # stream part of file to the client without copying it to memory, socket.sendfile falls back to chunked sends
+    def send_file(self, file, offset: int, count: int) -> None:
+        self.wfile.flush()
+        if count > 0:
+            self.connection.sendfile(file, offset, count)
+
+    # return (first, last) byte of a satisfiable single byte range, None to send the whole file
+    # and False for a range starting after the end of the file
+    def get_byte_range(self, file_size: int, etag: str, last_modified: str) -> tuple | bool | None:
+        range_header = self.headers['Range']
+        if not range_header:
+            return None
+
+        # If-Range contains either the entity tag or the modification date of the file
+        if_range = self.headers['If-Range']
+        if if_range and if_range.strip() not in (etag, last_modified):
+            return None
+
+        # multiple ranges and malformed ranges are ignored
+        m = re.match(r"^bytes=(\d*)-(\d*)$", range_header.strip())
+        if not m or (not m.group(1) and not m.group(2)):
+            return None
+
+        if not m.group(1):
+            start = max(file_size - int(m.group(2)), 0)
+            end = file_size - 1
+        else:
+            start = int(m.group(1))
+            end = min(int(m.group(2)), file_size - 1) if m.group(2) else file_size - 1
+            if start > end and start < file_size:
+                return None
+
+        if start >= file_size:
+            return False
+
+        return start, end
+
+    # True when the client or proxy already has the response with the entity tag
+    def not_modified(self, etag: str) -> bool:
+        if_none_match = self.headers['If-None-Match']
+        if not if_none_match:
+            return False
+
+        # weak comparison, as required for If-None-Match
+        etags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        return '*' in etags or etag in etags
+
+    # shared proxies may store responses of public binary caches only
+    def cache_control(self, max_age: int, immutable: bool = False) -> str:
+        cache_control = "{}, max-age={}".format('public' if self.cache.access == 'public' else 'private', max_age)
+        return cache_control + ", immutable" if immutable else cache_control
+
+    # send narinfo with its digest as entity tag, narinfos change when store paths are signed again
+    def send_narinfo(self, response: bytes, head: bool = False) -> None:
+        etag = '"{}"'.format(hashlib.sha256(response).hexdigest()[:32])
+        if self.not_modified(etag):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", self.cache_control(config.narinfo_max_age))
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/x-nix-narinfo")
+        self.send_header("Content-Length", str(len(response)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", self.cache_control(config.narinfo_max_age))
+        self.end_headers()
+        if not head:
+            self.wfile.write(response)
+
+    # store path of the binary cache from the in-memory index when loaded, from the database otherwise
+    def get_store_path(self, store_hash: str = '', file_hash: str = '') -> StorePath | None:
+        if store_path_index.is_loaded(self.cache.name):
+            return store_path_index.get(self.cache, store_hash=store_hash, file_hash=file_hash)
+
+        # most lookups are misses of substituters probed by Nix, answered without a query
+        if store_hash and not store_hash_filter.might_contain(self.cache.name, store_hash):
+            return None
+
+        path = StorePath.get(self.cache.name, store_hash=store_hash, file_hash=file_hash)
+        if not path and store_hash:
+            store_hash_filter.false_positive()
+        return path
+
     def do_GET(self) -> None:
+        self.cache = self.server.get_cache(self.headers['X-Forwarded-Host'] or self.headers['Host'])
+        if not self.cache:
+            self.send_status(404)
+            return
 
-        if self.server.cache.access == 'private':
-            if base64.b64decode(self.headers['Authorization'].split()[1]).decode('utf-8')[1:] != self.server.cache.token:
-                self.send_response(401)
-                self.end_headers()
+        if self.cache.access == 'private':
+            if base64.b64decode(self.headers['Authorization'].split()[1]).decode('utf-8')[1:] != self.cache.token:
+                self.send_status(401)
                 return
 
         # /nix-cache-info
@@ -251,94 +564,213 @@ class BinaryCacheRequestHandler(BaseHTTPRequestHandler):
             self.end_headers()
             self.wfile.write(response)
 
+        # /metrics
+        elif m := re.match(r"^/metrics$", self.path):
+            stats = {**narinfo_cache.stats(), **store_hash_filter.stats(), **store_path_index.stats(), **access_tracker.stats()}
+            response = ''.join("{} {}\n".format(name, value) for name, value in stats.items()).encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
         # /{storeHash}.narinfo
         elif m := re.match(r"^/([a-z0-9]+)\.narinfo$", self.path):
 
-            path = StorePath.get(self.server.cache.name, store_hash = m.group(1))
-            if not path:
-                self.send_response(404)
-                self.end_headers()
-                return
+            response = narinfo_cache.get(self.cache.name, m.group(1))
+            if response is None:
+                path = self.get_store_path(store_hash = m.group(1))
+                if not path:
+                    self.send_status(404)
+                    return
 
-            response = path.get_narinfo().encode('utf-8')
+                response = path.get_narinfo().encode('utf-8')
+                narinfo_cache.put(self.cache.name, m.group(1), response)
 
-            self.send_response(200)
-            self.send_header("Content-Type", "text/x-nix-narinfo")
-            self.send_header("Content-Length", str(len(response)))
-            self.end_headers()
-            self.wfile.write(response)
+            access_tracker.record(self.cache.name, m.group(1))
+            self.send_narinfo(response)
 
         # /nar/{fileHash}.nar.{compression}
         elif m := re.match(r"^/nar/([a-z0-9]+)\.nar\.(xz|zst)$", self.path):
 
-            path = StorePath.get(self.server.cache.name, file_hash=m.group(1))
+            path = self.get_store_path(file_hash=m.group(1))
             if not path:
-                self.send_response(404)
-                self.end_headers()
+                self.send_status(404)
                 return
             
-            nar_file = os.path.join(path.cache.cache_dir, '{}.nar.{}'.format(m.group(1), m.group(2)))
-            with open(nar_file, 'rb') as file: 
-                response = file.read()
+            nar_file = path.cache.storage.locate(m.group(1), m.group(2))
+            try:
+                if not nar_file:
+                    raise FileNotFoundError
+                file = open(nar_file, 'rb')
+            except FileNotFoundError:
+                self.send_status(404)
+                return
+
+            with file:
+                file_size = int(path.file_size)
+                last_modified = formatdate(os.fstat(file.fileno()).st_mtime, usegmt=True)
+                etag = '"{}"'.format(path.file_hash)
+
+                # If-None-Match is evaluated before Range
+                if self.not_modified(etag):
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Cache-Control", self.cache_control(NAR_MAX_AGE, immutable=True))
+                    self.send_header("Last-Modified", last_modified)
+                    self.end_headers()
+                    return
+
+                byte_range = self.get_byte_range(file_size, etag, last_modified)
+
+                if byte_range == False:
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */{}".format(file_size))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                if byte_range:
+                    start, end = byte_range
+                    self.send_response(206)
+                    self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, file_size))
+                else:
+                    start, end = 0, file_size - 1
+                    self.send_response(200)
+
+                self.send_header("Content-Type", "text/x-nix-narinfo")
+                self.send_header("Content-Length", str(end - start + 1))
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("Last-Modified", last_modified)
+                self.send_header("ETag", etag)
+                self.send_header("Cache-Control", self.cache_control(NAR_MAX_AGE, immutable=True))
+                self.end_headers()
+                self.send_file(file, start, end - start + 1)
+
+            # revalidations and unsatisfiable ranges send no NAR, resumed downloads count once
+            access_tracker.record(path.cache.name, path.store_hash, download=(start == 0))
             
+        else:
+            self.send_status(400)
+
+    def do_POST(self) -> None:
+        self.cache = self.server.get_cache(self.headers['X-Forwarded-Host'] or self.headers['Host'])
+        if not self.cache:
+            self.send_status(404)
+            return
+
+        if self.cache.access == 'private':
+            if base64.b64decode(self.headers['Authorization'].split()[1]).decode('utf-8')[1:] != self.cache.token:
+                self.send_status(401)
+                return
+
+        # /narinfo
+        if m := re.match(r"^/narinfo$", self.path):
+
+            content_length = int(self.headers['Content-Length'])
+            try:
+                store_hashes = json.loads(self.rfile.read(content_length).decode('utf-8'))
+            except ValueError:
+                self.send_status(400)
+                return
+
+            if (not isinstance(store_hashes, list) or len(store_hashes) > MAX_BULK_NARINFO
+                    or not all(isinstance(store_hash, str) and re.match(r"^[a-z0-9]+$", store_hash) for store_hash in store_hashes)):
+                self.send_status(400)
+                return
+
+            # narinfos of the existing store paths by store hash, signatures are stored on upload
+            if store_path_index.is_loaded(self.cache.name):
+                paths = store_path_index.get_many(self.cache, list(set(store_hashes)))
+            else:
+                store_hashes = [store_hash for store_hash in set(store_hashes) if store_hash_filter.might_contain(self.cache.name, store_hash)]
+                paths = StorePath.get_many(self.cache, store_hashes)
+            response = json.dumps({path.store_hash: path.get_narinfo() for path in paths}).encode('utf-8')
             self.send_response(200)
-            self.send_header("Content-Type", "text/x-nix-narinfo")
+            self.send_header("Content-Type", "application/json")
             self.send_header("Content-Length", str(len(response)))
             self.end_headers()
             self.wfile.write(response)
-            
+
         else:
-            self.send_response(400)
-            self.end_headers()
+            self.send_status(400)
 
     def do_PUT(self) -> None:
+        self.cache = self.server.get_cache(self.headers['X-Forwarded-Host'] or self.headers['Host'])
+        if not self.cache:
+            self.send_status(404)
+            return
         # /{narUuid}
         if m := re.match(r"^/([a-z0-9]{8}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{12})$", self.path):
             
             content_length = int(self.headers['Content-Length'])
 
-            filename = None
-            for f in os.listdir(self.server.cache.cache_dir):
-                if m.group(1) in f:
-                    filename = f
+            upload = NarUpload.get(m.group(1))
+            if not upload or upload.cache.name != self.cache.name:
+                self.send_status(400)
+                return
 
-            if not filename:
-                self.send_response(400)
-                self.end_headers()
+            # stream the body to disk, hash and size are checked on /complete
+            if not upload.receive(self.rfile, content_length):
+                self.send_status(400)
                 return
 
-            body = self.rfile.read(content_length)
-            with open(os.path.join(self.server.cache.cache_dir, filename), "wb") as file:
-                file.write(body)
             self.send_response(201)
             self.send_header("Content-Location", "/")
+            self.send_header("ETag", '"{}"'.format(upload.file_hash))
+            self.send_header("Content-Length", "0")
             self.end_headers()
-        else:
-            self.send_response(400)
+
+        # /{narUuid}/{partNumber}
+        elif m := re.match(r"^/([a-z0-9]{8}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{12})/([0-9]+)$", self.path):
+
+            content_length = int(self.headers['Content-Length'])
+
+            upload = NarUpload.get(m.group(1))
+            if not upload or upload.cache.name != self.cache.name:
+                self.send_status(400)
+                return
+
+            etag = upload.receive_part(int(m.group(2)), self.rfile, content_length)
+            if not etag:
+                self.send_status(400)
+                return
+
+            self.send_response(200)
+            self.send_header("ETag", '"{}"'.format(etag))
+            self.send_header("Content-Length", "0")
             self.end_headers()
+        else:
+            self.send_status(400)
 
     def do_HEAD(self) -> None:
+        self.cache = self.server.get_cache(self.headers['X-Forwarded-Host'] or self.headers['Host'])
+        if not self.cache:
+            self.send_status(404)
+            return
 
-        if self.server.cache.access == 'private':
-            if base64.b64decode(self.headers['Authorization'].split()[1]).decode('utf-8')[1:] != self.server.cache.token:
-                self.send_response(401)
-                self.end_headers()
+        if self.cache.access == 'private':
+            if base64.b64decode(self.headers['Authorization'].split()[1]).decode('utf-8')[1:] != self.cache.token:
+                self.send_status(401)
                 return
 
         # /{storeHash}.narinfo
         if m := re.match(r"^/([a-z0-9]+)\.narinfo", self.path):
 
-            path = StorePath.get(self.server.cache.name, store_hash = m.group(1))
-            if not path:
-                self.send_response(400)
-                self.end_headers()
-                return
-            
-            self.send_response(200)
-            self.end_headers()
+            response = narinfo_cache.get(self.cache.name, m.group(1))
+            if response is None:
+                path = self.get_store_path(store_hash = m.group(1))
+                if not path:
+                    self.send_status(400)
+                    return
+
+                response = path.get_narinfo().encode('utf-8')
+                narinfo_cache.put(self.cache.name, m.group(1), response)
+
+            # same headers as GET, without the body
+            self.send_narinfo(response, head=True)
         else:
-            self.send_response(400)
-            self.end_headers()
+            self.send_status(400)
 
 class WebSocketConnectionHandler():
     """
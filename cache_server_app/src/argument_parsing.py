@@ -12,6 +12,16 @@ import argparse
 import sys
 from cache_server_app.src.commands import CacheServerCommandHandler
 
+# parse size in bytes with optional K, M, G or T suffix, -1 means unlimited
+def parse_size(value: str) -> int:
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    try:
+        if value[-1:].upper() in units:
+            return int(float(value[:-1]) * units[value[-1].upper()])
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size: '%s'" % value)
+
 def parse_arguments(argv):
     parser = argparse.ArgumentParser(prog = 'cache-server', description='Cache server options')
     subparser = parser.add_subparsers(dest='command')
@@ -22,8 +32,13 @@ def parse_arguments(argv):
     start_subparser = start_parser.add_subparsers(dest='start_command')
     start_subparser.add_parser('server', description='Start cache server', help='Start cache server')
     start_cache_parser = start_subparser.add_parser('cache', description='Start binary cache', help='Start binary cache')
+    start_cache_parser.add_argument('-w', '--workers', type=int, default=1, help='Number of worker processes')
+    start_cache_parser.add_argument('-i', '--index', help='Keep store paths in memory', action='store_true')
     start_cache_parser.add_argument('name', type=str, help='Binary cache name')
     start_cache_parser.add_argument('port', type=int, help='Binary cache port')
+    start_caches_parser = start_subparser.add_parser('caches', description='Start all binary caches', help='Start all binary caches')
+    start_caches_parser.add_argument('-w', '--workers', type=int, default=1, help='Number of worker processes')
+    start_caches_parser.add_argument('-i', '--index', help='Keep store paths in memory', action='store_true')
 
     subparser.add_parser('stop', description='Stop cache server', help='Stop cache server')
 
@@ -33,8 +48,15 @@ def parse_arguments(argv):
     cache_create_parser.add_argument('name', type=str, help='Binary cache name')
     cache_create_parser.add_argument('port', type=int, help='Binary cache port')
     cache_create_parser.add_argument('-r', '--retention', help='Number of weeks after which paths will be removed', dest='retention')
+    cache_create_parser.add_argument('-m', '--max-size', type=parse_size, help='Maximum size of NAR files, e.g. 100G, least recently requested paths are removed above it', dest='max_size')
     cache_start_parser = cache_subparser.add_parser('start', description='Start binary cache', help='Start binary cache')
+    cache_start_parser.add_argument('-w', '--workers', type=int, default=1, help='Number of worker processes sharing the port')
+    cache_start_parser.add_argument('-i', '--index', help='Serve store paths from an in-memory index', action='store_true')
     cache_start_parser.add_argument('name', type=str, help='Binary cache name')
+    cache_start_all_parser = cache_subparser.add_parser('start-all', description='Start server serving all binary caches', help='Start server serving all binary caches')
+    cache_start_all_parser.add_argument('-w', '--workers', type=int, default=1, help='Number of worker processes sharing the port')
+    cache_start_all_parser.add_argument('-i', '--index', help='Serve store paths from an in-memory index', action='store_true')
+    cache_subparser.add_parser('stop-all', description='Stop server serving all binary caches', help='Stop server serving all binary caches')
     cache_stop_parser = cache_subparser.add_parser('stop', description='Stop binary cache', help='Stop binary cache')
     cache_stop_parser.add_argument('name', type=str, help='Binary cache name')
     cache_delete_parser = cache_subparser.add_parser('delete', description='Delete binary cache', help='Delete binary cache')
@@ -45,13 +67,27 @@ def parse_arguments(argv):
     cache_update_parser.add_argument('-a', '--access',choices=['public', 'private'], help='Change access to public/private')
     cache_update_parser.add_argument('-p', '--port', type=int, help='Change cache port to PORT')
     cache_update_parser.add_argument('-r', '--retention', type=int, help='Change cache retention to RETENTION')
+    cache_update_parser.add_argument('-m', '--max-size', type=parse_size, help='Change maximum size of NAR files to MAX_SIZE, -1 for unlimited', dest='max_size')
     cache_list_parser = cache_subparser.add_parser('list', description='List binary caches', help='List binary caches')
     cache_list_group = cache_list_parser.add_mutually_exclusive_group()
     cache_list_group.add_argument('-p', '--private', help='List private caches', action='store_true')
     cache_list_group.add_argument('-P', '--public', help='List public caches', action='store_true')
+    cache_resign_parser = cache_subparser.add_parser('resign', description='Sign all store paths of binary cache', help='Sign all store paths of binary cache')
+    cache_resign_parser.add_argument('name', type=str, help='Binary cache name')
+    cache_resign_parser.add_argument('-g', '--generate-keys', help='Generate new signing keys before signing', action='store_true', dest='generate_keys')
+    cache_migrate_parser = cache_subparser.add_parser('migrate-layout', description='Move NAR files of binary cache to the fan-out directory layout', help='Move NAR files of binary cache to the fan-out directory layout')
+    cache_migrate_parser.add_argument('name', type=str, help='Binary cache name')
+    cache_gc_parser = cache_subparser.add_parser('collect-garbage', description='Remove store paths of binary cache older than its retention', help='Remove store paths of binary cache older than its retention')
+    cache_gc_parser.add_argument('name', type=str, help='Binary cache name')
+    cache_dedup_parser = cache_subparser.add_parser('dedup', description='Move NAR files of binary cache to the store shared by all binary caches', help='Move NAR files of binary cache to the store shared by all binary caches')
+    cache_dedup_parser.add_argument('name', type=str, help='Binary cache name')
     cache_info_parser = cache_subparser.add_parser('info', help="Display info about binary cache", description="Display info about binary cache")
     cache_info_parser.add_argument('name', help="Binary cache name")
 
+    storage_parser = subparser.add_parser('storage', description='Manage NAR file storage', help='Manage NAR file storage')
+    storage_subparser = storage_parser.add_subparsers(dest='storage_command')
+    storage_subparser.add_parser('dedup', description='Move NAR files of all binary caches to the store shared by all binary caches', help='Move NAR files of all binary caches to the store shared by all binary caches')
+
     agent_parser = subparser.add_parser('agent', description='Manage deployment agents', help='Manage deployment agents')
     agent_subparser = agent_parser.add_subparsers(dest='agent_command')
     agent_add_parser = agent_subparser.add_parser('add', description='Create agent', help='Create agent')
@@ -88,6 +124,15 @@ def parse_arguments(argv):
     store_path_info_parser = store_path_subparser.add_parser('info', help="Display info about store path", description="Display info about store path")
     store_path_info_parser.add_argument('hash', help="Store path hash")
     store_path_info_parser.add_argument('cache', type=str, help='Binary cache name')
+    store_path_pin_parser = store_path_subparser.add_parser('pin', description="Keep store path and its closure from garbage collection", help='Keep store path and its closure from garbage collection')
+    store_path_pin_parser.add_argument('hash', help="Store path hash")
+    store_path_pin_parser.add_argument('cache', type=str, help='Binary cache name')
+    store_path_pin_parser.add_argument('-n', '--name', type=str, help='Root name, an existing root of the same name is replaced (default store path hash)')
+    store_path_unpin_parser = store_path_subparser.add_parser('unpin', description="Remove garbage collector root", help='Remove garbage collector root')
+    store_path_unpin_parser.add_argument('name', help="Root name")
+    store_path_unpin_parser.add_argument('cache', type=str, help='Binary cache name')
+    store_path_roots_parser = store_path_subparser.add_parser('roots', description="List garbage collector roots", help='List garbage collector roots')
+    store_path_roots_parser.add_argument('cache', type=str, help='Binary cache name')
 
     return parser.parse_args(argv)
 
@@ -102,7 +147,9 @@ def handle_arguments(argv) -> None:
         if arguments.start_command == 'server':
             command_handler.start_server()
         elif arguments.start_command == 'cache':
-            command_handler.start_cache(arguments.name, arguments.port)
+            command_handler.start_cache(arguments.name, arguments.port, arguments.workers, arguments.index)
+        elif arguments.start_command == 'caches':
+            command_handler.start_caches(arguments.workers, arguments.index)
 
     elif arguments.command == 'stop':
         command_handler.stop_command()
@@ -115,20 +162,36 @@ def handle_arguments(argv) -> None:
 
         if arguments.command == 'cache':
             if arguments.cache_command == 'create':
-                command_handler.cache_create(arguments.name, arguments.port, arguments.retention)
+                command_handler.cache_create(arguments.name, arguments.port, arguments.retention, arguments.max_size)
             elif arguments.cache_command == 'start':
-                command_handler.cache_start(arguments.name)
+                command_handler.cache_start(arguments.name, arguments.workers, arguments.index)
             elif arguments.cache_command == 'stop':
                 command_handler.cache_stop(arguments.name)
+            elif arguments.cache_command == 'start-all':
+                command_handler.cache_start_all(arguments.workers, arguments.index)
+            elif arguments.cache_command == 'stop-all':
+                command_handler.cache_stop_all()
             elif arguments.cache_command == 'delete':
                 command_handler.cache_delete(arguments.name)
             elif arguments.cache_command == 'update':
-                command_handler.cache_update(arguments.name, arguments.new_name, arguments.access, arguments.retention, arguments.port)
+                command_handler.cache_update(arguments.name, arguments.new_name, arguments.access, arguments.retention, arguments.port, arguments.max_size)
             elif arguments.cache_command == 'list':
                 command_handler.cache_list(arguments.private, arguments.public)
             elif arguments.cache_command == 'info':
                 command_handler.cache_info(arguments.name)
+            elif arguments.cache_command == 'resign':
+                command_handler.cache_resign(arguments.name, arguments.generate_keys)
+            elif arguments.cache_command == 'migrate-layout':
+                command_handler.cache_migrate_layout(arguments.name)
+            elif arguments.cache_command == 'collect-garbage':
+                command_handler.cache_collect_garbage(arguments.name)
+            elif arguments.cache_command == 'dedup':
+                command_handler.cache_dedup(arguments.name)
                 
+        elif arguments.command == 'storage':
+            if arguments.storage_command == 'dedup':
+                command_handler.storage_dedup()
+
         elif arguments.command == 'agent':
             if arguments.agent_command == 'add':
                 command_handler.agent_add(arguments.name, arguments.workspace)
@@ -158,3 +221,9 @@ def handle_arguments(argv) -> None:
                 command_handler.store_path_delete(arguments.cache, arguments.hash)
             elif arguments.store_path_command == 'info':
                 command_handler.store_path_info(arguments.hash, arguments.cache)
+            elif arguments.store_path_command == 'pin':
+                command_handler.store_path_pin(arguments.hash, arguments.cache, arguments.name)
+            elif arguments.store_path_command == 'unpin':
+                command_handler.store_path_unpin(arguments.name, arguments.cache)
+            elif arguments.store_path_command == 'roots':
+                command_handler.store_path_roots(arguments.cache)
@@ -15,6 +15,8 @@ import time
 import base64
 import ed25519
 from cache_server_app.src.database import CacheServerDatabase
+from cache_server_app.src.narinfo_cache import narinfo_cache
+from cache_server_app.src.storage import NarStorage
 
 class BinaryCache():
     """
@@ -22,6 +24,7 @@ class BinaryCache():
 
     Attributes:
         cache_dir: directory where cache stores NAR files
+        storage: object mapping NAR files to paths in cache_dir and the shared store
         database: object to handle database connection
         id: binary cache id
         name: binary cache name
@@ -29,11 +32,16 @@ class BinaryCache():
         token: binary cache JWT authentication token
         access: binary cache access ('public'/'private')
         port: port on which binary cache listens
-        retention: binary cache retention
+        retention: binary cache retention in weeks
+        max_size: maximum total size of NAR files of binary cache in bytes, -1 when unlimited
     """
 
-    def __init__(self, id: str, name: str, url: str, token: str, access: str, port: int, retention: int):
+    # maximum number of store paths deleted by garbage collector in one transaction
+    GC_BATCH_SIZE = 1000
+
+    def __init__(self, id: str, name: str, url: str, token: str, access: str, port: int, retention: int, max_size: int = -1):
         self.cache_dir = os.path.join(config.cache_dir, name)
+        self.storage = NarStorage(name)
         self.database = CacheServerDatabase()
         self.id = id
         self.name = name
@@ -42,30 +50,38 @@ class BinaryCache():
         self.access = access
         self.port = port
         self.retention = retention
+        self.max_size = max_size
 
     @staticmethod
     def get(name: str):
         row = CacheServerDatabase().get_binary_cache_row(name)
         if not row:
             return None
-        return BinaryCache(row[0], row[1], row[2], row[3], row[4], int(row[5]), int(row[6]))
+        return BinaryCache(row[0], row[1], row[2], row[3], row[4], int(row[5]), int(row[6]), int(row[7] or -1))
     
     @staticmethod
     def get_by_port(port: int):
         row = CacheServerDatabase().get_binary_cache_row_by_port(port)
         if not row:
             return None
-        return BinaryCache(row[0], row[1], row[2], row[3], row[4], row[5], row[6])
+        return BinaryCache(row[0], row[1], row[2], row[3], row[4], row[5], row[6], int(row[7] or -1))
 
     def save(self) -> None:
-        self.database.insert_binary_cache(self.id, self.name, self.url, self.token, self.access, self.port, self.retention)
+        self.database.insert_binary_cache(self.id, self.name, self.url, self.token, self.access, self.port, self.retention, self.max_size)
 
     def update(self) -> None:
-        self.database.update_binary_cache(self.id, self.name, self.url, self.token, self.access, self.port, self.retention)
+        self.database.update_binary_cache(self.id, self.name, self.url, self.token, self.access, self.port, self.retention, self.max_size)
 
     def delete(self) -> None:
+        nar_files = {(path[3], path[13] or 'xz') for path in self.get_paths()}
         self.database.delete_all_cache_paths(self.name)
         self.database.delete_binary_cache(self.name)
+        self.database.delete_cache_gc_roots(self.name)
+        narinfo_cache.invalidate_cache(self.name)
+
+        # NAR files in the shared store are removed when no other binary cache references them
+        for file_hash, compression in nar_files:
+            self.storage.release(file_hash, compression)
 
     def cache_json(self, permission: str) -> str:
         with open(os.path.join(self.cache_dir, 'key.pub'), 'r') as f:
@@ -95,27 +111,84 @@ class BinaryCache():
         return [path[1] for path in self.database.get_cache_store_paths(self.name)]
                 
     def get_missing_store_hashes(self, hashes: list) -> list:
-        return [store_hash for store_hash in hashes if store_hash not in self.get_store_hashes()]
+        existing = self.database.get_existing_store_hashes(self.name, hashes)
+        return [store_hash for store_hash in hashes if store_hash not in existing]
         
     def get_paths(self) -> list:
         return self.database.get_cache_store_paths(self.name)
     
+    # store signatures of (store_hash, signature) pairs in a single transaction
+    def update_signatures(self, signatures: list[tuple]) -> None:
+        self.database.update_store_path_signatures(self.name, signatures)
+        narinfo_cache.invalidate_cache(self.name)
+
     def update_workspaces(self, new_name: str) -> None:
         self.database.update_cache_in_workspaces(self.name, new_name)
 
     def update_paths(self, new_name: str) -> None:
         self.database.update_cache_in_paths(self.name, new_name)
+        self.database.update_cache_in_gc_roots(self.name, new_name)
+        narinfo_cache.invalidate_cache(self.name)
     
     def garbage_collector(self):
         while True:
-            self.collect_garbage()
+            removed, freed = self.collect_garbage()
+            if removed or freed:
+                print("Garbage collector removed %d store paths of binary cache %s, freed %d bytes." % (removed, self.name, freed))
             time.sleep(3600)
-    
-    def collect_garbage(self) -> None:
-        for file in os.listdir(self.cache_dir):
-            file_age = (os.path.getctime(os.path.join(self.cache_dir, file)) - time.time()) / 604800
-            if file_age > self.retention:
-                os.remove(file)
+
+    # True when store paths of binary cache are removed by garbage collector
+    def collects_garbage(self) -> bool:
+        return self.retention > 0 or self.max_size > 0
+
+    # delete store paths older than retention except closures of pinned roots and of the store paths kept, then
+    # least recently accessed store paths no kept store path references while the binary cache is larger than its
+    # maximum size, so that no kept store path loses its references, store paths are deleted in batches, each batch
+    # is deleted from the database in one transaction before its NAR files are released, files left by an interrupted
+    # run are removed by the next one, return (number of store paths removed, number of bytes freed)
+    def collect_garbage(self) -> tuple[int, int]:
+        removed = 0
+        freed = self.storage.release_unreferenced()
+
+        if self.retention > 0:
+            marked_at = int(time.time())
+            created_before = marked_at - self.retention * 604800
+            self.database.mark_live_store_paths(self.name, 'created_at', created_before)
+            while rows := self.database.delete_unmarked_store_paths(self.name, 'created_at', created_before, self.GC_BATCH_SIZE, marked_at):
+                removed += len(rows)
+                freed += self.remove_deleted_paths(rows)
+
+        if self.max_size > 0:
+            # only closures of pinned roots are marked, other store paths are deleted once nothing references them
+            self.database.mark_live_store_paths(self.name)
+            while (excess := self.database.get_cache_size(self.name) - self.max_size) > 0:
+                rows = self.database.delete_least_recently_accessed_store_paths(self.name, excess, self.GC_BATCH_SIZE)
+                if not rows:
+                    break
+                removed += len(rows)
+                freed += self.remove_deleted_paths(rows)
+
+        return removed, freed
+
+    # pin store path, so that garbage collector keeps it and its closure, a root of the same name is replaced
+    def pin(self, name: str, store_hash: str) -> None:
+        self.database.insert_gc_root(self.name, name, store_hash)
+
+    def unpin(self, name: str) -> None:
+        self.database.delete_gc_root(self.name, name)
+
+    # (name, store_hash, created_at) of pinned roots
+    def get_roots(self) -> list:
+        return self.database.get_gc_roots(self.name)
+
+    # release NAR files of (store_hash, file_hash, compression) store paths deleted from the database,
+    # return number of bytes freed
+    def remove_deleted_paths(self, rows: list) -> int:
+        for store_hash, file_hash, compression in rows:
+            narinfo_cache.invalidate(self.name, store_hash)
+
+        return sum(self.storage.release(file_hash, compression)
+                   for file_hash, compression in {(row[1], row[2] or 'xz') for row in rows})
 
     def generate_keys(self) -> None:
         sk, pk = ed25519.create_keypair()
@@ -127,3 +200,11 @@ class BinaryCache():
 
         with open(os.path.join(self.cache_dir, 'key.pub'), 'wb') as f:
             f.write(prefix + base64.b64encode(pk.to_bytes()))
+
+        narinfo_cache.invalidate_cache(self.name)
+
+    def get_signing_key(self) -> tuple[bytes, ed25519.SigningKey]:
+        with open(os.path.join(self.cache_dir, 'key.priv'), 'rb') as f:
+            content = f.read().split(b':')
+
+        return content[0], ed25519.SigningKey(base64.b64decode(content[1]))
@@ -18,13 +18,19 @@ import cache_server_app.src.config as config
 import threading
 import uuid
 import shutil
+import time
 
-from cache_server_app.src.api import CacheServerRequestHandler, BinaryCacheRequestHandler, WebSocketConnectionHandler, HTTPCacheServer, HTTPBinaryCache
+from datetime import datetime
+from cache_server_app.src.api import CacheServerRequestHandler, BinaryCacheRequestHandler, WebSocketConnectionHandler, HTTPCacheServer, HTTPBinaryCache, HTTPMultiBinaryCache
 from cache_server_app.src.database import CacheServerDatabase
 from cache_server_app.src.binary_cache import BinaryCache
 from cache_server_app.src.agent import Agent
 from cache_server_app.src.store_path import StorePath
 from cache_server_app.src.workspace import Workspace
+from cache_server_app.src.prefork import PreforkSupervisor, serve_until_terminated
+from cache_server_app.src.store_hash_filter import store_hash_filter
+from cache_server_app.src.store_path_index import store_path_index
+from cache_server_app.src.access_tracker import access_tracker
 
 class CacheServerCommandHandler():
     """
@@ -77,6 +83,8 @@ class CacheServerCommandHandler():
         asyncio.run(ws_handler.run())
 
     def start_server(self) -> None:
+        self.database.create_database()
+
         pid_file = "/var/run/cache-server.pid"
         self.save_pid(pid_file)
 
@@ -86,7 +94,6 @@ class CacheServerCommandHandler():
         server = HTTPCacheServer(
             ("localhost", config.server_port), CacheServerRequestHandler, ws_handler)
         print("Server started http://localhost:%d" % config.server_port)
-        CacheServerDatabase().create_database()
         server.serve_forever()
 
     # cache-server stop
@@ -106,7 +113,7 @@ class CacheServerCommandHandler():
             sys.exit(1)
 
     # cache-server cache create <name> <port>
-    def cache_create(self, name: str, port: int, retention: int | None) -> None:
+    def cache_create(self, name: str, port: int, retention: int | None, max_size: int | None = None) -> None:
         if BinaryCache.get(name):
             print("ERROR: Binary cache %s already exists." % name)
             sys.exit(1)
@@ -117,11 +124,14 @@ class CacheServerCommandHandler():
 
         if not retention:
             retention = -1
+
+        if not max_size:
+            max_size = -1
         
         cache_url = "http://{}.{}".format(name, config.server_hostname)
         cache_id = uuid.uuid1()
         cache_token = jwt.encode({'name': name}, config.key, algorithm="HS256")
-        cache = BinaryCache(cache_id, name, cache_url, cache_token, 'public', port, retention)
+        cache = BinaryCache(cache_id, name, cache_url, cache_token, 'public', port, retention, max_size)
         try:
             os.makedirs(cache.cache_dir)
         except FileExistsError:
@@ -133,8 +143,8 @@ class CacheServerCommandHandler():
         cache.generate_keys()
         cache.save()
         
-    # cache-server cache start <name>
-    def cache_start(self, name: str) -> None:
+    # cache-server cache start [-w <workers>] [-i] <name>
+    def cache_start(self, name: str, workers: int, index: bool = False) -> None:
         cache = BinaryCache.get(name)
         if not cache:
             print("ERROR: Binary cache %s does not exist." % name)
@@ -143,10 +153,17 @@ class CacheServerCommandHandler():
         if self.get_pid('/var/run/{}.pid'.format(cache.id)):
             print("ERROR: Binary cache %s is already running." % name)
             sys.exit(1)
+
+        if workers < 1:
+            print("ERROR: Number of workers must be at least 1.")
+            sys.exit(1)
             
-        subprocess.Popen(["cache-server", "hidden-start", "cache", name, str(cache.port)])
+        subprocess.Popen(["cache-server", "hidden-start", "cache", "--workers", str(workers)]
+                         + (["--index"] if index else []) + [name, str(cache.port)])
+
+    def start_cache(self, name: str, port: int, workers: int = 1, index: bool = False) -> None:
+        self.database.check_database()
 
-    def start_cache(self, name: str, port: int) -> None:
         cache = BinaryCache.get(name)
         if not cache:
             print("ERROR: Binary cache %s does not exist." % name)
@@ -155,14 +172,116 @@ class CacheServerCommandHandler():
         pid_file = '/var/run/{}.pid'.format(cache.id)
         self.save_pid(pid_file)
 
-        if cache.retention > 0:
-            ws_thread = threading.Thread(target=cache.garbage_collector)
-            ws_thread.start()
+        # loaded before forking, so that workers share the memory until they change it
+        if index:
+            store_path_index.load(cache.name)
+        else:
+            store_hash_filter.load(cache.name)
+
+        if workers == 1:
+            if cache.collects_garbage():
+                threading.Thread(target=cache.garbage_collector, daemon=True).start()
 
-        server = HTTPBinaryCache(
-            ("localhost", port), BinaryCacheRequestHandler, cache)
-        print("Binary cache started http://localhost:%d" % port)
-        server.serve_forever()
+            server = HTTPBinaryCache(
+                ("localhost", port), BinaryCacheRequestHandler, cache)
+            print("Binary cache started http://localhost:%d" % port)
+            serve_until_terminated(server)
+            access_tracker.flush()
+            return
+
+        # garbage is collected by the first worker only
+        def serve(index: int) -> None:
+            if index == 0 and cache.collects_garbage():
+                threading.Thread(target=cache.garbage_collector, daemon=True).start()
+            server = HTTPBinaryCache(
+                ("localhost", port), BinaryCacheRequestHandler, cache, reuse_port=True)
+            serve_until_terminated(server)
+            # requests recorded since the last flush are written before the worker exits
+            access_tracker.flush()
+
+        print("Binary cache started http://localhost:%d with %d workers" % (port, workers))
+        PreforkSupervisor(workers, serve).run()
+        self.remove_pid(pid_file)
+
+    # cache-server cache start-all [-w <workers>] [-i]
+    def cache_start_all(self, workers: int, index: bool = False) -> None:
+        if not config.binary_cache_port:
+            print("ERROR: binary-cache-port is not set in the configuration file.")
+            sys.exit(1)
+
+        if self.get_pid('/var/run/cache-server-caches.pid'):
+            print("ERROR: Binary caches are already running.")
+            sys.exit(1)
+
+        if workers < 1:
+            print("ERROR: Number of workers must be at least 1.")
+            sys.exit(1)
+
+        subprocess.Popen(["cache-server", "hidden-start", "caches", "--workers", str(workers)]
+                         + (["--index"] if index else []))
+
+    # collect garbage of all binary caches with retention or maximum size, caches are loaded again every run
+    def garbage_collector_all(self) -> None:
+        while True:
+            for row in self.database.get_cache_list():
+                cache = BinaryCache.get(row[1])
+                if cache and cache.collects_garbage():
+                    removed, freed = cache.collect_garbage()
+                    if removed or freed:
+                        print("Garbage collector removed %d store paths of binary cache %s, freed %d bytes." % (removed, cache.name, freed))
+            time.sleep(3600)
+
+    def start_caches(self, workers: int = 1, index: bool = False) -> None:
+        self.database.check_database()
+
+        pid_file = '/var/run/cache-server-caches.pid'
+        self.save_pid(pid_file)
+
+        # binary caches created later are served from the database
+        if index:
+            for row in self.database.get_cache_list():
+                store_path_index.load(row[1])
+
+        if workers == 1:
+            gc_thread = threading.Thread(target=self.garbage_collector_all, daemon=True)
+            gc_thread.start()
+
+            server = HTTPMultiBinaryCache(
+                ("localhost", config.binary_cache_port), BinaryCacheRequestHandler, config.cache_registry_ttl)
+            print("Binary caches started http://localhost:%d" % config.binary_cache_port)
+            serve_until_terminated(server)
+            access_tracker.flush()
+            return
+
+        # garbage is collected by the first worker only
+        def serve(index: int) -> None:
+            if index == 0:
+                threading.Thread(target=self.garbage_collector_all, daemon=True).start()
+            server = HTTPMultiBinaryCache(
+                ("localhost", config.binary_cache_port), BinaryCacheRequestHandler, config.cache_registry_ttl, reuse_port=True)
+            serve_until_terminated(server)
+            # requests recorded since the last flush are written before the worker exits
+            access_tracker.flush()
+
+        print("Binary caches started http://localhost:%d with %d workers" % (config.binary_cache_port, workers))
+        PreforkSupervisor(workers, serve).run()
+        self.remove_pid(pid_file)
+
+    # cache-server cache stop-all
+    def cache_stop_all(self) -> None:
+        pid_file = '/var/run/cache-server-caches.pid'
+        pid = self.get_pid(pid_file)
+        if pid:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                print("Server stopped.")
+                self.remove_pid(pid_file)
+            except ProcessLookupError:
+                print("Server is not running.")
+                self.remove_pid(pid_file)
+        else:
+            print("Server is not running.")
+            sys.exit(1)
 
     # cache-server cache stop <name>
     def cache_stop(self, name: str) -> None:
@@ -235,7 +354,8 @@ class CacheServerCommandHandler():
         agent.delete()
 
     # cache-server cache update
-    def cache_update(self, name: str, new_name: str | None , access: str | None, retention: int | None, port: int | None) -> None:
+    def cache_update(self, name: str, new_name: str | None , access: str | None, retention: int | None, port: int | None,
+                     max_size: int | None = None) -> None:
         cache = BinaryCache.get(name)
         if not cache:
             print("ERROR: Binary cache %s does not exist." % name)
@@ -262,11 +382,94 @@ class CacheServerCommandHandler():
         if retention:
             cache.retention = retention
 
+        if max_size:
+            cache.max_size = max_size
+
         if port:
             cache.port = port
 
         cache.update()
             
+    # cache-server cache resign <name>
+    def cache_resign(self, name: str, generate_keys: bool) -> None:
+        cache = BinaryCache.get(name)
+        if not cache:
+            print("ERROR: Binary cache %s does not exist." % name)
+            sys.exit(1)
+
+        if generate_keys:
+            cache.generate_keys()
+
+        signing_key = cache.get_signing_key()
+        paths = [StorePath.from_row(row, cache) for row in cache.get_paths()]
+        cache.update_signatures([(path.store_hash, path.sign(signing_key)) for path in paths])
+
+    # cache-server cache migrate-layout <name>
+    def cache_migrate_layout(self, name: str) -> None:
+        cache = BinaryCache.get(name)
+        if not cache:
+            print("ERROR: Binary cache %s does not exist." % name)
+            sys.exit(1)
+
+        # files are moved one by one, the binary cache can keep serving meanwhile
+        migrated = 0
+        for path in cache.get_paths():
+            if cache.storage.migrate(path[3], path[13] or 'xz'):
+                migrated += 1
+
+        print("Migrated %d NAR files." % migrated)
+
+    # cache-server cache collect-garbage <name>
+    def cache_collect_garbage(self, name: str) -> None:
+        cache = BinaryCache.get(name)
+        if not cache:
+            print("ERROR: Binary cache %s does not exist." % name)
+            sys.exit(1)
+
+        if not cache.collects_garbage():
+            print("ERROR: Binary cache %s has neither retention nor maximum size." % name)
+            sys.exit(1)
+
+        removed, freed = cache.collect_garbage()
+        print("Removed %d store paths, freed %d bytes." % (removed, freed))
+
+    # cache-server cache dedup <name>
+    def cache_dedup(self, name: str) -> None:
+        cache = BinaryCache.get(name)
+        if not cache:
+            print("ERROR: Binary cache %s does not exist." % name)
+            sys.exit(1)
+
+        moved, freed = self.deduplicate_cache(cache)
+        print("Moved %d NAR files to the shared store, freed %d bytes." % (moved, freed))
+
+    # cache-server storage dedup
+    def storage_dedup(self) -> None:
+        moved = 0
+        freed = 0
+        for row in self.database.get_cache_list():
+            cache = BinaryCache.get(row[1])
+            if not cache:
+                continue
+
+            cache_moved, cache_freed = self.deduplicate_cache(cache)
+            moved += cache_moved
+            freed += cache_freed
+
+        print("Moved %d NAR files to the shared store, freed %d bytes." % (moved, freed))
+
+    # move own NAR files of binary cache to the shared store, return (number of files moved, number of bytes freed)
+    def deduplicate_cache(self, cache: BinaryCache) -> tuple[int, int]:
+        # files are moved one by one, the binary cache can keep serving meanwhile
+        moved = 0
+        freed = 0
+        for file_hash, compression in {(path[3], path[13] or 'xz') for path in cache.get_paths()}:
+            file_moved, file_freed = cache.storage.deduplicate(file_hash, compression)
+            moved += file_moved
+            freed += file_freed
+
+        return moved, freed
+
     # cache-server cache list
     def cache_list(self, private: bool, public: bool) -> None:
         db_result = []
@@ -291,11 +494,18 @@ class CacheServerCommandHandler():
             retention = None
         else:
             retention = cache.retention
+
+        if cache.max_size == -1:
+            max_size = None
+        else:
+            max_size = cache.max_size
             
-        output = "Id: {}\nName: {}\nUrl: {}\nToken: {}\nAccess: {}\nPort: {}\nRetention: {}".format(cache.id, cache.name,
+        output = "Id: {}\nName: {}\nUrl: {}\nToken: {}\nAccess: {}\nPort: {}\nRetention: {}\nMax size: {}\nSize: {}\nDownloads: {}".format(cache.id, cache.name,
                                                                                                   cache.url, cache.token,
                                                                                                   cache.access, cache.port,
-                                                                                                  retention)
+                                                                                                  retention, max_size,
+                                                                                                  self.database.get_cache_size(cache.name),
+                                                                                                  self.database.get_cache_download_count(cache.name))
         print(output)
 
     # cache-server agent list <workspace_name>
@@ -330,10 +540,8 @@ class CacheServerCommandHandler():
             print("ERROR: Store path not found")
             sys.exit(1)
 
-        for file in os.listdir(cache.cache_dir):
-            if path.file_hash in file:
-                os.remove(os.path.join(cache.cache_dir, file))
         path.delete()
+        cache.storage.release(path.file_hash, path.compression)
 
     # cache-server store-path info <store_hash> <cache_name>
     def store_path_info(self, store_hash: str, cache_name: str) -> None:
@@ -347,9 +555,52 @@ class CacheServerCommandHandler():
             print("ERROR: Store path not found")
             sys.exit(1)
 
-        output = "Store hash: {}\nStore suffix: {}\nFile hash: {}".format(path.store_hash, path.store_suffix, path.file_hash)
+        if path.last_access:
+            last_access = datetime.fromtimestamp(path.last_access).strftime("%Y-%m-%d %H:%M:%S")
+        else:
+            last_access = None
+
+        output = "Store hash: {}\nStore suffix: {}\nFile hash: {}\nLast access: {}\nDownloads: {}".format(path.store_hash, path.store_suffix,
+                                                                                                     path.file_hash, last_access,
+                                                                                                     path.download_count)
         print(output)
 
+    # cache-server store-path pin <store_hash> <cache_name> [-n <name>]
+    def store_path_pin(self, store_hash: str, cache_name: str, name: str | None) -> None:
+        cache = BinaryCache.get(cache_name)
+        if not cache:
+            print("ERROR: Binary cache %s does not exist." % cache_name)
+            sys.exit(1)
+
+        if not StorePath.get(cache_name, store_hash=store_hash):
+            print("ERROR: Store path not found")
+            sys.exit(1)
+
+        cache.pin(name or store_hash, store_hash)
+
+    # cache-server store-path unpin <name> <cache_name>
+    def store_path_unpin(self, name: str, cache_name: str) -> None:
+        cache = BinaryCache.get(cache_name)
+        if not cache:
+            print("ERROR: Binary cache %s does not exist." % cache_name)
+            sys.exit(1)
+
+        if name not in [root[0] for root in cache.get_roots()]:
+            print("ERROR: Root %s does not exist." % name)
+            sys.exit(1)
+
+        cache.unpin(name)
+
+    # cache-server store-path roots <cache_name>
+    def store_path_roots(self, cache_name: str) -> None:
+        cache = BinaryCache.get(cache_name)
+        if not cache:
+            print("ERROR: Binary cache %s does not exist." % cache_name)
+            sys.exit(1)
+
+        for name, store_hash, created_at in cache.get_roots():
+            print("{} {}".format(name, store_hash))
+
     # cache-server agent info <name>
     def agent_info(self, name: str) -> None:
         agent = Agent.get(name)
@@ -28,6 +28,22 @@ try:
     server_port = int(config.get('cache-server', 'server-port'))
     deploy_port = int(config.get('cache-server', 'deploy-port'))
     key = config.get('cache-server', 'key')
+    database_pool_size = int(config.get('cache-server', 'database-pool-size', fallback='8'))
+    database_busy_timeout = float(config.get('cache-server', 'database-busy-timeout', fallback='5'))
+    binary_cache_port = int(config.get('cache-server', 'binary-cache-port', fallback='0'))
+    cache_registry_ttl = float(config.get('cache-server', 'cache-registry-ttl', fallback='10'))
+    http_workers = int(config.get('cache-server', 'http-workers', fallback='16'))
+    http_queue_size = int(config.get('cache-server', 'http-queue-size', fallback='128'))
+    http_keepalive_timeout = float(config.get('cache-server', 'http-keepalive-timeout', fallback='15'))
+    http_keepalive_requests = int(config.get('cache-server', 'http-keepalive-requests', fallback='1000'))
+    narinfo_cache_size = int(config.get('cache-server', 'narinfo-cache-size', fallback='10000'))
+    narinfo_cache_ttl = int(config.get('cache-server', 'narinfo-cache-ttl', fallback='60'))
+    narinfo_cache_refresh_interval = float(config.get('cache-server', 'narinfo-cache-refresh-interval', fallback='1'))
+    narinfo_max_age = int(config.get('cache-server', 'narinfo-max-age', fallback='300'))
+    store_hash_filter_error_rate = float(config.get('cache-server', 'store-hash-filter-error-rate', fallback='0.01'))
+    store_path_index_refresh_interval = float(config.get('cache-server', 'store-path-index-refresh-interval', fallback='1'))
+    access_flush_interval = float(config.get('cache-server', 'access-flush-interval', fallback='60'))
+    access_tracker_size = int(config.get('cache-server', 'access-tracker-size', fallback='100000'))
 except Exception:
     print("ERROR: Failed to parse config.")
     sys.exit(1)
@@ -10,134 +10,600 @@ Date: 1.5.2024
 
 import sqlite3
 import os
+import sys
+import queue
+import threading
 import cache_server_app.src.config as config
 
+from contextlib import contextmanager, closing
+
+# maximum number of variables bound to one statement (SQLite limit is 999 in older versions)
+MAX_STATEMENT_VARIABLES = 500
+
+class ConnectionPool():
+    """
+    Class to share long-lived SQLite connections between threads.
+
+    Connections are handed out in last in first out order, so a thread
+    issuing queries in sequence keeps reusing the same connection and its
+    statement cache.
+
+    Attributes:
+        database_file: database file the connections are opened to
+        max_size: maximum number of open connections
+        busy_timeout: number of seconds to wait for a lock held by another connection
+        idle: connections not used by any thread
+        size: number of open connections
+        lock: lock guarding size
+    """
+
+    pools = {}
+    pools_lock = threading.Lock()
+
+    def __init__(self, database_file: str, max_size: int, busy_timeout: float):
+        self.database_file = database_file
+        self.max_size = max_size
+        self.busy_timeout = busy_timeout
+        self.idle = queue.LifoQueue()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    # return the pool shared by all CacheServerDatabase objects of the process,
+    # forked worker processes never use connections opened by their parent
+    @staticmethod
+    def get(database_file: str):
+        key = (os.getpid(), database_file)
+        with ConnectionPool.pools_lock:
+            if key not in ConnectionPool.pools:
+                ConnectionPool.pools[key] = ConnectionPool(database_file, config.database_pool_size, config.database_busy_timeout)
+            return ConnectionPool.pools[key]
+
+    def connect(self) -> sqlite3.Connection:
+        # writes start with BEGIN IMMEDIATE so that lock waits respect the busy timeout
+        db_connection = sqlite3.connect(self.database_file,
+                                        timeout=self.busy_timeout,
+                                        isolation_level='IMMEDIATE',
+                                        check_same_thread=False)
+        db_connection.execute("PRAGMA journal_mode = WAL")
+        db_connection.execute("PRAGMA synchronous = NORMAL")
+        db_connection.execute("PRAGMA cache_size = -16000")
+        db_connection.execute("PRAGMA mmap_size = 268435456")
+        db_connection.execute("PRAGMA temp_store = MEMORY")
+        return db_connection
+
+    @contextmanager
+    def connection(self):
+        try:
+            db_connection = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                create = self.size < self.max_size
+                if create:
+                    self.size += 1
+            if create:
+                try:
+                    db_connection = self.connect()
+                except sqlite3.Error:
+                    with self.lock:
+                        self.size -= 1
+                    raise
+            else:
+                db_connection = self.idle.get()
+
+        try:
+            yield db_connection
+        finally:
+            self.idle.put(db_connection)
+
+    # close idle connections, used before the database file is removed
+    def close(self) -> None:
+        while True:
+            try:
+                db_connection = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            db_connection.close()
+            with self.lock:
+                self.size -= 1
+
 class CacheServerDatabase():
     """
     Class to handle SQLite database queires.
 
     Attributes:
         database_file: database file specified in the cache-server configuration
+        pool: pool of connections to the database file
     """
     def __init__(self):
         self.database_file = config.database
 
-    # create tables in case database file is empty
+    # looked up on every use, so objects created before fork use the pool of the worker
+    @property
+    def pool(self) -> ConnectionPool:
+        return ConnectionPool.get(self.database_file)
+
+    def close(self) -> None:
+        self.pool.close()
+
+    # create database file if missing and migrate it to the current schema version
     def create_database(self) -> None:
+        migrations = self.get_migrations()
+        version = self.get_schema_version()
+
+        if version > len(migrations):
+            print("ERROR: Database %s has schema version %d, this cache-server supports version %d." % (self.database_file, version, len(migrations)))
+            sys.exit(1)
+
+        with closing(sqlite3.connect(self.database_file, isolation_level=None)) as db_connection:
+            db_cursor = db_connection.cursor()
+
+            # every migration runs in its own transaction together with the version update
+            for new_version in range(version + 1, len(migrations) + 1):
+                db_cursor.execute("BEGIN")
+                try:
+                    migrations[new_version - 1](db_cursor)
+                    db_cursor.execute("PRAGMA user_version = {}".format(new_version))
+                    db_cursor.execute("COMMIT")
+                except sqlite3.Error as e:
+                    db_cursor.execute("ROLLBACK")
+                    print("ERROR: Database migration to schema version %d failed: %s" % (new_version, e))
+                    sys.exit(1)
+
+    # exit in case database was not migrated to the schema version of this cache-server
+    def check_database(self) -> None:
+        version = self.get_schema_version()
+        if version != len(self.get_migrations()):
+            print("ERROR: Database %s has schema version %d, this cache-server requires version %d." % (self.database_file, version, len(self.get_migrations())))
+            sys.exit(1)
+
+    def get_schema_version(self) -> int:
+        with closing(sqlite3.connect(self.database_file)) as db_connection:
+            return db_connection.execute("PRAGMA user_version").fetchone()[0]
+
+    # schema migrations, the schema version stored in the database is the number of applied migrations
+    def get_migrations(self) -> list:
+        return [
+            self.migration_create_tables,
+            self.migration_store_path_indexes,
+            self.migration_nar_upload,
+            self.migration_nar_upload_part,
+            self.migration_upload_sessions,
+            self.migration_store_path_change,
+            self.migration_store_path_change_update,
+            self.migration_nar_file,
+            self.migration_garbage_collection,
+            self.migration_max_size,
+            self.migration_download_count,
+            self.migration_gc_roots,
+            self.migration_referrers,
+            self.migration_nar_release,
+            self.migration_unique_store_path
+        ]
+
+    def add_column(self, db_cursor: sqlite3.Cursor, table: str, column: str, definition: str) -> None:
+        columns = [row[1] for row in db_cursor.execute("PRAGMA table_info({})".format(table)).fetchall()]
+        if column not in columns:
+            db_cursor.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table, column, definition))
+
+    # version 1, tables of databases created before schema versioning are kept
+    def migration_create_tables(self, db_cursor: sqlite3.Cursor) -> None:
+        db_cursor.execute(""" CREATE TABLE IF NOT EXISTS binary_cache (
+                                id VARCHAR UNIQUE,
+                                name VARCHAR UNIQUE,
+                                url VARCHAR,
+                                token VARCHAR,
+                                access VARCHAR,
+                                port VARCHAR,
+                                retention INT
+                            ); """)
+
+        db_cursor.execute(""" CREATE TABLE IF NOT EXISTS store_path (
+                                id VARCHAR UNIQUE,
+                                store_hash VARCHAR,
+                                store_suffix VARCHAR,
+                                file_hash VARCHAR,
+                                file_size INT,
+                                nar_hash VARCHAR,
+                                nar_size INT,
+                                deriver VARCHAR,
+                                refs VARCHAR,
+                                cache_name VARCHAR,
+                                FOREIGN KEY(cache_name) REFERENCES binary_cache(name)
+                            ); """)
+
+        db_cursor.execute(""" CREATE TABLE IF NOT EXISTS workspace (
+                                id VARCHAR UNIQUE,
+                                name VARCHAR,
+                                token VARCHAR,
+                                cache_name VARCHAR,
+                                FOREIGN KEY(cache_name) REFERENCES binary_cache(name)
+                            ); """)
+
+        db_cursor.execute(""" CREATE TABLE IF NOT EXISTS agent (
+                                id VARCHAR UNIQUE,
+                                name VARCHAR,
+                                token VARCHAR,
+                                workspace_name VARCHAR,
+                                FOREIGN KEY(workspace_name) REFERENCES workspace(name)
+                            ); """)
+
+    # version 2, narinfo signature, timestamps, compression and store path lookup indexes
+    def migration_store_path_indexes(self, db_cursor: sqlite3.Cursor) -> None:
+        self.add_column(db_cursor, 'store_path', 'signature', 'VARCHAR')
+        self.add_column(db_cursor, 'store_path', 'created_at', 'INT')
+        self.add_column(db_cursor, 'store_path', 'last_access', 'INT')
+        self.add_column(db_cursor, 'store_path', 'compression', 'VARCHAR')
+        db_cursor.execute("UPDATE store_path SET created_at = CAST(strftime('%s', 'now') AS INT) WHERE created_at IS NULL")
+        db_cursor.execute("CREATE INDEX IF NOT EXISTS store_path_cache_store_hash ON store_path (cache_name, store_hash)")
+        db_cursor.execute("CREATE INDEX IF NOT EXISTS store_path_cache_file_hash ON store_path (cache_name, file_hash)")
+
+    # version 3, file hash and size of uploaded NAR files
+    def migration_nar_upload(self, db_cursor: sqlite3.Cursor) -> None:
+        db_cursor.execute(""" CREATE TABLE IF NOT EXISTS nar_upload (
+                                id VARCHAR UNIQUE,
+                                cache_name VARCHAR,
+                                file_hash VARCHAR,
+                                file_size INT,
+                                FOREIGN KEY(cache_name) REFERENCES binary_cache(name)
+                            ); """)
+
+    # version 4, parts of multipart NAR uploads
+    def migration_nar_upload_part(self, db_cursor: sqlite3.Cursor) -> None:
+        db_cursor.execute(""" CREATE TABLE IF NOT EXISTS nar_upload_part (
+                                upload_id VARCHAR,
+                                part_number INT,
+                                etag VARCHAR,
+                                file_hash VARCHAR,
+                                file_size INT,
+                                UNIQUE(upload_id, part_number)
+                            ); """)
+
+    # version 5, upload sessions and compression of stored NAR files
+    def migration_upload_sessions(self, db_cursor: sqlite3.Cursor) -> None:
+        self.add_column(db_cursor, 'nar_upload', 'file_name', 'VARCHAR')
+        self.add_column(db_cursor, 'nar_upload', 'compression', 'VARCHAR')
+        self.add_column(db_cursor, 'nar_upload', 'state', 'VARCHAR')
+        self.add_column(db_cursor, 'nar_upload', 'created_at', 'INT')
+
+        # compression of existing store paths is determined from their NAR files once
+        rows = db_cursor.execute("SELECT store_hash, cache_name, file_hash FROM store_path WHERE compression IS NULL").fetchall()
+        for store_hash, cache_name, file_hash in rows:
+            compression = 'xz'
+            if os.path.exists(os.path.join(config.cache_dir, cache_name, '{}.nar.zst'.format(file_hash))):
+                compression = 'zst'
+            db_cursor.execute("UPDATE store_path SET compression=? WHERE store_hash=? AND cache_name=?", (compression, store_hash, cache_name))
+
+    # version 6, log of added and removed store hashes read by processes keeping them in memory,
+    # the log keeps the last 100000 changes, processes lagging further load the store hashes again
+    def migration_store_path_change(self, db_cursor: sqlite3.Cursor) -> None:
+        db_cursor.execute(""" CREATE TABLE IF NOT EXISTS store_path_change (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                cache_name VARCHAR,
+                                store_hash VARCHAR,
+                                deleted INT
+                            ); """)
+
+        db_cursor.execute(""" CREATE TRIGGER IF NOT EXISTS store_path_change_insert AFTER INSERT ON store_path
+                            BEGIN
+                                INSERT INTO store_path_change (cache_name, store_hash, deleted) VALUES (NEW.cache_name, NEW.store_hash, 0);
+                            END; """)
+
+        db_cursor.execute(""" CREATE TRIGGER IF NOT EXISTS store_path_change_delete AFTER DELETE ON store_path
+                            BEGIN
+                                INSERT INTO store_path_change (cache_name, store_hash, deleted) VALUES (OLD.cache_name, OLD.store_hash, 1);
+                            END; """)
+
+        db_cursor.execute(""" CREATE TRIGGER IF NOT EXISTS store_path_change_update AFTER UPDATE OF cache_name, store_hash ON store_path
+                            BEGIN
+                                INSERT INTO store_path_change (cache_name, store_hash, deleted) VALUES (OLD.cache_name, OLD.store_hash, 1);
+                                INSERT INTO store_path_change (cache_name, store_hash, deleted) VALUES (NEW.cache_name, NEW.store_hash, 0);
+                            END; """)
+
+        db_cursor.execute(""" CREATE TRIGGER IF NOT EXISTS store_path_change_prune AFTER INSERT ON store_path_change
+                            BEGIN
+                                DELETE FROM store_path_change WHERE id <= NEW.id - 100000;
+                            END; """)
+
+    # version 7, changes of narinfo fields are logged as well, for processes keeping whole store paths in memory
+    def migration_store_path_change_update(self, db_cursor: sqlite3.Cursor) -> None:
+        db_cursor.execute(""" CREATE TRIGGER IF NOT EXISTS store_path_change_update_fields
+                            AFTER UPDATE OF store_suffix, file_hash, file_size, nar_hash, nar_size, deriver, refs, signature, compression ON store_path
+                            BEGIN
+                                INSERT INTO store_path_change (cache_name, store_hash, deleted) VALUES (NEW.cache_name, NEW.store_hash, 0);
+                            END; """)
+
+    # version 8, NAR files shared by binary caches, counting store paths referencing them
+    def migration_nar_file(self, db_cursor: sqlite3.Cursor) -> None:
+        db_cursor.execute(""" CREATE TABLE IF NOT EXISTS nar_file (
+                                file_hash VARCHAR,
+                                compression VARCHAR,
+                                refcount INT,
+                                UNIQUE(file_hash, compression)
+                            ); """)
+
+        db_cursor.execute(""" INSERT OR IGNORE INTO nar_file (file_hash, compression, refcount)
+                                SELECT file_hash, COALESCE(compression, 'xz'), COUNT(*) FROM store_path
+                                WHERE file_hash IS NOT NULL
+                                GROUP BY file_hash, COALESCE(compression, 'xz')
+                            ; """)
+
+        db_cursor.execute(""" CREATE TRIGGER IF NOT EXISTS nar_file_reference AFTER INSERT ON store_path
+                            WHEN NEW.file_hash IS NOT NULL
+                            BEGIN
+                                INSERT OR IGNORE INTO nar_file (file_hash, compression, refcount) VALUES (NEW.file_hash, COALESCE(NEW.compression, 'xz'), 0);
+                                UPDATE nar_file SET refcount = refcount + 1 WHERE file_hash = NEW.file_hash AND compression = COALESCE(NEW.compression, 'xz');
+                            END; """)
+
+        db_cursor.execute(""" CREATE TRIGGER IF NOT EXISTS nar_file_release AFTER DELETE ON store_path
+                            WHEN OLD.file_hash IS NOT NULL
+                            BEGIN
+                                UPDATE nar_file SET refcount = refcount - 1 WHERE file_hash = OLD.file_hash AND compression = COALESCE(OLD.compression, 'xz');
+                                DELETE FROM nar_file WHERE file_hash = OLD.file_hash AND compression = COALESCE(OLD.compression, 'xz') AND refcount <= 0;
+                            END; """)
+
+        db_cursor.execute(""" CREATE TRIGGER IF NOT EXISTS nar_file_update AFTER UPDATE OF file_hash, compression ON store_path
+                            BEGIN
+                                UPDATE nar_file SET refcount = refcount - 1 WHERE file_hash = OLD.file_hash AND compression = COALESCE(OLD.compression, 'xz');
+                                DELETE FROM nar_file WHERE file_hash = OLD.file_hash AND compression = COALESCE(OLD.compression, 'xz') AND refcount <= 0;
+                                INSERT OR IGNORE INTO nar_file (file_hash, compression, refcount) VALUES (NEW.file_hash, COALESCE(NEW.compression, 'xz'), 0);
+                                UPDATE nar_file SET refcount = refcount + 1 WHERE file_hash = NEW.file_hash AND compression = COALESCE(NEW.compression, 'xz');
+                            END; """)
+
+    # version 9, store paths expired by retention are looked up by index and NAR files are released in batches,
+    # unreferenced NAR files keep their row until the file is removed, so an interrupted removal is finished later
+    def migration_garbage_collection(self, db_cursor: sqlite3.Cursor) -> None:
+        db_cursor.execute("CREATE INDEX IF NOT EXISTS store_path_cache_created_at ON store_path (cache_name, created_at)")
+        db_cursor.execute("CREATE INDEX IF NOT EXISTS nar_file_released ON nar_file (file_hash) WHERE refcount <= 0")
+
+        db_cursor.execute("DROP TRIGGER IF EXISTS nar_file_release")
+        db_cursor.execute(""" CREATE TRIGGER nar_file_release AFTER DELETE ON store_path
+                            WHEN OLD.file_hash IS NOT NULL
+                            BEGIN
+                                UPDATE nar_file SET refcount = refcount - 1 WHERE file_hash = OLD.file_hash AND compression = COALESCE(OLD.compression, 'xz');
+                            END; """)
+
+        db_cursor.execute("DROP TRIGGER IF EXISTS nar_file_update")
+        db_cursor.execute(""" CREATE TRIGGER nar_file_update AFTER UPDATE OF file_hash, compression ON store_path
+                            BEGIN
+                                UPDATE nar_file SET refcount = refcount - 1 WHERE file_hash = OLD.file_hash AND compression = COALESCE(OLD.compression, 'xz');
+                                INSERT OR IGNORE INTO nar_file (file_hash, compression, refcount) VALUES (NEW.file_hash, COALESCE(NEW.compression, 'xz'), 0);
+                                UPDATE nar_file SET refcount = refcount + 1 WHERE file_hash = NEW.file_hash AND compression = COALESCE(NEW.compression, 'xz');
+                            END; """)
+
+    # version 10, size quota of binary caches evicting least recently accessed store paths,
+    # total size of NAR files of every binary cache is kept up to date by triggers
+    def migration_max_size(self, db_cursor: sqlite3.Cursor) -> None:
+        self.add_column(db_cursor, 'binary_cache', 'max_size', 'INT')
+        db_cursor.execute("UPDATE store_path SET last_access = created_at WHERE last_access IS NULL")
+        db_cursor.execute("CREATE INDEX IF NOT EXISTS store_path_cache_last_access ON store_path (cache_name, last_access)")
+
+        db_cursor.execute(""" CREATE TABLE IF NOT EXISTS cache_size (
+                                cache_name VARCHAR UNIQUE,
+                                size INT
+                            ); """)
+
+        db_cursor.execute(""" INSERT OR IGNORE INTO cache_size (cache_name, size)
+                                SELECT cache_name, SUM(COALESCE(file_size, 0)) FROM store_path
+                                GROUP BY cache_name
+                            ; """)
+
+        db_cursor.execute(""" CREATE TRIGGER IF NOT EXISTS cache_size_insert AFTER INSERT ON store_path
+                            BEGIN
+                                INSERT OR IGNORE INTO cache_size (cache_name, size) VALUES (NEW.cache_name, 0);
+                                UPDATE cache_size SET size = size + COALESCE(NEW.file_size, 0) WHERE cache_name = NEW.cache_name;
+                            END; """)
+
+        db_cursor.execute(""" CREATE TRIGGER IF NOT EXISTS cache_size_delete AFTER DELETE ON store_path
+                            BEGIN
+                                UPDATE cache_size SET size = size - COALESCE(OLD.file_size, 0) WHERE cache_name = OLD.cache_name;
+                            END; """)
 
-        # create database file if missing
-        if not os.path.exists(self.database_file):
-            with open(self.database_file, 'w'):
-                pass
-
-        # check if database file is empty
-        if os.stat(self.database_file).st_size == 0:
-
-            binary_cache_table = """ CREATE TABLE binary_cache (
-                                    id VARCHAR UNIQUE,
-                                    name VARCHAR UNIQUE,
-                                    url VARCHAR,
-                                    token VARCHAR,
-                                    access VARCHAR,
-                                    port VARCHAR,
-                                    retention INT
-                                ); """
-                
-            store_path_table = """ CREATE TABLE store_path (
-                                    id VARCHAR UNIQUE,
-                                    store_hash VARCHAR,
-                                    store_suffix VARCHAR,
-                                    file_hash VARCHAR,
-                                    file_size INT,
-                                    nar_hash VARCHAR,
-                                    nar_size INT,
-                                    deriver VARCHAR,
-                                    refs VARCHAR,
-                                    cache_name VARCHAR,
-                                    FOREIGN KEY(cache_name) REFERENCES binary_cache(name)
-                                ); """
-            
-            workspace_table = """ CREATE TABLE workspace (
-                                    id VARCHAR UNIQUE,
-                                    name VARCHAR,
-                                    token VARCHAR,
-                                    cache_name VARCHAR,
-                                    FOREIGN KEY(cache_name) REFERENCES binary_cache(name)
-                                ); """
-            
-            agent_table = """ CREATE TABLE agent (
-                                    id VARCHAR UNIQUE,
-                                    name VARCHAR,
-                                    token VARCHAR,
-                                    workspace_name VARCHAR,
-                                    FOREIGN KEY(workspace_name) REFERENCES workspace(name)
-                                ); """
-            
-            # create tables
-            with sqlite3.connect(self.database_file) as db_connection:
-                db_cursor = db_connection.cursor()
-                db_cursor.execute(binary_cache_table)
-                db_cursor.execute(store_path_table)
-                db_cursor.execute(workspace_table)
-                db_cursor.execute(agent_table)
-                db_connection.commit()
-
-    # execute statements without returning any value
-    def execute_statement(self, statement: str) -> None:
+        db_cursor.execute(""" CREATE TRIGGER IF NOT EXISTS cache_size_update AFTER UPDATE OF cache_name, file_size ON store_path
+                            BEGIN
+                                UPDATE cache_size SET size = size - COALESCE(OLD.file_size, 0) WHERE cache_name = OLD.cache_name;
+                                INSERT OR IGNORE INTO cache_size (cache_name, size) VALUES (NEW.cache_name, 0);
+                                UPDATE cache_size SET size = size + COALESCE(NEW.file_size, 0) WHERE cache_name = NEW.cache_name;
+                            END; """)
+
+    # version 11, number of NAR downloads of store paths
+    def migration_download_count(self, db_cursor: sqlite3.Cursor) -> None:
+        self.add_column(db_cursor, 'store_path', 'download_count', 'INT NOT NULL DEFAULT 0')
+
+    # version 12, references of store paths as rows, so that garbage collector can mark closures of pinned
+    # roots and of retained store paths, store path names contain no quotes, so refs split as JSON arrays
+    def migration_gc_roots(self, db_cursor: sqlite3.Cursor) -> None:
+        db_cursor.execute(""" CREATE TABLE IF NOT EXISTS store_path_ref (
+                                cache_name VARCHAR,
+                                store_hash VARCHAR,
+                                ref_hash VARCHAR
+                            ); """)
+        db_cursor.execute("CREATE INDEX IF NOT EXISTS store_path_ref_cache_store_hash ON store_path_ref (cache_name, store_hash)")
+
+        db_cursor.execute(""" INSERT INTO store_path_ref (cache_name, store_hash, ref_hash)
+                                SELECT DISTINCT cache_name, store_hash, substr(value, 1, 32)
+                                FROM store_path, json_each('["' || replace(refs, ' ', '","') || '"]')
+                                WHERE value <> '' AND substr(value, 1, 32) <> store_hash
+                            ; """)
+
+        db_cursor.execute(""" CREATE TRIGGER IF NOT EXISTS store_path_ref_insert AFTER INSERT ON store_path
+                            BEGIN
+                                INSERT INTO store_path_ref (cache_name, store_hash, ref_hash)
+                                SELECT DISTINCT NEW.cache_name, NEW.store_hash, substr(value, 1, 32)
+                                FROM json_each('["' || replace(COALESCE(NEW.refs, ''), ' ', '","') || '"]')
+                                WHERE value <> '' AND substr(value, 1, 32) <> NEW.store_hash;
+                            END; """)
+
+        db_cursor.execute(""" CREATE TRIGGER IF NOT EXISTS store_path_ref_delete AFTER DELETE ON store_path
+                            BEGIN
+                                DELETE FROM store_path_ref WHERE cache_name = OLD.cache_name AND store_hash = OLD.store_hash;
+                            END; """)
+
+        db_cursor.execute(""" CREATE TRIGGER IF NOT EXISTS store_path_ref_update AFTER UPDATE OF cache_name, store_hash, refs ON store_path
+                            BEGIN
+                                DELETE FROM store_path_ref WHERE cache_name = OLD.cache_name AND store_hash = OLD.store_hash;
+                                INSERT INTO store_path_ref (cache_name, store_hash, ref_hash)
+                                SELECT DISTINCT NEW.cache_name, NEW.store_hash, substr(value, 1, 32)
+                                FROM json_each('["' || replace(COALESCE(NEW.refs, ''), ' ', '","') || '"]')
+                                WHERE value <> '' AND substr(value, 1, 32) <> NEW.store_hash;
+                            END; """)
+
+        db_cursor.execute(""" CREATE TABLE IF NOT EXISTS gc_root (
+                                cache_name VARCHAR,
+                                name VARCHAR,
+                                store_hash VARCHAR,
+                                created_at INT,
+                                UNIQUE(cache_name, name)
+                            ); """)
+
+        db_cursor.execute(""" CREATE TABLE IF NOT EXISTS gc_live (
+                                cache_name VARCHAR,
+                                store_hash VARCHAR,
+                                PRIMARY KEY(cache_name, store_hash)
+                            ) WITHOUT ROWID; """)
+
+    # version 13, number of store paths of the same binary cache referencing every store path, so that
+    # quota eviction finds the least recently accessed store path no other store path needs by index
+    def migration_referrers(self, db_cursor: sqlite3.Cursor) -> None:
+        self.add_column(db_cursor, 'store_path', 'referrers', 'INT NOT NULL DEFAULT 0')
+        db_cursor.execute("CREATE INDEX IF NOT EXISTS store_path_ref_cache_ref_hash ON store_path_ref (cache_name, ref_hash)")
+        db_cursor.execute(""" UPDATE store_path SET referrers = (
+                                SELECT COUNT(*) FROM store_path_ref
+                                WHERE store_path_ref.cache_name = store_path.cache_name
+                                AND store_path_ref.ref_hash = store_path.store_hash
+                            ); """)
+        db_cursor.execute("CREATE INDEX IF NOT EXISTS store_path_cache_unreferenced ON store_path (cache_name, last_access) WHERE referrers = 0")
+
+        db_cursor.execute(""" CREATE TRIGGER IF NOT EXISTS store_path_referrers_insert AFTER INSERT ON store_path
+                            BEGIN
+                                UPDATE store_path SET referrers = (
+                                    SELECT COUNT(*) FROM store_path_ref
+                                    WHERE cache_name = NEW.cache_name AND ref_hash = NEW.store_hash
+                                ) WHERE rowid = NEW.rowid;
+                            END; """)
+
+        db_cursor.execute(""" CREATE TRIGGER IF NOT EXISTS store_path_ref_reference AFTER INSERT ON store_path_ref
+                            BEGIN
+                                UPDATE store_path SET referrers = referrers + 1 WHERE cache_name = NEW.cache_name AND store_hash = NEW.ref_hash;
+                            END; """)
+
+        db_cursor.execute(""" CREATE TRIGGER IF NOT EXISTS store_path_ref_release AFTER DELETE ON store_path_ref
+                            BEGIN
+                                UPDATE store_path SET referrers = referrers - 1 WHERE cache_name = OLD.cache_name AND store_hash = OLD.ref_hash;
+                            END; """)
+
+    # version 14, NAR files of deleted store paths are recorded in the same transaction and forgotten once
+    # the binary cache released them, so that copies of the binary cache left by an interrupted release are found
+    def migration_nar_release(self, db_cursor: sqlite3.Cursor) -> None:
+        db_cursor.execute(""" CREATE TABLE IF NOT EXISTS nar_release (
+                                cache_name VARCHAR,
+                                file_hash VARCHAR,
+                                compression VARCHAR,
+                                UNIQUE(cache_name, file_hash, compression)
+                            ); """)
+
+        db_cursor.execute(""" CREATE TRIGGER IF NOT EXISTS nar_release_delete AFTER DELETE ON store_path
+                            WHEN OLD.file_hash IS NOT NULL
+                            BEGIN
+                                INSERT OR IGNORE INTO nar_release (cache_name, file_hash, compression) VALUES (OLD.cache_name, OLD.file_hash, COALESCE(OLD.compression, 'xz'));
+                            END; """)
+
+    # version 15, store path pushed again replaces its row instead of adding another one with the same store hash,
+    # references and other rows derived from the store hash are kept by the update triggers
+    def migration_unique_store_path(self, db_cursor: sqlite3.Cursor) -> None:
+        # deleting older duplicates drops the references of the kept rows as well, they are added back
+        db_cursor.execute(""" DELETE FROM store_path WHERE rowid NOT IN (
+                                SELECT MAX(rowid) FROM store_path GROUP BY cache_name, store_hash
+                            ); """)
+        db_cursor.execute(""" INSERT INTO store_path_ref (cache_name, store_hash, ref_hash)
+                                SELECT DISTINCT cache_name, store_hash, substr(value, 1, 32)
+                                FROM store_path, json_each('["' || replace(COALESCE(refs, ''), ' ', '","') || '"]')
+                                WHERE value <> '' AND substr(value, 1, 32) <> store_hash
+                                AND NOT EXISTS (
+                                    SELECT 1 FROM store_path_ref
+                                    WHERE store_path_ref.cache_name = store_path.cache_name
+                                    AND store_path_ref.store_hash = store_path.store_hash
+                                )
+                            ; """)
+
+        db_cursor.execute("DROP INDEX IF EXISTS store_path_cache_store_hash")
+        db_cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS store_path_cache_store_hash ON store_path (cache_name, store_hash)")
+
+        db_cursor.execute(""" CREATE TRIGGER IF NOT EXISTS nar_release_update AFTER UPDATE OF file_hash, compression ON store_path
+                            WHEN OLD.file_hash IS NOT NULL AND (OLD.file_hash IS NOT NEW.file_hash OR OLD.compression IS NOT NEW.compression)
+                            BEGIN
+                                INSERT OR IGNORE INTO nar_release (cache_name, file_hash, compression) VALUES (OLD.cache_name, OLD.file_hash, COALESCE(OLD.compression, 'xz'));
+                            END; """)
+
+    # execute statements without returning any value, parameters are bound so that SQLite can reuse cached statements
+    def execute_statement(self, statement: str, parameters: tuple = ()) -> None:
         try:
-            with sqlite3.connect(self.database_file) as db_connection:
-                db_cursor = db_connection.cursor()
-                db_cursor.execute(statement)
-                db_connection.commit()
+            with self.pool.connection() as db_connection:
+                with db_connection:
+                    db_connection.execute(statement, parameters)
+        except sqlite3.Error as e:
+            print("ERROR: ", e)
+
+    # execute statement for every parameter tuple in a single transaction
+    def execute_many(self, statement: str, parameters: list[tuple]) -> None:
+        try:
+            with self.pool.connection() as db_connection:
+                with db_connection:
+                    db_connection.executemany(statement, parameters)
         except sqlite3.Error as e:
             print("ERROR: ", e)
 
     # execute SQL selects
-    def execute_select(self, statement: str) -> list:
+    def execute_select(self, statement: str, parameters: tuple = ()) -> list:
         try:
-            with sqlite3.connect(self.database_file) as db_connection:
-                db_cursor = db_connection.cursor()
-                result = db_cursor.execute(statement).fetchall()
-                db_connection.commit()
-            return result
+            with self.pool.connection() as db_connection:
+                return db_connection.execute(statement, parameters).fetchall()
         except sqlite3.Error as e:
             print("ERROR: ", e)
-            
-    def insert_binary_cache(self, id: str, name: str, url: str, token: str, access: str, port: int, retention: int) -> None:
+
+    # execute SQL select for chunks of values bound to the placeholder {} of the statement
+    def execute_select_chunked(self, statement: str, parameters: tuple, values: list) -> list:
+        result = []
+        for i in range(0, len(values), MAX_STATEMENT_VARIABLES):
+            chunk = values[i:i + MAX_STATEMENT_VARIABLES]
+            chunk_statement = statement.format(', '.join('?' * len(chunk)))
+            result.extend(self.execute_select(chunk_statement, (*parameters, *chunk)) or [])
+        return result
+
+    def insert_binary_cache(self, id: str, name: str, url: str, token: str, access: str, port: int, retention: int, max_size: int) -> None:
         statement = """
-            INSERT INTO binary_cache (id, name, url, token, access, port, retention)
-            VALUES ('{}', '{}', '{}', '{}', '{}', '{}', '{}')
-            ; """.format(id, name, url, token, access, port, retention)
-        self.execute_statement(statement)
+            INSERT INTO binary_cache (id, name, url, token, access, port, retention, max_size)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ; """
+        self.execute_statement(statement, (str(id), name, url, token, access, port, retention, max_size))
 
     def delete_binary_cache(self, name: str) -> None:
         statement = """
             DELETE FROM binary_cache
-            WHERE name='{}'
-            ; """.format(name)
-        self.execute_statement(statement)
+            WHERE name=?
+            ; """
+        self.execute_statement(statement, (name,))
 
     def delete_all_cache_paths(self, name: str) -> None:
         statement = """
             DELETE FROM store_path
-            WHERE cache_name='{}'
-        ; """.format(name)
-        self.execute_statement(statement)
+            WHERE cache_name=?
+        ; """
+        self.execute_statement(statement, (name,))
 
-    def update_binary_cache(self, id: str, name: str, url: str, token: str, access: str, port: int, retention: int) -> None:
+    def update_binary_cache(self, id: str, name: str, url: str, token: str, access: str, port: int, retention: int, max_size: int) -> None:
         statement = """
             UPDATE binary_cache
-            SET name='{}', url='{}', token='{}', access='{}', port='{}', retention='{}'
-            WHERE id='{}'
-            ; """.format(name, url, token, access,port, retention, id)
-        self.execute_statement(statement)
+            SET name=?, url=?, token=?, access=?, port=?, retention=?, max_size=?
+            WHERE id=?
+            ; """
+        self.execute_statement(statement, (name, url, token, access, port, retention, max_size, str(id)))
 
     def get_binary_cache_row(self, name: str) -> list | None:
         statement = """
             SELECT * FROM binary_cache
-            WHERE name='{}'
-            ; """.format(name)
-        db_result = self.execute_select(statement)
+            WHERE name=?
+            ; """
+        db_result = self.execute_select(statement, (name,))
         
         if not db_result:
             return None
@@ -147,9 +613,9 @@ class CacheServerDatabase():
     def get_binary_cache_row_by_port(self, port: int) -> list | None:
         statement = """
             SELECT * FROM binary_cache
-            WHERE port='{}'
-            ; """.format(port)
-        db_result = self.execute_select(statement)
+            WHERE port=?
+            ; """
+        db_result = self.execute_select(statement, (port,))
         
         if not db_result:
             return None
@@ -179,30 +645,39 @@ class CacheServerDatabase():
     def get_cache_store_paths(self, cache_name: str) -> list:
         statement = """
             SELECT * FROM store_path
-            WHERE cache_name='{}'
-            ; """.format(cache_name)
-        return self.execute_select(statement)
+            WHERE cache_name=?
+            ; """
+        return self.execute_select(statement, (cache_name,))
+
+    # return the subset of store_hashes present in the cache, queried in chunks using the (cache_name, store_hash) index
+    def get_existing_store_hashes(self, cache_name: str, store_hashes: list[str]) -> set[str]:
+        statement = """
+            SELECT store_hash FROM store_path
+            WHERE cache_name=?
+            AND store_hash IN ({})
+            ; """
+        return set(row[0] for row in self.execute_select_chunked(statement, (cache_name,), store_hashes))
 
     def insert_agent(self, agent_id: str, name: str, token: str, workspace_name: str) -> None:
         statement = """
             INSERT INTO agent (id, name, token, workspace_name)
-            VALUES ('{}', '{}', '{}', '{}')
-            ; """.format(agent_id, name, token, workspace_name)
-        self.execute_statement(statement)
+            VALUES (?, ?, ?, ?)
+            ; """
+        self.execute_statement(statement, (str(agent_id), name, token, workspace_name))
 
     def delete_agent(self, name: str) -> None:
         statement = """
             DELETE FROM agent
-            WHERE name='{}'
-            ; """.format(name)
-        self.execute_statement(statement)
+            WHERE name=?
+            ; """
+        self.execute_statement(statement, (name,))
 
     def get_agent_row(self, name: str) -> list | None:
         statement = """
             SELECT * FROM agent
-            WHERE name='{}'
-            ; """.format(name)
-        db_result = self.execute_select(statement)
+            WHERE name=?
+            ; """
+        db_result = self.execute_select(statement, (name,))
         
         if not db_result:
             return None
@@ -212,31 +687,39 @@ class CacheServerDatabase():
     def get_workspace_agents(self, workspace_name: str) -> list[str]:
         statement = """
             SELECT * FROM agent
-            WHERE workspace_name='{}'
-            ; """.format(workspace_name)
-        return self.execute_select(statement)
+            WHERE workspace_name=?
+            ; """
+        return self.execute_select(statement, (workspace_name,))
     
     def get_store_path_row(self, cache_name: str, store_hash: str = '', file_hash: str = '') -> list | None:
         if store_hash:
             statement = """
                 SELECT * FROM store_path
-                WHERE store_hash='{}'
-                AND cache_name='{}'
-                ; """.format(store_hash, cache_name)
+                WHERE store_hash=?
+                AND cache_name=?
+                ; """
+            db_result = self.execute_select(statement, (store_hash, cache_name))
         else:
             statement = """
                 SELECT * FROM store_path
-                WHERE file_hash='{}'
-                AND cache_name='{}'
-                ; """.format(file_hash, cache_name)
-            
-        db_result = self.execute_select(statement)
+                WHERE file_hash=?
+                AND cache_name=?
+                ; """
+            db_result = self.execute_select(statement, (file_hash, cache_name))
         
         if not db_result:
             return None
         
         return db_result[0]
-    
+
+    def get_store_path_rows(self, cache_name: str, store_hashes: list[str]) -> list:
+        statement = """
+            SELECT * FROM store_path
+            WHERE cache_name=?
+            AND store_hash IN ({})
+            ; """
+        return self.execute_select_chunked(statement, (cache_name,), store_hashes)
+
     def insert_store_path(self,
                           id: str,
                           store_hash: str,
@@ -247,43 +730,86 @@ class CacheServerDatabase():
                           nar_size: int,
                           deriver: str,
                           references: list[str],
-                          cache_name: str) -> None:
-        statement = """
+                          cache_name: str,
+                          signature: str,
+                          compression: str) -> None:
+        self.insert_store_paths([(id, store_hash, store_suffix, file_hash, file_size, nar_hash,
+                                  nar_size, deriver, references, cache_name, signature, compression)])
+
+    # insert store paths in a single transaction, rows are in the order of insert_store_path arguments,
+    # a store path pushed again is updated in place and keeps its id and number of downloads
+    def insert_store_paths(self, rows: list[tuple]) -> None:
+        # no upsert, its conflict clause would override the conflict handling of statements in triggers
+        update_statement = """
+            UPDATE store_path
+            SET store_suffix=?, file_hash=?, file_size=?, nar_hash=?, nar_size=?, deriver=?, refs=?, signature=?, compression=?,
+            created_at=CAST(strftime('%s', 'now') AS INT), last_access=MAX(last_access, CAST(strftime('%s', 'now') AS INT))
+            WHERE store_hash=?
+            AND cache_name=?
+            ; """
+        insert_statement = """
             INSERT INTO store_path (id, store_hash, store_suffix, file_hash, file_size, nar_hash,
-            nar_size, deriver, refs, cache_name)
-            VALUES ('{}', '{}', '{}', '{}', '{}', '{}', '{}', '{}', '{}', '{}')
-            ; """.format(id, store_hash, store_suffix, file_hash, file_size, nar_hash,
-                         nar_size, deriver, references, cache_name)
-        self.execute_statement(statement)
+            nar_size, deriver, refs, cache_name, signature, compression, created_at, last_access)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CAST(strftime('%s', 'now') AS INT), CAST(strftime('%s', 'now') AS INT))
+            ; """
+        try:
+            with self.pool.connection() as db_connection:
+                with db_connection:
+                    db_connection.execute("BEGIN IMMEDIATE")
+                    for id, store_hash, store_suffix, file_hash, file_size, nar_hash, nar_size, deriver, refs, cache_name, signature, compression in rows:
+                        cursor = db_connection.execute(update_statement, (store_suffix, file_hash, file_size, nar_hash, nar_size, deriver,
+                                                                          refs, signature, compression, store_hash, cache_name))
+                        if cursor.rowcount == 0:
+                            db_connection.execute(insert_statement, (str(id), store_hash, store_suffix, file_hash, file_size, nar_hash,
+                                                                     nar_size, deriver, refs, cache_name, signature, compression))
+        except sqlite3.Error as e:
+            print("ERROR: ", e)
+
+    def update_store_path_signature(self, store_hash: str, cache_name: str, signature: str) -> None:
+        self.update_store_path_signatures(cache_name, [(store_hash, signature)])
+
+    # update signatures of (store_hash, signature) pairs in a single transaction
+    def update_store_path_signatures(self, cache_name: str, signatures: list[tuple]) -> None:
+        statement = """
+            UPDATE store_path
+            SET signature=?
+            WHERE store_hash=?
+            AND cache_name=?
+            ; """
+        self.execute_many(statement, [(signature, store_hash, cache_name) for store_hash, signature in signatures])
 
     def delete_store_path(self, store_hash: str, cache_name: str) -> None:
+        self.delete_store_paths(cache_name, [store_hash])
+
+    # delete store paths of the cache in a single transaction
+    def delete_store_paths(self, cache_name: str, store_hashes: list[str]) -> None:
         statement = """
             DELETE FROM store_path
-            WHERE store_hash='{}'
-            AND cache_name='{}'
-            ; """.format(store_hash, cache_name)
-        self.execute_statement(statement)
+            WHERE store_hash=?
+            AND cache_name=?
+            ; """
+        self.execute_many(statement, [(store_hash, cache_name) for store_hash in store_hashes])
 
     def insert_workspace(self, workspace_id: str, name: str, token: str, cache_name: str) -> None:
         statement = """
             INSERT INTO workspace (id, name, token, cache_name)
-            VALUES ('{}', '{}', '{}', '{}')
-            ; """.format(workspace_id, name, token, cache_name)
-        self.execute_statement(statement)
+            VALUES (?, ?, ?, ?)
+            ; """
+        self.execute_statement(statement, (str(workspace_id), name, token, cache_name))
 
     def delete_workspace(self, name: str) -> None:
         statement = """
             DELETE FROM workspace
-            WHERE name='{}'
-            ; """.format(name)
-        self.execute_statement(statement)
+            WHERE name=?
+            ; """
+        self.execute_statement(statement, (name,))
 
     def get_workspace_row(self, name: str) -> list | None:
         statement = """
             SELECT * FROM workspace
-            WHERE name='{}'
-            ; """.format(name)
-        db_result = self.execute_select(statement)
+            WHERE name=?
+            ; """
+        db_result = self.execute_select(statement, (name,))
         
         if not db_result:
             return None
@@ -293,9 +819,9 @@ class CacheServerDatabase():
     def get_workspace_row_by_token(self, token: str) -> list | None:
         statement = """
             SELECT * FROM workspace
-            WHERE token='{}'
-            ; """.format(token)
-        db_result = self.execute_select(statement)
+            WHERE token=?
+            ; """
+        db_result = self.execute_select(statement, (token,))
         
         if not db_result:
             return None
@@ -305,9 +831,9 @@ class CacheServerDatabase():
     def delete_all_workspace_agents(self, workspace_name: str) -> None:
         statement = """
             DELETE FROM agent
-            WHERE workspace_name='{}'
-        ; """.format(workspace_name)
-        self.execute_statement(statement)
+            WHERE workspace_name=?
+        ; """
+        self.execute_statement(statement, (workspace_name,))
 
     def get_workspace_list(self) -> list[str]:
         statement = """
@@ -318,24 +844,323 @@ class CacheServerDatabase():
     def update_workspace(self, id: str, name: str, token: str, cache_name: str) -> None:
         statement = """
             UPDATE workspace
-            SET name='{}', token='{}', cache_name='{}'
-            WHERE id='{}'
-            ; """.format(name, token, cache_name, id)
-        self.execute_statement(statement)
+            SET name=?, token=?, cache_name=?
+            WHERE id=?
+            ; """
+        self.execute_statement(statement, (name, token, cache_name, str(id)))
 
     def update_cache_in_workspaces(self, cache_name: str, new_name: str) -> None:
         statement = """
             UPDATE workspace
-            SET cache_name='{}'
-            WHERE cache_name='{}'
-            ; """.format(new_name, cache_name)
-        self.execute_statement(statement)
+            SET cache_name=?
+            WHERE cache_name=?
+            ; """
+        self.execute_statement(statement, (new_name, cache_name))
+
+    # store hashes of binary cache, None when they could not be read
+    def get_store_hashes(self, cache_name: str) -> list | None:
+        statement = """
+            SELECT store_hash FROM store_path
+            WHERE cache_name=?
+            ; """
+        rows = self.execute_select(statement, (cache_name,))
+        return None if rows is None else [row[0] for row in rows]
+
+    # return (lowest, highest) id of the logged store path changes, None when the log could not be read
+    def get_store_path_change_range(self) -> tuple | None:
+        statement = """
+            SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) FROM store_path_change
+            ; """
+        rows = self.execute_select(statement)
+        return tuple(rows[0]) if rows else None
+
+    def get_store_path_changes(self, after_id: int) -> list:
+        statement = """
+            SELECT id, cache_name, store_hash, deleted FROM store_path_change
+            WHERE id > ?
+            ORDER BY id
+            ; """
+        return self.execute_select(statement, (after_id,)) or []
+
+    # number of store paths of all binary caches referencing the NAR file
+    def get_nar_file_refcount(self, file_hash: str, compression: str) -> int:
+        statement = """
+            SELECT refcount FROM nar_file
+            WHERE file_hash=?
+            AND compression=?
+            ; """
+        db_result = self.execute_select(statement, (file_hash, compression))
+        return db_result[0][0] if db_result else 0
+
+    # (file_hash, compression) of NAR files no longer referenced by any store path, whose files were not removed yet
+    def get_released_nar_files(self) -> list:
+        statement = """
+            SELECT file_hash, compression FROM nar_file
+            WHERE refcount <= 0
+            ; """
+        return self.execute_select(statement) or []
+
+    # (file_hash, compression) of NAR files of deleted store paths of binary cache, which were not released yet
+    def get_nar_releases(self, cache_name: str) -> list:
+        statement = """
+            SELECT file_hash, compression FROM nar_release
+            WHERE cache_name=?
+            ; """
+        return self.execute_select(statement, (cache_name,)) or []
+
+    def delete_nar_release(self, cache_name: str, file_hash: str, compression: str) -> None:
+        statement = """
+            DELETE FROM nar_release
+            WHERE cache_name=?
+            AND file_hash=?
+            AND compression=?
+            ; """
+        self.execute_statement(statement, (cache_name, file_hash, compression))
+
+    # forget NAR file after its file was removed, unless a store path referenced it again meanwhile
+    def delete_released_nar_file(self, file_hash: str, compression: str) -> None:
+        statement = """
+            DELETE FROM nar_file
+            WHERE file_hash=?
+            AND compression=?
+            AND refcount <= 0
+            ; """
+        self.execute_statement(statement, (file_hash, compression))
+
+    # total number of NAR downloads of store paths of binary cache
+    def get_cache_download_count(self, cache_name: str) -> int:
+        statement = """
+            SELECT SUM(download_count) FROM store_path
+            WHERE cache_name=?
+            ; """
+        db_result = self.execute_select(statement, (cache_name,))
+        return (db_result[0][0] or 0) if db_result else 0
+
+    # total size of NAR files of store paths of binary cache
+    def get_cache_size(self, cache_name: str) -> int:
+        statement = """
+            SELECT size FROM cache_size
+            WHERE cache_name=?
+            ; """
+        db_result = self.execute_select(statement, (cache_name,))
+        return db_result[0][0] if db_result else 0
+
+    # add (last_access, downloads, cache_name, store_hash) accesses of store paths in a single transaction
+    def update_store_path_access(self, accesses: list[tuple]) -> None:
+        statement = """
+            UPDATE store_path
+            SET last_access=MAX(COALESCE(last_access, 0), ?), download_count=download_count + ?
+            WHERE cache_name=?
+            AND store_hash=?
+            ; """
+        self.execute_many(statement, accesses)
+
+    # statement marking store paths of binary cache reachable by references from its pinned roots and from store paths
+    # whose column (created_at/last_access) is at least the timestamp, only roots are marked without column, walks stop
+    # at marked store paths, so marking again adds only closures of store paths pushed or pinned since
+    def get_mark_statement(self, column: str) -> str:
+        survivors = """
+                UNION
+                SELECT store_hash FROM store_path
+                WHERE cache_name=?
+                AND {} >= ?
+            """.format(column) if column else ""
+        return """
+            INSERT OR IGNORE INTO gc_live (cache_name, store_hash)
+            WITH RECURSIVE live(store_hash) AS (
+                SELECT store_hash FROM gc_root
+                WHERE cache_name=?
+                {}
+                UNION
+                SELECT store_path_ref.ref_hash FROM store_path_ref
+                JOIN live ON store_path_ref.store_hash = live.store_hash
+                WHERE store_path_ref.cache_name=?
+                AND NOT EXISTS (SELECT 1 FROM gc_live WHERE gc_live.cache_name = store_path_ref.cache_name AND gc_live.store_hash = store_path_ref.ref_hash)
+            )
+            SELECT ?, store_hash FROM live
+            ; """.format(survivors)
+
+    def get_mark_parameters(self, cache_name: str, column: str, after: int) -> tuple:
+        return (cache_name, *((cache_name, after) if column else ()), cache_name, cache_name)
+
+    def mark_live_store_paths(self, cache_name: str, column: str = '', after: int = 0) -> None:
+        try:
+            with self.pool.connection() as db_connection:
+                with db_connection:
+                    db_connection.execute("DELETE FROM gc_live WHERE cache_name=?", (cache_name,))
+                    db_connection.execute(self.get_mark_statement(column), self.get_mark_parameters(cache_name, column, after))
+        except sqlite3.Error as e:
+            print("ERROR: ", e)
+
+    # delete least recently accessed unmarked store paths no other store path references, one at a time, so that
+    # references of a deleted store path become candidates as soon as their last referrer is deleted, until NAR files
+    # of the deleted store paths add up to the size or limit store paths were deleted, in a single transaction,
+    # closures of roots pinned since the mark are marked first, return (store_hash, file_hash, compression)
+    # of the deleted store paths
+    def delete_least_recently_accessed_store_paths(self, cache_name: str, size: int, limit: int) -> list:
+        select_statement = """
+            SELECT id, store_hash, file_hash, compression, file_size FROM store_path
+            WHERE cache_name=?
+            AND referrers = 0
+            AND NOT EXISTS (SELECT 1 FROM gc_live WHERE gc_live.cache_name = store_path.cache_name AND gc_live.store_hash = store_path.store_hash)
+            ORDER BY last_access
+            LIMIT 1
+            ; """
+        delete_statement = """
+            DELETE FROM store_path
+            WHERE id=?
+            ; """
+        rows = []
+        try:
+            with self.pool.connection() as db_connection:
+                with db_connection:
+                    db_connection.execute("BEGIN IMMEDIATE")
+                    db_connection.execute(self.get_mark_statement(''), self.get_mark_parameters(cache_name, '', 0))
+                    while size > 0 and len(rows) < limit:
+                        row = db_connection.execute(select_statement, (cache_name,)).fetchone()
+                        if not row:
+                            break
+                        db_connection.execute(delete_statement, (row[0],))
+                        rows.append(row)
+                        size -= row[4] or 0
+                return [row[1:4] for row in rows]
+        except sqlite3.Error as e:
+            print("ERROR: ", e)
+            return []
+
+    # delete at most limit unmarked store paths of binary cache whose column (created_at/last_access) is before
+    # the timestamp in a single transaction, closures of roots and store paths pushed since marked_at are marked
+    # first, return (store_hash, file_hash, compression) of the deleted store paths
+    def delete_unmarked_store_paths(self, cache_name: str, column: str, before: int, limit: int, marked_at: int) -> list:
+        select_statement = """
+            SELECT id, store_hash, file_hash, compression FROM store_path
+            WHERE cache_name=?
+            AND {} < ?
+            AND NOT EXISTS (SELECT 1 FROM gc_live WHERE gc_live.cache_name = store_path.cache_name AND gc_live.store_hash = store_path.store_hash)
+            LIMIT ?
+            ; """.format(column)
+        delete_statement = """
+            DELETE FROM store_path
+            WHERE id=?
+            ; """
+        try:
+            with self.pool.connection() as db_connection:
+                with db_connection:
+                    # the select runs inside the write transaction, so the returned rows are exactly the deleted ones
+                    # and no store path pushed meanwhile references them
+                    db_connection.execute("BEGIN IMMEDIATE")
+                    db_connection.execute(self.get_mark_statement(column), self.get_mark_parameters(cache_name, column, marked_at))
+                    rows = db_connection.execute(select_statement, (cache_name, before, limit)).fetchall()
+                    db_connection.executemany(delete_statement, [(row[0],) for row in rows])
+                return [row[1:] for row in rows]
+        except sqlite3.Error as e:
+            print("ERROR: ", e)
+            return []
+
+    # pin store path as garbage collector root of binary cache, a root of the same name is replaced
+    def insert_gc_root(self, cache_name: str, name: str, store_hash: str) -> None:
+        statement = """
+            INSERT OR REPLACE INTO gc_root (cache_name, name, store_hash, created_at)
+            VALUES (?, ?, ?, CAST(strftime('%s', 'now') AS INT))
+            ; """
+        self.execute_statement(statement, (cache_name, name, store_hash))
+
+    def delete_gc_root(self, cache_name: str, name: str) -> None:
+        statement = """
+            DELETE FROM gc_root
+            WHERE cache_name=?
+            AND name=?
+            ; """
+        self.execute_statement(statement, (cache_name, name))
+
+    def get_gc_roots(self, cache_name: str) -> list:
+        statement = """
+            SELECT name, store_hash, created_at FROM gc_root
+            WHERE cache_name=?
+            ORDER BY name
+            ; """
+        return self.execute_select(statement, (cache_name,)) or []
+
+    def delete_cache_gc_roots(self, cache_name: str) -> None:
+        self.execute_statement("DELETE FROM gc_root WHERE cache_name=?", (cache_name,))
+        self.execute_statement("DELETE FROM gc_live WHERE cache_name=?", (cache_name,))
+
+    def update_cache_in_gc_roots(self, cache_name: str, new_name: str) -> None:
+        self.execute_statement("UPDATE gc_root SET cache_name=? WHERE cache_name=?", (new_name, cache_name))
+        self.execute_statement("DELETE FROM gc_live WHERE cache_name=?", (cache_name,))
 
     def update_cache_in_paths(self, cache_name: str, new_name: str) -> None:
         statement = """
             UPDATE store_path
-            SET cache_name='{}'
-            WHERE cache_name='{}'
-            ; """.format(new_name, cache_name)
-        self.execute_statement(statement)
-        
\ No newline at end of file
+            SET cache_name=?
+            WHERE cache_name=?
+            ; """
+        self.execute_statement(statement, (new_name, cache_name))
+
+        # references are moved row by row, referrers counted while only some rows were moved are counted again
+        statement = """
+            UPDATE store_path SET referrers = (
+                SELECT COUNT(*) FROM store_path_ref
+                WHERE store_path_ref.cache_name = store_path.cache_name
+                AND store_path_ref.ref_hash = store_path.store_hash
+            )
+            WHERE cache_name=?
+            ; """
+        self.execute_statement(statement, (new_name,))
+        self.execute_statement("UPDATE nar_release SET cache_name=? WHERE cache_name=?", (new_name, cache_name))
+
+    def insert_nar_upload(self,
+                          id: str,
+                          cache_name: str,
+                          file_hash: str,
+                          file_size: int,
+                          file_name: str,
+                          compression: str,
+                          state: str,
+                          created_at: int) -> None:
+        statement = """
+            INSERT OR REPLACE INTO nar_upload (id, cache_name, file_hash, file_size, file_name, compression, state, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ; """
+        self.execute_statement(statement, (str(id), cache_name, file_hash, file_size, file_name, compression, state, created_at))
+
+    def get_nar_upload_row(self, id: str) -> list | None:
+        statement = """
+            SELECT * FROM nar_upload
+            WHERE id=?
+            ; """
+        db_result = self.execute_select(statement, (str(id),))
+
+        if not db_result:
+            return None
+
+        return db_result[0]
+
+    def delete_nar_upload(self, id: str) -> None:
+        statement = """
+            DELETE FROM nar_upload
+            WHERE id=?
+            ; """
+        self.execute_statement(statement, (str(id),))
+
+    def insert_nar_upload_part(self, upload_id: str, part_number: int, etag: str, file_hash: str, file_size: int) -> None:
+        statement = """
+            INSERT OR REPLACE INTO nar_upload_part (upload_id, part_number, etag, file_hash, file_size)
+            VALUES (?, ?, ?, ?, ?)
+            ; """
+        self.execute_statement(statement, (str(upload_id), part_number, etag, file_hash, file_size))
+
+    def get_nar_upload_part_rows(self, upload_id: str) -> list:
+        statement = """
+            SELECT * FROM nar_upload_part
+            WHERE upload_id=?
+            ORDER BY part_number
+            ; """
+        return self.execute_select(statement, (str(upload_id),)) or []
+
+    def delete_nar_upload_parts(self, upload_id: str) -> None:
+        statement = """
+            DELETE FROM nar_upload_part
+            WHERE upload_id=?
+            ; """
+        self.execute_statement(statement, (str(upload_id),))
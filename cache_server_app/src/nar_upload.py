@@ -0,0 +1,233 @@
+#!/usr/bin/env python3.10
+"""
+nar_upload
+
+Module containing the NarUpload class.
+
+Date: 18.10.2026
+"""
+
+import os
+import time
+import uuid
+import shutil
+import hashlib
+from cache_server_app.src.database import CacheServerDatabase
+from cache_server_app.src.binary_cache import BinaryCache
+
+# size of chunks in which uploaded NAR files are read and written
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# alphabet of the base32 encoding used by Nix
+NIX_BASE32_ALPHABET = '0123456789abcdfghijklmnpqrsvwxyz'
+
+# pairs of characters of the Nix alphabet by the 10 bits they encode
+NIX_BASE32_PAIRS = [first + second for first in NIX_BASE32_ALPHABET for second in NIX_BASE32_ALPHABET]
+
+# the digest read as a little-endian number, written in base 32 from the most significant digit,
+# two digits at a time
+def nix_base32(digest: bytes) -> str:
+    length = (len(digest) * 8 - 1) // 5 + 1
+    value = int.from_bytes(digest, 'little')
+    pairs = ''.join([NIX_BASE32_PAIRS[(value >> shift) & 0x3ff] for shift in range(5 * (length - length % 2 - 2), -1, -10)])
+    return NIX_BASE32_ALPHABET[value >> (5 * (length - 1))] + pairs if length % 2 else pairs
+
+NIX_BASE32_CHARS = frozenset(NIX_BASE32_ALPHABET)
+
+# digits of int() in base 32 in the order of the Nix alphabet
+NIX_BASE32_DIGITS = str.maketrans(NIX_BASE32_ALPHABET, '0123456789abcdefghijklmnopqrstuv')
+
+# inverse of nix_base32, None when the text is not an encoded digest
+def nix_base32_decode(text: str) -> bytes | None:
+    size = len(text) * 5 // 8
+    if not size or (size * 8 - 1) // 5 + 1 != len(text) or not NIX_BASE32_CHARS.issuperset(text):
+        return None
+
+    value = int(text.translate(NIX_BASE32_DIGITS), 32)
+    if value >> (size * 8):
+        return None
+    return value.to_bytes(size, 'little')
+
+# copy count bytes (or everything when count is None) in fixed-size chunks, updating hashes on the way
+def copy_stream(source, destination, count: int | None, hashes: list) -> int:
+    copied = 0
+    while count is None or copied < count:
+        chunk = source.read(UPLOAD_CHUNK_SIZE if count is None else min(UPLOAD_CHUNK_SIZE, count - copied))
+        if not chunk:
+            break
+        for file_hash in hashes:
+            file_hash.update(chunk)
+        destination.write(chunk)
+        copied += len(chunk)
+    return copied
+
+class NarUpload():
+    """
+    Class to represent upload session of a NAR file to binary cache.
+
+    The session is created by multipart-nar, the NAR file is then uploaded
+    either with a single PUT request or in parts, which are stored separately
+    until the upload is completed.
+
+    Attributes:
+        database: object to handle database connection
+        id: upload id (narId handed out by multipart-nar)
+        cache: binary cache to which the NAR file is uploaded
+        file_hash: hex encoded SHA-256 hash of the uploaded file
+        file_size: size of the uploaded file
+        file_name: name of the upload file in the binary cache directory
+        compression: compression of the NAR file ('xz'/'zst')
+        state: upload state ('created'/'uploaded')
+        created_at: time when the session was created
+    """
+
+    def __init__(self,
+                 id: str,
+                 cache: BinaryCache,
+                 file_hash: str,
+                 file_size: int,
+                 file_name: str,
+                 compression: str,
+                 state: str,
+                 created_at: int
+                ):
+        self.database = CacheServerDatabase()
+        self.id = id
+        self.cache = cache
+        self.file_hash = file_hash
+        self.file_size = file_size
+        self.file_name = file_name
+        self.compression = compression
+        self.state = state
+        self.created_at = created_at
+
+    @staticmethod
+    def get(id: str):
+        row = CacheServerDatabase().get_nar_upload_row(id)
+        if not row:
+            return None
+        return NarUpload(row[0], BinaryCache.get(row[1]), row[2], row[3], row[4], row[5], row[6], row[7])
+
+    # create session and the empty file the NAR is uploaded to
+    @staticmethod
+    def create(cache: BinaryCache, compression: str):
+        id = str(uuid.uuid4())
+        upload = NarUpload(id, cache, '', 0, '{}.nar.{}'.format(id, compression), compression, 'created', int(time.time()))
+        with open(upload.get_file(), 'w'):
+            pass
+        upload.save()
+        return upload
+
+    def get_file(self) -> str:
+        return os.path.join(self.cache.cache_dir, self.file_name)
+
+    # write count bytes of stream to the upload file, hashing them on the way
+    def receive(self, stream, count: int) -> bool:
+        file_hash = hashlib.sha256()
+        with open(self.get_file(), 'wb') as file:
+            if copy_stream(stream, file, count, [file_hash]) != count:
+                return False
+
+        self.file_hash = file_hash.hexdigest()
+        self.file_size = count
+        self.state = 'uploaded'
+        self.save()
+        return True
+
+    def get_parts_dir(self) -> str:
+        return os.path.join(self.cache.cache_dir, 'parts', str(self.id))
+
+    # store one part of a multipart upload and return its entity tag, parts may arrive
+    # concurrently and in any order, a retried part replaces the previous attempt atomically
+    def receive_part(self, part_number: int, stream, count: int) -> str | None:
+        while True:
+            try:
+                os.makedirs(self.get_parts_dir(), exist_ok=True)
+                break
+            except FileNotFoundError:
+                # the empty parts directory was removed by another finished upload meanwhile
+                continue
+        part_file = os.path.join(self.get_parts_dir(), str(part_number))
+        tmp_file = '{}.{}.tmp'.format(part_file, uuid.uuid4().hex)
+
+        etag = hashlib.md5()
+        file_hash = hashlib.sha256()
+        with open(tmp_file, 'wb') as file:
+            received = copy_stream(stream, file, count, [etag, file_hash])
+
+        if received != count:
+            os.remove(tmp_file)
+            return None
+
+        os.replace(tmp_file, part_file)
+        self.database.insert_nar_upload_part(self.id, part_number, etag.hexdigest(), file_hash.hexdigest(), count)
+        return etag.hexdigest()
+
+    def has_parts(self) -> bool:
+        return len(self.database.get_nar_upload_part_rows(self.id)) > 0
+
+    # concatenate the completed parts into the upload file in ascending part number order,
+    # parts are streamed so memory usage does not depend on the NAR size
+    def assemble(self, parts: list[dict]) -> bool:
+        rows = {row[1]: row for row in self.database.get_nar_upload_part_rows(self.id)}
+        parts = sorted(parts, key=lambda part: int(part['partNumber']))
+        for part in parts:
+            row = rows.get(int(part['partNumber']))
+            if not row or row[2] != part['eTag'].strip('"'):
+                return False
+
+        # a single part already is the whole file
+        if len(parts) == 1:
+            row = rows[int(parts[0]['partNumber'])]
+            os.replace(os.path.join(self.get_parts_dir(), str(row[1])), self.get_file())
+            self.file_hash = row[3]
+            self.file_size = int(row[4])
+        else:
+            file_hash = hashlib.sha256()
+            self.file_size = 0
+            with open(self.get_file(), 'wb') as file:
+                for part in parts:
+                    with open(os.path.join(self.get_parts_dir(), str(int(part['partNumber']))), 'rb') as part_file:
+                        self.file_size += copy_stream(part_file, file, None, [file_hash])
+            self.file_hash = file_hash.hexdigest()
+
+        self.state = 'uploaded'
+        self.remove_parts()
+        self.save()
+        return True
+
+    def remove_parts(self) -> None:
+        shutil.rmtree(self.get_parts_dir(), ignore_errors=True)
+        # the parts directory is kept only while some upload has parts in it
+        try:
+            os.rmdir(os.path.dirname(self.get_parts_dir()))
+        except OSError:
+            pass
+        self.database.delete_nar_upload_parts(self.id)
+
+    # client reported file hash may be base16 or Nix base32 encoded
+    def matches(self, file_hash: str, file_size: int) -> bool:
+        if self.state != 'uploaded':
+            return False
+
+        file_hash = file_hash.split(':')[-1]
+        digest = bytes.fromhex(self.file_hash)
+        return int(file_size) == self.file_size and file_hash in (self.file_hash, nix_base32(digest))
+
+    def save(self) -> None:
+        self.database.insert_nar_upload(self.id,
+                                        self.cache.name,
+                                        self.file_hash,
+                                        self.file_size,
+                                        self.file_name,
+                                        self.compression,
+                                        self.state,
+                                        self.created_at
+                                        )
+
+    # remove the session together with its upload file and parts
+    def delete(self) -> None:
+        self.remove_parts()
+        if os.path.exists(self.get_file()):
+            os.remove(self.get_file())
+        self.database.delete_nar_upload(self.id)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3.10
+"""
+narinfo_cache
+
+Module containing the in-process cache of rendered narinfo responses.
+
+Date: 18.10.2026
+"""
+
+import time
+import threading
+import cache_server_app.src.config as config
+from collections import OrderedDict
+from cache_server_app.src.store_path_changes import StorePathChangeLog
+
+class NarinfoCache():
+    """
+    Class to cache rendered narinfo responses in least recently used order.
+
+    Entries are invalidated by the store path and binary cache methods which
+    change them. Store paths pushed, re-signed or deleted by other processes
+    are read from the store path change log at most once per refresh interval.
+
+    Attributes:
+        max_size: maximum number of cached narinfos
+        ttl: number of seconds after which a cached narinfo expires
+        refresh_interval: number of seconds between reads of the store path change log
+        entries: cached narinfos keyed by (cache name, store hash)
+        lock: lock guarding entries and counters
+        changes: reader of the store path change log
+        changes_lock: lock held while the change log is read
+        refreshed: monotonic time of the last read of the change log
+        hits: number of lookups answered from the cache
+        misses: number of lookups not found in the cache
+    """
+
+    def __init__(self, max_size: int, ttl: int, refresh_interval: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.changes = StorePathChangeLog()
+        self.changes_lock = threading.Lock()
+        self.refreshed = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+
+    # drop narinfos of store paths changed by any process, once the refresh interval elapsed
+    def refresh(self) -> None:
+        if time.monotonic() - self.refreshed < self.refresh_interval or not self.changes_lock.acquire(blocking=False):
+            return
+
+        try:
+            self.refreshed = time.monotonic()
+            changes = self.changes.read()
+            with self.lock:
+                if changes is None:
+                    # unread changes were pruned, any narinfo may be outdated
+                    self.entries.clear()
+                    return
+
+                for change_id, cache_name, store_hash, deleted in changes:
+                    self.entries.pop((cache_name, store_hash), None)
+        finally:
+            self.changes_lock.release()
+
+    def get(self, cache_name: str, store_hash: str) -> bytes | None:
+        if self.max_size > 0:
+            self.refresh()
+
+        key = (cache_name, store_hash)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            if entry:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, cache_name: str, store_hash: str, narinfo: bytes) -> None:
+        if self.max_size <= 0:
+            return
+
+        key = (cache_name, store_hash)
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, narinfo)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, cache_name: str, store_hash: str) -> None:
+        with self.lock:
+            self.entries.pop((cache_name, store_hash), None)
+
+    # drop all narinfos of a binary cache (rename, key change, deletion)
+    def invalidate_cache(self, cache_name: str) -> None:
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == cache_name]:
+                del self.entries[key]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'narinfo_cache_hits': self.hits,
+                'narinfo_cache_misses': self.misses,
+                'narinfo_cache_entries': len(self.entries)
+            }
+
+narinfo_cache = NarinfoCache(config.narinfo_cache_size, config.narinfo_cache_ttl, config.narinfo_cache_refresh_interval)
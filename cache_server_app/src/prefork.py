@@ -0,0 +1,100 @@
+#!/usr/bin/env python3.10
+"""
+prefork
+
+Module containing supervisor running HTTP servers in pre-forked worker processes.
+
+Date: 18.10.2026
+"""
+
+import os
+import sys
+import time
+import signal
+import threading
+import traceback
+
+class PreforkSupervisor():
+    """
+    Class to run a server in several forked worker processes.
+
+    Every worker binds its own listening socket with SO_REUSEPORT, so the
+    kernel spreads incoming connections between them. Crashed workers are
+    started again, SIGTERM is passed to all workers, which finish the
+    requests in progress before exiting.
+
+    Attributes:
+        workers: number of worker processes
+        serve: function run in worker process, receives index of the worker
+        children: dictionary of worker index by pid
+        started: dictionary of worker start time by index
+        stopping: True after SIGTERM was received
+    """
+
+    # workers exiting sooner after start are restarted with a delay
+    RESTART_DELAY = 1.0
+
+    def __init__(self, workers: int, serve):
+        self.workers = workers
+        self.serve = serve
+        self.children = {}
+        self.started = {}
+        self.stopping = False
+
+    def spawn(self, index: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            code = 0
+            try:
+                self.serve(index)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+
+        self.children[pid] = index
+        self.started[index] = time.monotonic()
+
+    def stop(self, signum, frame) -> None:
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for index in range(self.workers):
+            self.spawn(index)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            index = self.children.pop(pid, None)
+            if index is None or self.stopping:
+                continue
+
+            print("Worker %d (pid %d) exited with status %d, restarting." % (index, pid, os.waitstatus_to_exitcode(status)))
+            if time.monotonic() - self.started[index] < self.RESTART_DELAY:
+                time.sleep(self.RESTART_DELAY)
+            if not self.stopping:
+                self.spawn(index)
+
+# serve until SIGTERM, then stop accepting connections and finish the accepted ones
+def serve_until_terminated(server) -> None:
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3.10
+"""
+storage
+
+Module containing the NarStorage class.
+
+Date: 18.10.2026
+"""
+
+import os
+import glob
+import cache_server_app.src.config as config
+from cache_server_app.src.database import CacheServerDatabase
+
+# directory of NAR files shared by all binary caches, not a valid binary cache name
+SHARED_DIR = '.nar'
+
+class NarStorage():
+    """
+    Class to map NAR files of binary cache to paths on disk.
+
+    NAR files are stored once for all binary caches in the shared store
+    <cache-dir>/.nar/ab/cd/<file_hash>.nar.<compression>, the nar_file table
+    counts store paths of all binary caches referencing each of them and
+    the file is removed when the last of them is deleted.
+
+    Binary caches created before keep their own copies in the fan-out layout
+    <cache_dir>/ab/cd/<file_hash>.nar.<compression> or the older flat layout
+    <cache_dir>/<file_hash>.nar.<compression> until they are deduplicated,
+    all locations are served in the meantime.
+
+    Attributes:
+        cache_name: name of the binary cache
+        cache_dir: directory where cache stores its own NAR files
+        shared_dir: directory of the shared store
+        database: object to handle database connection
+    """
+
+    def __init__(self, cache_name: str):
+        self.cache_name = cache_name
+        self.cache_dir = os.path.join(config.cache_dir, cache_name)
+        self.shared_dir = os.path.join(config.cache_dir, SHARED_DIR)
+        self.database = CacheServerDatabase()
+
+    def get_shared_nar_file(self, file_hash: str, compression: str) -> str:
+        return os.path.join(self.shared_dir, file_hash[0:2], file_hash[2:4], '{}.nar.{}'.format(file_hash, compression))
+
+    def get_nar_file(self, file_hash: str, compression: str) -> str:
+        return os.path.join(self.cache_dir, file_hash[0:2], file_hash[2:4], '{}.nar.{}'.format(file_hash, compression))
+
+    def get_flat_nar_file(self, file_hash: str, compression: str) -> str:
+        return os.path.join(self.cache_dir, '{}.nar.{}'.format(file_hash, compression))
+
+    # return path of existing NAR file, files only move towards the shared store,
+    # so the locations are checked again backwards in case the file moved between the checks
+    def locate(self, file_hash: str, compression: str) -> str | None:
+        for nar_file in (self.get_shared_nar_file(file_hash, compression),
+                         self.get_nar_file(file_hash, compression),
+                         self.get_flat_nar_file(file_hash, compression),
+                         self.get_nar_file(file_hash, compression),
+                         self.get_shared_nar_file(file_hash, compression)):
+            if os.path.exists(nar_file):
+                return nar_file
+        return None
+
+    # move verified uploaded file to the shared store, a file with the same hash has the same content
+    def store(self, file: str, file_hash: str, compression: str) -> str:
+        nar_file = self.get_shared_nar_file(file_hash, compression)
+        os.makedirs(os.path.dirname(nar_file), exist_ok=True)
+        os.replace(file, nar_file)
+        return nar_file
+
+    # remove NAR files no longer referenced after store paths were deleted from the database,
+    # return number of bytes freed
+    def release(self, file_hash: str, compression: str) -> int:
+        freed = 0
+        if not self.database.get_store_path_row(self.cache_name, file_hash=file_hash):
+            for nar_file in (self.get_nar_file(file_hash, compression), self.get_flat_nar_file(file_hash, compression)):
+                try:
+                    size = os.path.getsize(nar_file)
+                    os.remove(nar_file)
+                    freed += size
+                except FileNotFoundError:
+                    pass
+
+        freed += self.release_shared(file_hash, compression)
+        self.database.delete_nar_release(self.cache_name, file_hash, compression)
+        return freed
+
+    def release_shared(self, file_hash: str, compression: str) -> int:
+        if self.database.get_nar_file_refcount(file_hash, compression) > 0:
+            return 0
+
+        # the file is put aside first, an upload of the same file referencing it
+        # again meanwhile gets it back, unless it already stored its own copy
+        nar_file = self.get_shared_nar_file(file_hash, compression)
+        released_file = '{}.{}.released'.format(nar_file, os.getpid())
+        try:
+            os.rename(nar_file, released_file)
+        except FileNotFoundError:
+            # files put aside by a release interrupted before removing them
+            freed = 0
+            for released_file in glob.glob(glob.escape(nar_file) + '.*.released'):
+                freed += os.path.getsize(released_file)
+                os.remove(released_file)
+            self.database.delete_released_nar_file(file_hash, compression)
+            return freed
+
+        if self.database.get_nar_file_refcount(file_hash, compression) > 0 and not os.path.exists(nar_file):
+            os.rename(released_file, nar_file)
+            return 0
+
+        size = os.path.getsize(released_file)
+        os.remove(released_file)
+        self.database.delete_released_nar_file(file_hash, compression)
+        return size
+
+    # finish releases interrupted after store paths were deleted from the database, own copies of the binary cache
+    # are found by the NAR files recorded on deletion, shared ones by their reference count,
+    # return number of bytes freed
+    def release_unreferenced(self) -> int:
+        freed = sum(self.release(file_hash, compression) for file_hash, compression in self.database.get_nar_releases(self.cache_name))
+        return freed + sum(self.release_shared(file_hash, compression) for file_hash, compression in self.database.get_released_nar_files())
+
+    # move NAR file from the flat layout to the fan-out layout, the rename is atomic
+    # so the file stays available to running binary caches
+    def migrate(self, file_hash: str, compression: str) -> bool:
+        flat_nar_file = self.get_flat_nar_file(file_hash, compression)
+        if not os.path.exists(flat_nar_file):
+            return False
+
+        nar_file = self.get_nar_file(file_hash, compression)
+        os.makedirs(os.path.dirname(nar_file), exist_ok=True)
+        os.rename(flat_nar_file, nar_file)
+        return True
+
+    # move own copy of a NAR file to the shared store, or remove it when the shared store has it already,
+    # return (whether the file was moved, number of bytes freed)
+    def deduplicate(self, file_hash: str, compression: str) -> tuple[bool, int]:
+        shared_nar_file = self.get_shared_nar_file(file_hash, compression)
+        for nar_file in (self.get_nar_file(file_hash, compression), self.get_flat_nar_file(file_hash, compression)):
+            if not os.path.exists(nar_file):
+                continue
+
+            if not os.path.exists(shared_nar_file):
+                os.makedirs(os.path.dirname(shared_nar_file), exist_ok=True)
+                os.rename(nar_file, shared_nar_file)
+                return True, 0
+
+            # copies of different size are corrupted, left for inspection
+            size = os.path.getsize(nar_file)
+            if size != os.path.getsize(shared_nar_file):
+                return False, 0
+
+            os.remove(nar_file)
+            return False, size
+
+        return False, 0
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3.10
+"""
+store_hash_filter
+
+Module containing the in-process filter of store hashes present in binary caches.
+
+Date: 18.10.2026
+"""
+
+import math
+import hashlib
+import threading
+import cache_server_app.src.config as config
+from cache_server_app.src.database import CacheServerDatabase
+from cache_server_app.src.store_path_changes import StorePathChangeLog
+
+class BloomFilter():
+    """
+    Class of a Bloom filter of strings.
+
+    Attributes:
+        capacity: number of items the filter is sized for
+        size: number of bits
+        hashes: number of bits set for each item
+        bits: bit array
+        count: number of added items
+        removed: number of removed items, which are still reported as present
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        self.removed = 0
+
+    # bit positions of the item by double hashing of one digest
+    def positions(self, item: str) -> list[int]:
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, item: str) -> None:
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(item))
+
+    # expected false positive rate for the added items
+    def error_rate(self) -> float:
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+class StoreHashFilter():
+    """
+    Class to answer lookups of missing store hashes without querying the
+    store_path table.
+
+    Every binary cache gets a Bloom filter of its store hashes, loaded on
+    first lookup without holding the lock of the other filters. Lookups
+    of present store hashes read the filters without locking, before
+    answering a store hash as missing the filters are brought up to date
+    with the store path change log, so store paths pushed through other
+    processes are never reported missing. Filters which could not be
+    loaded report every store hash as present.
+
+    Attributes:
+        error_rate: target false positive rate of the filters, 0 disables them
+        filters: Bloom filters by binary cache name
+        changes: reader of the store path change log
+        lock: lock guarding updates of filters, the change log reader and false_positives
+        building: locks of filters being loaded by binary cache name
+        negatives: number of lookups answered as missing by the filters, updated without locking
+        false_positives: number of store hashes passed by the filters but missing in the database
+    """
+
+    # minimum capacity of a filter, filters are sized for twice the number of store paths they are built from
+    MIN_CAPACITY = 100000
+
+    def __init__(self, error_rate: float):
+        self.error_rate = error_rate
+        self.filters = {}
+        self.changes = StorePathChangeLog()
+        self.lock = threading.Lock()
+        self.building = {}
+        self.negatives = 0
+        self.false_positives = 0
+
+    # build the filter of a binary cache from the database, changes logged later are applied by update
+    def load(self, cache_name: str) -> None:
+        if self.error_rate <= 0:
+            return
+
+        self.build(cache_name)
+
+    # return the filter of a binary cache, None when it could not be loaded
+    def build(self, cache_name: str) -> BloomFilter | None:
+        with self.lock:
+            building = self.building.setdefault(cache_name, threading.Lock())
+
+        # lookups of other binary caches are not blocked by loading the filter
+        with building:
+            bloom_filter = self.filters.get(cache_name)
+            if bloom_filter:
+                return bloom_filter
+
+            database = CacheServerDatabase()
+            change_range = database.get_store_path_change_range()
+            store_hashes = database.get_store_hashes(cache_name)
+            if change_range is None or store_hashes is None:
+                return None
+
+            bloom_filter = BloomFilter(max(2 * len(store_hashes), self.MIN_CAPACITY), self.error_rate)
+            for store_hash in store_hashes:
+                bloom_filter.add(store_hash)
+
+            with self.lock:
+                last_change = change_range[1]
+                if self.changes.last_change < last_change:
+                    self.update()
+
+                # changes logged while loading were read by update without applying them to this filter
+                changes = database.get_store_path_changes(last_change)
+                if changes and changes[0][0] > last_change + 1:
+                    return None
+
+                for change_id, changed_cache_name, store_hash, deleted in changes:
+                    if change_id > self.changes.last_change:
+                        break
+                    if changed_cache_name == cache_name:
+                        self.apply(bloom_filter, store_hash, deleted)
+
+                self.filters[cache_name] = bloom_filter
+                return bloom_filter
+
+    def apply(self, bloom_filter: BloomFilter, store_hash: str, deleted: int) -> None:
+        if deleted:
+            bloom_filter.removed += 1
+        else:
+            bloom_filter.add(store_hash)
+
+    # apply store path changes committed since the last update
+    def update(self) -> None:
+
+        # filters loaded later contain all logged changes
+        changes = self.changes.read(skip=not self.filters)
+        if changes is None:
+            # pruned changes were not applied, filters are loaded again on next lookup
+            self.filters = {}
+            return
+
+        for change_id, cache_name, store_hash, deleted in changes:
+            bloom_filter = self.filters.get(cache_name)
+            if not bloom_filter:
+                continue
+
+            self.apply(bloom_filter, store_hash, deleted)
+
+            # overfilled filters and filters of mostly removed store paths are loaded again
+            if bloom_filter.count > bloom_filter.capacity or bloom_filter.removed > bloom_filter.capacity // 2:
+                del self.filters[cache_name]
+
+    # False only when the store hash is certainly not present in the binary cache
+    def might_contain(self, cache_name: str, store_hash: str) -> bool:
+        if self.error_rate <= 0:
+            return True
+
+        bloom_filter = self.filters.get(cache_name)
+        if bloom_filter and store_hash in bloom_filter:
+            return True
+
+        # reading an unchanged change log costs only PRAGMA data_version
+        with self.lock:
+            self.update()
+            bloom_filter = self.filters.get(cache_name)
+
+        bloom_filter = bloom_filter or self.build(cache_name)
+        if not bloom_filter or store_hash in bloom_filter:
+            return True
+
+        self.negatives += 1
+        return False
+
+    def close(self) -> None:
+        with self.lock:
+            self.changes.close()
+            self.filters = {}
+
+    # record store hash passed by the filter, but not found in the database
+    def false_positive(self) -> None:
+        with self.lock:
+            self.false_positives += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = {
+                'store_hash_filter_negatives': self.negatives,
+                'store_hash_filter_false_positives': self.false_positives
+            }
+            for cache_name, bloom_filter in self.filters.items():
+                stats['store_hash_filter_bytes{{cache="{}"}}'.format(cache_name)] = len(bloom_filter.bits)
+                stats['store_hash_filter_entries{{cache="{}"}}'.format(cache_name)] = bloom_filter.count - bloom_filter.removed
+                stats['store_hash_filter_error_rate{{cache="{}"}}'.format(cache_name)] = round(bloom_filter.error_rate(), 6)
+            return stats
+
+store_hash_filter = StoreHashFilter(config.store_hash_filter_error_rate)
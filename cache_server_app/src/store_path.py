@@ -10,9 +10,9 @@ Date: 1.5.2024
 
 import os
 import base64
-import ed25519
 from cache_server_app.src.database import CacheServerDatabase
 from cache_server_app.src.binary_cache import BinaryCache
+from cache_server_app.src.narinfo_cache import narinfo_cache
 
 class StorePath():
     """
@@ -30,6 +30,10 @@ class StorePath():
         deriver: store path of the deriver
         references: immediate dependencies of the store path
         cache: binary cache in which the store path is stored
+        signature: narinfo signature created with the binary cache key
+        compression: compression of the NAR file ('xz'/'zst')
+        last_access: timestamp of the last request of the store path written to the database
+        download_count: number of NAR downloads written to the database
     """
 
     def __init__(self,
@@ -42,7 +46,11 @@ class StorePath():
                  nar_size: int,
                  deriver: str,
                  references: list[str],
-                 cache: BinaryCache
+                 cache: BinaryCache,
+                 signature: str = '',
+                 compression: str = 'xz',
+                 last_access: int | None = None,
+                 download_count: int = 0
                 ):
         self.id = id
         self.database = CacheServerDatabase()
@@ -55,6 +63,10 @@ class StorePath():
         self.deriver = deriver
         self.references = references
         self.cache = cache
+        self.signature = signature
+        self.compression = compression
+        self.last_access = last_access
+        self.download_count = download_count
 
     @staticmethod
     def get(cache_name: str, store_hash: str = '', file_hash: str = ''):
@@ -67,6 +79,16 @@ class StorePath():
         if not row:
             return None
 
+        return StorePath.from_row(row, BinaryCache.get(row[9]))
+
+    # load store paths of one binary cache by store hashes, unknown hashes are skipped
+    @staticmethod
+    def get_many(cache: BinaryCache, store_hashes: list[str]) -> list:
+        rows = CacheServerDatabase().get_store_path_rows(cache.name, store_hashes)
+        return [StorePath.from_row(row, cache) for row in rows]
+
+    @staticmethod
+    def from_row(row: list, cache: BinaryCache):
         return StorePath(row[0],
                          row[1],
                          row[2],
@@ -76,17 +98,17 @@ class StorePath():
                          row[6],
                          row[7],
                          row[8].split(' '),
-                         BinaryCache.get(row[9])
+                         cache,
+                         row[10] or '',
+                         row[13] or 'xz',
+                         row[12],
+                         row[14]
                          )
     
     def get_narinfo(self) -> str:
-        for fn in os.listdir(self.cache.cache_dir):
-            if self.file_hash in fn:
-                file_name = fn
-
         narinfo_dict = f"""StorePath: /nix/store/{self.store_hash}-{self.store_suffix}
-URL: nar/{self.file_hash}.nar{os.path.splitext(file_name)[1]}
-Compression: {os.path.splitext(file_name)[1][1:]}
+URL: nar/{self.file_hash}.nar.{self.compression}
+Compression: {self.compression}
 FileHash: sha256:{self.file_hash}
 FileSize: {self.file_size}
 NarHash: {self.nar_hash}
@@ -94,7 +116,7 @@ NarSize: {self.nar_size}
 Deriver: {self.deriver}
 System: "x86_64-linux"
 References: {' '.join(self.references)}
-Sig: {self.signature()}
+Sig: {self.signature or self.sign()}
 """
         return narinfo_dict
     
@@ -103,13 +125,12 @@ Sig: {self.signature()}
         output = f"1;/nix/store/{self.store_hash}-{self.store_suffix};{self.nar_hash};{self.nar_size};{refs}".encode('utf-8')
         return output
     
-    def signature(self) -> str:
-        with open(os.path.join(self.cache.cache_dir, 'key.priv'), 'rb') as f:
-            content = f.read().split(b':')
-        
-        prefix = content[0]
+    # signing_key can be passed to avoid reading the key file for every path
+    def sign(self, signing_key: tuple | None = None) -> str:
+        if not signing_key:
+            signing_key = self.cache.get_signing_key()
 
-        sk = ed25519.SigningKey(base64.b64decode(content[1]))
+        prefix, sk = signing_key
         sig = prefix + b':' + base64.b64encode(sk.sign(self.fingerprint()))
         return sig.decode('utf-8')
     
@@ -123,8 +144,21 @@ Sig: {self.signature()}
                                         self.nar_size,
                                         self.deriver,
                                         ' '.join(self.references),
-                                        self.cache.name
+                                        self.cache.name,
+                                        self.signature,
+                                        self.compression
                                         )
+        narinfo_cache.invalidate(self.cache.name, self.store_hash)
+
+    def update_signature(self, signature: str) -> None:
+        self.signature = signature
+        self.database.update_store_path_signature(self.store_hash, self.cache.name, signature)
+        narinfo_cache.invalidate(self.cache.name, self.store_hash)
         
+    # path of the NAR file on disk, None if the file is missing
+    def get_nar_file(self) -> str | None:
+        return self.cache.storage.locate(self.file_hash, self.compression)
+
     def delete(self) -> None:
         self.database.delete_store_path(self.store_hash, self.cache.name)
+        narinfo_cache.invalidate(self.cache.name, self.store_hash)
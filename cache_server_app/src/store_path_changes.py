@@ -0,0 +1,79 @@
+#!/usr/bin/env python3.10
+"""
+store_path_changes
+
+Module containing the reader of store path changes committed by any process.
+
+Date: 18.10.2026
+"""
+
+import os
+import sqlite3
+import cache_server_app.src.config as config
+from cache_server_app.src.database import CacheServerDatabase
+
+class StorePathChangeLog():
+    """
+    Class to read the store_path_change log, which triggers on store_path
+    fill for every insert, removal and change of a store path.
+
+    The log is queried only when PRAGMA data_version of a dedicated
+    connection reports a commit of another connection, so reading an
+    unchanged log does not touch any table. The reader is not thread safe,
+    its users guard it by their own lock.
+
+    Attributes:
+        last_change: id of the last change read
+        data_version: data version of the database seen by the last read
+        connection: connection used only to read the data version
+        pid: process the connection was opened in
+    """
+
+    def __init__(self):
+        self.last_change = 0
+        self.data_version = None
+        self.connection = None
+        self.pid = None
+
+    # return (id, cache name, store hash, deleted) of changes committed since the last read,
+    # None when unread changes were pruned and everything built from the log has to be loaded again,
+    # skip marks all changes read, before loading the state from store_path
+    def read(self, skip: bool = False) -> list | None:
+        # connections inherited from a parent process must not be used
+        if self.pid != os.getpid():
+            self.connection = sqlite3.connect(config.database, check_same_thread=False)
+            self.pid = os.getpid()
+            self.data_version = None
+
+        data_version = self.connection.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self.data_version:
+            return []
+
+        # a commit made after reading the version is read again by the next read
+        database = CacheServerDatabase()
+        change_range = database.get_store_path_change_range()
+        if not change_range:
+            # nothing was read, the next read tries again
+            return []
+
+        self.data_version = data_version
+        first_change, last_change = change_range
+
+        if skip:
+            self.last_change = last_change
+            return []
+
+        if first_change > self.last_change + 1:
+            self.last_change = last_change
+            return None
+
+        changes = database.get_store_path_changes(self.last_change)
+        if changes:
+            self.last_change = changes[-1][0]
+        return changes
+
+    def close(self) -> None:
+        if self.connection and self.pid == os.getpid():
+            self.connection.close()
+        self.connection = None
+        self.pid = None
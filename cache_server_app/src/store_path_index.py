@@ -0,0 +1,243 @@
+#!/usr/bin/env python3.10
+"""
+store_path_index
+
+Module containing the in-memory index of store paths of binary caches.
+
+Date: 18.10.2026
+"""
+
+import sys
+import time
+import uuid
+import base64
+import marshal
+import binascii
+import threading
+import cache_server_app.src.config as config
+from cache_server_app.src.database import CacheServerDatabase
+from cache_server_app.src.binary_cache import BinaryCache
+from cache_server_app.src.store_path import StorePath
+from cache_server_app.src.store_path_changes import StorePathChangeLog
+from cache_server_app.src.narinfo_cache import narinfo_cache
+from cache_server_app.src.nar_upload import nix_base32, nix_base32_decode
+
+# fields of store paths are packed into bytes where they convert back to the same text, other values are kept as they are
+
+def pack_nix_hash(text: str) -> bytes | str:
+    digest = nix_base32_decode(text)
+    return digest if digest is not None else text
+
+def unpack_nix_hash(value: bytes | str) -> str:
+    return nix_base32(value) if isinstance(value, bytes) else value
+
+def pack_uuid(text: str) -> bytes | str:
+    try:
+        value = uuid.UUID(text)
+    except (ValueError, TypeError, AttributeError):
+        return text
+    return value.bytes if str(value) == text else text
+
+def unpack_uuid(value: bytes | str) -> str:
+    return str(uuid.UUID(bytes=value)) if isinstance(value, bytes) else value
+
+def pack_hex(text: str | None) -> bytes | str | None:
+    try:
+        value = bytes.fromhex(text)
+    except (ValueError, TypeError):
+        return text
+    return value if value.hex() == text else text
+
+def unpack_hex(value: bytes | str | None) -> str | None:
+    return value.hex() if isinstance(value, bytes) else value
+
+# sha256:<nix base32 digest>
+def pack_nar_hash(text: str | None) -> bytes | str | None:
+    if text and text.startswith('sha256:') and isinstance(digest := pack_nix_hash(text[7:]), bytes):
+        return digest
+    return text
+
+def unpack_nar_hash(value: bytes | str | None) -> str | None:
+    return 'sha256:' + nix_base32(value) if isinstance(value, bytes) else value
+
+# <key name>:<base64 signature>
+def pack_signature(text: str) -> tuple | str:
+    name, _, signature = text.partition(':')
+    try:
+        value = base64.b64decode(signature, validate=True)
+    except binascii.Error:
+        return text
+    return (name, value) if signature and base64.b64encode(value).decode('ascii') == signature else text
+
+def unpack_signature(value: tuple | str) -> str:
+    return value[0] + ':' + base64.b64encode(value[1]).decode('ascii') if isinstance(value, tuple) else value
+
+# return (store hash, fields) of a store_path row, a single bytes object per store path keeps the index compact
+def pack_store_path(row: list) -> tuple[bytes | str, bytes]:
+    fields = (pack_uuid(row[0]), row[2], pack_hex(row[3]), row[4], pack_nar_hash(row[5]), row[6],
+              row[7], row[8], pack_signature(row[10] or ''), row[13] or 'xz')
+    return pack_nix_hash(row[1]), marshal.dumps(fields)
+
+# return (id, store suffix, file hash, file size, nar hash, nar size, deriver, refs, signature, compression) of a packed store path
+def unpack_store_path(packed: bytes) -> tuple:
+    id, store_suffix, file_hash, file_size, nar_hash, nar_size, deriver, refs, signature, compression = marshal.loads(packed)
+    return (unpack_uuid(id), store_suffix, unpack_hex(file_hash), file_size, unpack_nar_hash(nar_hash), nar_size,
+            deriver, refs, unpack_signature(signature), sys.intern(compression))
+
+class StorePathIndex():
+    """
+    Class to answer store path lookups of binary caches from memory.
+
+    Store paths of a binary cache are loaded once by load, each packed into
+    a single bytes object keyed by the digest of its store hash, hashes and
+    signatures are kept as binary digests. Lookups read the index
+    without locking and apply the store path change log at most once per
+    refresh interval, so store paths changed or deleted by other processes
+    are seen within that interval without querying the store_path table.
+    Before a store path is answered as missing the change log is applied,
+    so store paths pushed by other processes are found right away. Lookups
+    in binary caches which were not loaded (see is_loaded) are left to the
+    database.
+
+    Attributes:
+        refresh_interval: number of seconds between reads of the change log by lookups of present store paths
+        caches: (packed paths by store hash, store hashes by file hash) by binary cache name
+        changes: reader of the store path change log
+        lock: lock guarding updates of caches and the change log reader
+        refreshed: monotonic time of the last read of the change log
+    """
+
+    def __init__(self, refresh_interval: float):
+        self.refresh_interval = refresh_interval
+        self.caches = {}
+        self.changes = StorePathChangeLog()
+        self.lock = threading.Lock()
+        self.refreshed = 0.0
+
+    def load(self, cache_name: str) -> None:
+        with self.lock:
+            self.update()
+            self.build(cache_name)
+
+    def build(self, cache_name: str) -> None:
+        by_store_hash = {}
+        by_file_hash = {}
+        for row in CacheServerDatabase().get_cache_store_paths(cache_name) or []:
+            self.add(by_store_hash, by_file_hash, row)
+        self.caches[cache_name] = (by_store_hash, by_file_hash)
+
+    def add(self, by_store_hash: dict, by_file_hash: dict, row: list) -> None:
+        store_key, packed = pack_store_path(row)
+        by_store_hash[store_key] = packed
+        # the file hash maps to the key object of the store hash, which is not stored twice
+        by_file_hash[pack_hex(row[3])] = store_key
+
+    # apply store path changes committed since the last update
+    def update(self) -> None:
+        self.refreshed = time.monotonic()
+        changes = self.changes.read(skip=not self.caches)
+        if changes is None:
+            # pruned changes were not applied, all loaded binary caches are loaded again
+            for cache_name in list(self.caches):
+                self.build(cache_name)
+                narinfo_cache.invalidate_cache(cache_name)
+            return
+
+        changed = {}
+        for change_id, cache_name, store_hash, deleted in changes:
+            if cache_name in self.caches:
+                changed.setdefault(cache_name, set()).add(store_hash)
+
+        # changed store paths are replaced by their current rows, deleted ones are just removed
+        database = CacheServerDatabase()
+        for cache_name, store_hashes in changed.items():
+            by_store_hash, by_file_hash = self.caches[cache_name]
+            for store_hash in store_hashes:
+                store_key = pack_nix_hash(store_hash)
+                packed = by_store_hash.pop(store_key, None)
+                if packed:
+                    file_key = pack_hex(unpack_store_path(packed)[2])
+                    if by_file_hash.get(file_key) == store_key:
+                        del by_file_hash[file_key]
+                narinfo_cache.invalidate(cache_name, store_hash)
+
+            for row in database.get_store_path_rows(cache_name, list(store_hashes)):
+                self.add(by_store_hash, by_file_hash, row)
+
+    # apply the change log once the refresh interval elapsed, unless another lookup is applying it
+    def refresh(self) -> None:
+        if time.monotonic() - self.refreshed >= self.refresh_interval and self.lock.acquire(blocking=False):
+            try:
+                self.update()
+            finally:
+                self.lock.release()
+
+    def is_loaded(self, cache_name: str) -> bool:
+        return cache_name in self.caches
+
+    # return (store hash, packed store path), None when the store path is not in the index
+    def lookup(self, cache_name: str, store_hash: str = '', file_hash: str = '') -> tuple | None:
+        by_store_hash, by_file_hash = self.caches.get(cache_name, ({}, {}))
+        store_key = pack_nix_hash(store_hash) if store_hash else by_file_hash.get(pack_hex(file_hash))
+        packed = by_store_hash.get(store_key) if store_key is not None else None
+        if not packed:
+            return None
+        return store_hash or unpack_nix_hash(store_key), packed
+
+    def to_store_path(self, cache: BinaryCache, store_hash: str, packed: bytes) -> StorePath:
+        id, store_suffix, file_hash, file_size, nar_hash, nar_size, deriver, refs, signature, compression = unpack_store_path(packed)
+        return StorePath(id,
+                         store_hash,
+                         store_suffix,
+                         file_hash,
+                         file_size,
+                         nar_hash,
+                         nar_size,
+                         deriver,
+                         refs.split(' ') if refs is not None else [],
+                         cache,
+                         signature,
+                         compression
+                         )
+
+    # return store path of a loaded binary cache, None when it does not exist
+    def get(self, cache: BinaryCache, store_hash: str = '', file_hash: str = '') -> StorePath | None:
+        self.refresh()
+        entry = self.lookup(cache.name, store_hash, file_hash)
+        if not entry:
+            # store paths pushed by other processes since the last refresh are never reported missing
+            with self.lock:
+                self.update()
+            entry = self.lookup(cache.name, store_hash, file_hash)
+
+        if entry:
+            return self.to_store_path(cache, *entry)
+
+        # store paths sharing a NAR file are indexed by file hash only once, removing one of them
+        # can leave the others out of the index, which is rare enough to fall back to the database
+        if file_hash:
+            return StorePath.get(cache.name, file_hash=file_hash)
+        return None
+
+    def get_many(self, cache: BinaryCache, store_hashes: list[str]) -> list:
+        self.refresh()
+        entries = [self.lookup(cache.name, store_hash) for store_hash in store_hashes]
+        if not all(entries):
+            with self.lock:
+                self.update()
+            entries = [entry or self.lookup(cache.name, store_hash) for store_hash, entry in zip(store_hashes, entries)]
+
+        return [self.to_store_path(cache, *entry) for entry in entries if entry]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'store_path_index_entries{{cache="{}"}}'.format(cache_name): len(by_store_hash)
+                    for cache_name, (by_store_hash, by_file_hash) in self.caches.items()}
+
+    def close(self) -> None:
+        with self.lock:
+            self.changes.close()
+            self.caches = {}
+            self.refreshed = 0.0
+
+store_path_index = StorePathIndex(config.store_path_index_refresh_interval)
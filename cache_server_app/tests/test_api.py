@@ -0,0 +1,99 @@
+#!/usr/bin/env python3.10
+"""
+test_api
+
+Module created to test handling of HTTP requests by cache-server and binary caches.
+
+Date: 18.10.2026
+"""
+
+import pytest
+import os
+import shutil
+import threading
+import http.client
+from email.message import Message
+from cache_server_app.src.database import CacheServerDatabase
+from cache_server_app.src.binary_cache import BinaryCache
+from cache_server_app.src.api import BinaryCacheRequestHandler, CacheServerRequestHandler, HTTPCacheServer
+
+ETAG = '"testetag"'
+LAST_MODIFIED = 'Sun, 18 Oct 2026 00:00:00 GMT'
+
+# handler with the request headers only, byte ranges are parsed from headers
+def request_handler(headers: dict) -> BinaryCacheRequestHandler:
+    handler = BinaryCacheRequestHandler.__new__(BinaryCacheRequestHandler)
+    handler.headers = Message()
+    for name, value in headers.items():
+        handler.headers[name] = value
+    return handler
+
+def get_byte_range(headers: dict, file_size: int = 100) -> tuple | bool | None:
+    return request_handler(headers).get_byte_range(file_size, ETAG, LAST_MODIFIED)
+
+def test_byte_range() -> None:
+    assert get_byte_range({}) == None
+    assert get_byte_range({'Range': 'bytes=10-19'}) == (10, 19)
+    assert get_byte_range({'Range': 'bytes=10-'}) == (10, 99)
+    assert get_byte_range({'Range': 'bytes=90-200'}) == (90, 99)
+
+def test_byte_range_suffix() -> None:
+    assert get_byte_range({'Range': 'bytes=-10'}) == (90, 99)
+    assert get_byte_range({'Range': 'bytes=-200'}) == (0, 99)
+
+def test_byte_range_not_satisfiable() -> None:
+    # answered by 416 Range Not Satisfiable
+    assert get_byte_range({'Range': 'bytes=100-'}) == False
+    assert get_byte_range({'Range': 'bytes=150-200'}) == False
+
+def test_byte_range_ignored() -> None:
+    assert get_byte_range({'Range': 'bytes=20-10'}) == None
+    assert get_byte_range({'Range': 'bytes=0-9,20-29'}) == None
+    assert get_byte_range({'Range': 'items=0-9'}) == None
+    assert get_byte_range({'Range': 'bytes=-'}) == None
+
+def test_byte_range_if_range() -> None:
+    assert get_byte_range({'Range': 'bytes=10-19', 'If-Range': ETAG}) == (10, 19)
+    assert get_byte_range({'Range': 'bytes=10-19', 'If-Range': LAST_MODIFIED}) == (10, 19)
+    # the file changed, the whole file is sent
+    assert get_byte_range({'Range': 'bytes=10-19', 'If-Range': '"otheretag"'}) == None
+    assert get_byte_range({'Range': 'bytes=10-19', 'If-Range': 'Sat, 17 Oct 2026 00:00:00 GMT'}) == None
+
+# fixture serving the cache-server API on a free port and stopping it after each test
+@pytest.fixture()
+def server_fixture():
+    database = CacheServerDatabase()
+    database.create_database()
+    BinaryCache("cacheuuid", "testcache", "url", "token", "public", 5000, 0).save()
+    cache = BinaryCache.get("testcache")
+    os.makedirs(cache.cache_dir)
+    cache.generate_keys()
+    server = HTTPCacheServer(('127.0.0.1', 0), CacheServerRequestHandler, None)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    connection = http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout=5)
+
+    yield connection
+
+    # teardown
+    connection.close()
+    server.shutdown()
+    server.server_close()
+    database.close()
+    if os.path.exists(database.database_file):
+        os.remove(database.database_file)
+    shutil.rmtree(os.path.dirname(cache.cache_dir), ignore_errors=True)
+
+def test_keepalive_unknown_cache_route(server_fixture) -> None:
+    connection = server_fixture
+    for method, path in (('GET', '/api/v1/cache/testcache'), ('GET', '/api/v1/cache/testcache/foo?'), ('POST', '/api/v1/cache/testcache/foo?')):
+        connection.request(method, path, headers={'Authorization': 'Bearer token'})
+        response = connection.getresponse()
+        response.read()
+        assert response.status == 400
+
+    # the connection is still usable after the unknown routes
+    connection.request('GET', '/api/v1/cache/testcache?')
+    response = connection.getresponse()
+    assert response.status == 200
+    assert b'"testcache"' in response.read()
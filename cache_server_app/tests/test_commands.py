@@ -10,12 +10,15 @@ Date: 1.5.2024
 
 import pytest
 import os
+import time
 import shutil
 from cache_server_app.src.commands import CacheServerCommandHandler
 from cache_server_app.src.agent import Agent
 from cache_server_app.src.binary_cache import BinaryCache
 from cache_server_app.src.workspace import Workspace
+from cache_server_app.src.store_path import StorePath
 from cache_server_app.src.database import CacheServerDatabase
+from cache_server_app.src.access_tracker import AccessTracker
 
 # main fixture for tests
 @pytest.fixture()
@@ -35,6 +38,7 @@ def setup_fixture():
     yield setup
 
     # teardown
+    CacheServerDatabase().close()
     os.remove("cache_server_app/tests/test_tmp/dbfile.db")
     if os.path.exists("cache_server_app/tests/test_tmp/binary-caches"):
         shutil.rmtree("cache_server_app/tests/test_tmp/binary-caches")
@@ -133,4 +137,184 @@ def test_cache_delete_not_exist(setup_fixture) -> None:
     with pytest.raises(SystemExit) as error:
         CacheServerCommandHandler().cache_delete("wrong_cache")
 
-    assert error.value.code == 1
\ No newline at end of file
+    assert error.value.code == 1
+
+def test_cache_resign_correct(setup_fixture) -> None:
+    CacheServerCommandHandler().cache_create("testcache", 5000, None)
+    cache = BinaryCache.get('testcache')
+    StorePath("testuuid", "testhash", "testsuffix", "testfilehash", 1, "sha256:testnarhash", 1,
+              "", ["testref-testsuffix"], cache).save()
+    CacheServerCommandHandler().cache_resign("testcache", False)
+    signature = StorePath.get("testcache", store_hash="testhash").signature
+    CacheServerCommandHandler().cache_resign("testcache", True)
+
+    assert signature.startswith("testcache.cache-server-1:")
+    assert StorePath.get("testcache", store_hash="testhash").signature != signature
+
+def test_cache_resign_not_exist(setup_fixture) -> None:
+    with pytest.raises(SystemExit) as error:
+        CacheServerCommandHandler().cache_resign("wrong_cache", False)
+
+    assert error.value.code == 1
+
+def test_cache_migrate_layout_correct(setup_fixture) -> None:
+    cache = setup_fixture['cache']
+    StorePath("testuuid", "testhash", "testsuffix", "abcdfilehash", 1, "sha256:testnarhash", 1,
+              "", [], cache).save()
+    with open(os.path.join(cache.cache_dir, "abcdfilehash.nar.xz"), "w") as f:
+        f.write("nar")
+    CacheServerCommandHandler().cache_migrate_layout(cache.name)
+
+    assert os.path.exists(os.path.join(cache.cache_dir, "ab", "cd", "abcdfilehash.nar.xz")) == True
+    assert os.path.exists(os.path.join(cache.cache_dir, "abcdfilehash.nar.xz")) == False
+    assert StorePath.get(cache.name, store_hash="testhash").get_nar_file() == os.path.join(cache.cache_dir, "ab", "cd", "abcdfilehash.nar.xz")
+
+def test_cache_collect_garbage_correct(setup_fixture) -> None:
+    cache = setup_fixture['cache']
+    cache.retention = 1
+    cache.update()
+    for store_hash, file_hash in (("oldhash", "abcdoldfilehash"), ("newhash", "abcdnewfilehash")):
+        StorePath("uuid" + store_hash, store_hash, "testsuffix", file_hash, 3, "sha256:testnarhash", 1,
+                  "", [], cache).save()
+        os.makedirs(os.path.dirname(cache.storage.get_shared_nar_file(file_hash, "xz")), exist_ok=True)
+        with open(cache.storage.get_shared_nar_file(file_hash, "xz"), "w") as f:
+            f.write("nar")
+    CacheServerDatabase().execute_statement("UPDATE store_path SET created_at = created_at - 604801 WHERE store_hash = 'oldhash'")
+    CacheServerCommandHandler().cache_collect_garbage(cache.name)
+
+    assert StorePath.get(cache.name, store_hash="oldhash") == None
+    assert os.path.exists(cache.storage.get_shared_nar_file("abcdoldfilehash", "xz")) == False
+    assert StorePath.get(cache.name, store_hash="newhash").get_nar_file() == cache.storage.get_shared_nar_file("abcdnewfilehash", "xz")
+
+def test_cache_collect_garbage_max_size(setup_fixture) -> None:
+    cache = setup_fixture['cache']
+    CacheServerCommandHandler().cache_update(cache.name, None, None, None, None, 5)
+    for store_hash in ("hash1", "hash2", "hash3"):
+        StorePath("uuid" + store_hash, store_hash, "testsuffix", "abcd" + store_hash, 2, "sha256:testnarhash", 1,
+                  "", [], cache).save()
+    CacheServerDatabase().execute_statement("UPDATE store_path SET last_access = last_access - 10 WHERE store_hash = 'hash2'")
+    CacheServerCommandHandler().cache_collect_garbage(cache.name)
+
+    assert StorePath.get(cache.name, store_hash="hash2") == None
+    assert StorePath.get(cache.name, store_hash="hash1") != None
+    assert StorePath.get(cache.name, store_hash="hash3") != None
+    assert CacheServerDatabase().get_cache_size(cache.name) == 4
+
+def test_cache_collect_garbage_closure(setup_fixture) -> None:
+    cache = setup_fixture['cache']
+    cache.retention = 1
+    cache.update()
+    # dep1 <- app1 (pinned), dep2 <- app2 (expired), dep3 <- app3 (kept), all dependencies expired
+    for store_hash, references in (("d" * 32, []), ("e" * 32, []), ("f" * 32, []),
+                                   ("a" * 32, ["d" * 32 + "-dep1"]), ("b" * 32, ["e" * 32 + "-dep2"]), ("c" * 32, ["f" * 32 + "-dep3"])):
+        StorePath("uuid" + store_hash, store_hash, "testsuffix", "abcd" + store_hash, 1, "sha256:testnarhash", 1,
+                  "", references, cache).save()
+    CacheServerDatabase().execute_statement("UPDATE store_path SET created_at = created_at - 604801 WHERE store_hash <> ?", ("c" * 32,))
+    CacheServerCommandHandler().store_path_pin("a" * 32, cache.name, "app")
+    CacheServerCommandHandler().cache_collect_garbage(cache.name)
+
+    assert {path[1] for path in cache.get_paths()} == {"a" * 32, "d" * 32, "c" * 32, "f" * 32}
+
+def test_cache_collect_garbage_max_size_referenced(setup_fixture) -> None:
+    cache = setup_fixture['cache']
+    CacheServerCommandHandler().cache_update(cache.name, None, None, None, None, 5)
+    # a (oldest, large) <- b, c unrelated and most recently accessed
+    for store_hash, file_size, references, age in (("a" * 32, 10, [], 30), ("b" * 32, 1, ["a" * 32 + "-a"], 20), ("c" * 32, 1, [], 10)):
+        StorePath("uuid" + store_hash, store_hash, "testsuffix", "abcd" + store_hash, file_size, "sha256:testnarhash", 1,
+                  "", references, cache).save()
+        CacheServerDatabase().execute_statement("UPDATE store_path SET last_access = last_access - ? WHERE store_hash = ?", (age, store_hash))
+    removed, freed = BinaryCache.get(cache.name).collect_garbage()
+
+    assert removed == 2
+    assert {path[1] for path in cache.get_paths()} == {"c" * 32}
+    assert CacheServerDatabase().get_cache_size(cache.name) == 1
+
+def test_cache_collect_garbage_pushed_again(setup_fixture) -> None:
+    cache = setup_fixture['cache']
+    cache.retention = 1
+    cache.update()
+    StorePath("uuiddep", "b" * 32, "dep", "abcddepfilehash", 1, "sha256:testnarhash", 1,
+              "", [], cache).save()
+    CacheServerDatabase().execute_statement("UPDATE store_path SET created_at = created_at - 604801")
+    # the referrer is pushed twice, the dependency is kept by the remaining store path
+    for id in ("uuid1", "uuid2"):
+        StorePath(id, "a" * 32, "testsuffix", "abcdfilehash", 1, "sha256:testnarhash", 1,
+                  "", ["b" * 32 + "-dep"], cache).save()
+    CacheServerCommandHandler().cache_collect_garbage(cache.name)
+
+    assert StorePath.get(cache.name, store_hash="b" * 32) != None
+    assert len(cache.get_paths()) == 2
+
+def test_cache_collect_garbage_pushed_during_sweep(setup_fixture) -> None:
+    cache = setup_fixture['cache']
+    database = CacheServerDatabase()
+    StorePath("uuiddep", "b" * 32, "dep", "abcddepfilehash", 1, "sha256:testnarhash", 1,
+              "", [], cache).save()
+    database.execute_statement("UPDATE store_path SET created_at = created_at - 604801")
+    marked_at = int(time.time())
+    database.mark_live_store_paths(cache.name, 'created_at', marked_at - 604800)
+    # pushed after the mark, referencing the expired store path
+    StorePath("uuid", "a" * 32, "testsuffix", "abcdfilehash", 1, "sha256:testnarhash", 1,
+              "", ["b" * 32 + "-dep"], cache).save()
+
+    assert database.delete_unmarked_store_paths(cache.name, 'created_at', marked_at - 604800, 1000, marked_at) == []
+    assert StorePath.get(cache.name, store_hash="b" * 32) != None
+
+def test_cache_collect_garbage_interrupted_release(setup_fixture) -> None:
+    cache = setup_fixture['cache']
+    StorePath("testuuid", "testhash", "testsuffix", "abcdfilehash", 3, "sha256:testnarhash", 1,
+              "", [], cache).save()
+    os.makedirs(os.path.dirname(cache.storage.get_nar_file("abcdfilehash", "xz")))
+    with open(cache.storage.get_nar_file("abcdfilehash", "xz"), "w") as f:
+        f.write("nar")
+    # store path deleted, but its own copy was not released yet
+    CacheServerDatabase().execute_statement("DELETE FROM store_path WHERE store_hash = 'testhash'")
+    removed, freed = cache.collect_garbage()
+
+    assert freed == 3
+    assert os.path.exists(cache.storage.get_nar_file("abcdfilehash", "xz")) == False
+    assert CacheServerDatabase().get_nar_releases(cache.name) == []
+
+def test_storage_dedup_correct(setup_fixture) -> None:
+    BinaryCache("otheruuid", "othername", "otherurl", "othertoken", "public", 0, 0).save()
+    for cache in (setup_fixture['cache'], BinaryCache.get("othername")):
+        StorePath("uuid" + cache.name, "testhash", "testsuffix", "abcdfilehash", 3, "sha256:testnarhash", 1,
+                  "", [], cache).save()
+        os.makedirs(os.path.dirname(cache.storage.get_nar_file("abcdfilehash", "xz")))
+        with open(cache.storage.get_nar_file("abcdfilehash", "xz"), "w") as f:
+            f.write("nar")
+    CacheServerCommandHandler().storage_dedup()
+
+    assert os.path.exists(setup_fixture['cache'].storage.get_shared_nar_file("abcdfilehash", "xz")) == True
+    for cache in (setup_fixture['cache'], BinaryCache.get("othername")):
+        assert os.path.exists(cache.storage.get_nar_file("abcdfilehash", "xz")) == False
+        assert StorePath.get(cache.name, store_hash="testhash").get_nar_file() == cache.storage.get_shared_nar_file("abcdfilehash", "xz")
+
+def test_store_path_unpin_not_exist(setup_fixture) -> None:
+    with pytest.raises(SystemExit) as error:
+        CacheServerCommandHandler().store_path_unpin("wrong_root", setup_fixture['cache'].name)
+
+    assert error.value.code == 1
+
+def test_store_path_access_tracked(setup_fixture) -> None:
+    cache = setup_fixture['cache']
+    StorePath("testuuid", "testhash", "testsuffix", "testfilehash", 1, "sha256:testnarhash", 1,
+              "", [], cache).save()
+    access_tracker = AccessTracker(3600, 100)
+    access_tracker.record(cache.name, "testhash")
+    access_tracker.record(cache.name, "testhash", download=True)
+    access_tracker.record(cache.name, "testhash", download=True)
+    access_tracker.flush()
+
+    assert StorePath.get(cache.name, store_hash="testhash").download_count == 2
+    assert CacheServerDatabase().get_cache_download_count(cache.name) == 2
+    assert access_tracker.stats()['access_tracker_flushed'] == 1
+
+def test_store_path_access_tracker_bounded(setup_fixture) -> None:
+    access_tracker = AccessTracker(3600, 2)
+    for store_hash in ("hash1", "hash2", "hash3"):
+        access_tracker.record(setup_fixture['cache'].name, store_hash)
+    access_tracker.record(setup_fixture['cache'].name, "hash1", download=True)
+
+    assert access_tracker.stats()['access_tracker_pending'] == 2
+    assert access_tracker.stats()['access_tracker_dropped'] == 1
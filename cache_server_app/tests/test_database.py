@@ -0,0 +1,130 @@
+#!/usr/bin/env python3.10
+"""
+test_database
+
+Module created to test database schema handling.
+
+Date: 18.10.2026
+"""
+
+import pytest
+import os
+import sqlite3
+from cache_server_app.src.database import CacheServerDatabase
+
+# fixture removing the database file after each test
+@pytest.fixture()
+def database_fixture():
+    database = CacheServerDatabase()
+
+    yield database
+
+    # teardown
+    database.close()
+    if os.path.exists(database.database_file):
+        os.remove(database.database_file)
+
+#### schema migration tests ####
+
+def test_create_database_version(database_fixture) -> None:
+    database_fixture.create_database()
+
+    assert database_fixture.get_schema_version() == len(database_fixture.get_migrations())
+
+def test_create_database_legacy(database_fixture) -> None:
+    with sqlite3.connect(database_fixture.database_file) as db_connection:
+        db_connection.execute("CREATE TABLE binary_cache (id VARCHAR UNIQUE, name VARCHAR UNIQUE, url VARCHAR, token VARCHAR, access VARCHAR, port VARCHAR, retention INT)")
+        db_connection.execute("CREATE TABLE store_path (id VARCHAR UNIQUE, store_hash VARCHAR, store_suffix VARCHAR, file_hash VARCHAR, file_size INT, nar_hash VARCHAR, nar_size INT, deriver VARCHAR, refs VARCHAR, cache_name VARCHAR)")
+        db_connection.execute("INSERT INTO store_path (id, store_hash, cache_name) VALUES ('legacyuuid', 'legacyhash', 'legacycache')")
+    db_connection.close()
+
+    database_fixture.create_database()
+    row = database_fixture.get_store_path_row('legacycache', store_hash='legacyhash')
+
+    assert row[0] == 'legacyuuid'
+    assert database_fixture.get_schema_version() == len(database_fixture.get_migrations())
+
+def test_create_database_newer_version(database_fixture) -> None:
+    with sqlite3.connect(database_fixture.database_file) as db_connection:
+        db_connection.execute("PRAGMA user_version = 1000")
+    db_connection.close()
+
+    with pytest.raises(SystemExit) as error:
+        database_fixture.create_database()
+
+    assert error.value.code == 1
+
+def test_check_database_not_migrated(database_fixture) -> None:
+    with pytest.raises(SystemExit) as error:
+        database_fixture.check_database()
+
+    assert error.value.code == 1
+
+#### store path batch tests ####
+
+def test_insert_store_paths(database_fixture) -> None:
+    database_fixture.create_database()
+    database_fixture.insert_store_paths([("uuid%d" % i, "hash%d" % i, "suffix", "filehash%d" % i, 1, "narhash", 1, "", "", "testcache", "", "xz")
+                                         for i in range(1000)])
+
+    assert len(database_fixture.get_store_path_rows("testcache", ["hash%d" % i for i in range(0, 2000, 2)])) == 500
+
+def test_delete_store_paths(database_fixture) -> None:
+    database_fixture.create_database()
+    database_fixture.insert_store_paths([("uuid%d" % i, "hash%d" % i, "suffix", "filehash%d" % i, 1, "narhash", 1, "", "", "testcache", "", "xz")
+                                         for i in range(10)])
+    database_fixture.delete_store_paths("testcache", ["hash%d" % i for i in range(5)])
+
+    assert database_fixture.get_existing_store_hashes("testcache", ["hash%d" % i for i in range(10)]) == {"hash%d" % i for i in range(5, 10)}
+
+def test_statement_parameters_quoted(database_fixture) -> None:
+    database_fixture.create_database()
+    database_fixture.insert_binary_cache("uuid", "quote'name", "url", "token", "public", 5000, 0, -1)
+
+    assert database_fixture.get_binary_cache_row("quote'name")[1] == "quote'name"
+
+def test_nar_file_refcount(database_fixture) -> None:
+    database_fixture.create_database()
+    database_fixture.insert_store_paths([("uuid%d" % i, "hash%d" % i, "suffix", "filehash", 1, "narhash", 1, "", "", "cache%d" % i, "", "xz")
+                                         for i in range(3)])
+    assert database_fixture.get_nar_file_refcount("filehash", "xz") == 3
+
+    database_fixture.delete_store_paths("cache0", ["hash0"])
+    database_fixture.delete_all_cache_paths("cache1")
+    assert database_fixture.get_nar_file_refcount("filehash", "xz") == 1
+
+    database_fixture.delete_store_paths("cache2", ["hash2"])
+    assert database_fixture.get_nar_file_refcount("filehash", "xz") == 0
+
+def test_store_path_pushed_again(database_fixture) -> None:
+    database_fixture.create_database()
+    database_fixture.insert_store_paths([("uuiddep", "b" * 32, "dep", "filehashdep", 1, "narhash", 1, "", "", "testcache", "", "xz")])
+    for id, file_hash in (("uuid1", "filehash1"), ("uuid2", "filehash2")):
+        database_fixture.insert_store_paths([(id, "a" * 32, "suffix", file_hash, 2, "narhash", 1, "", "b" * 32 + "-dep", "testcache", "", "xz")])
+
+    rows = database_fixture.get_store_path_rows("testcache", ["a" * 32])
+    assert len(rows) == 1
+    assert rows[0][0] == "uuid1" and rows[0][3] == "filehash2"
+    assert database_fixture.execute_select("SELECT referrers FROM store_path WHERE store_hash = ?", ("b" * 32,)) == [(1,)]
+    assert database_fixture.get_cache_size("testcache") == 3
+    assert database_fixture.get_nar_file_refcount("filehash1", "xz") == 0
+    assert database_fixture.get_nar_releases("testcache") == [("filehash1", "xz")]
+
+def test_duplicate_store_paths_migrated(database_fixture) -> None:
+    database_fixture.create_database()
+    with sqlite3.connect(database_fixture.database_file) as db_connection:
+        # duplicates pushed before version 15
+        db_connection.execute("DROP INDEX store_path_cache_store_hash")
+        db_connection.execute("PRAGMA user_version = 14")
+        for id in ("uuid1", "uuid2"):
+            db_connection.execute("INSERT INTO store_path (id, store_hash, file_hash, file_size, refs, cache_name, compression) VALUES (?, ?, 'filehash', 1, ?, 'testcache', 'xz')",
+                                  (id, "a" * 32, "b" * 32 + "-dep"))
+        db_connection.execute("INSERT INTO store_path (id, store_hash, file_hash, file_size, refs, cache_name, compression) VALUES ('uuiddep', ?, 'filehashdep', 1, '', 'testcache', 'xz')", ("b" * 32,))
+    db_connection.close()
+
+    database_fixture.create_database()
+
+    assert [row[0] for row in database_fixture.get_store_path_rows("testcache", ["a" * 32])] == ["uuid2"]
+    assert database_fixture.execute_select("SELECT referrers FROM store_path WHERE store_hash = ?", ("b" * 32,)) == [(1,)]
+    assert database_fixture.get_cache_size("testcache") == 2
+    assert database_fixture.get_nar_file_refcount("filehash", "xz") == 1
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3.10
+"""
+test_nar_upload
+
+Module created to test upload sessions of NAR files.
+
+Date: 18.10.2026
+"""
+
+import pytest
+import io
+import os
+import shutil
+import hashlib
+from cache_server_app.src.database import CacheServerDatabase
+from cache_server_app.src.binary_cache import BinaryCache
+from cache_server_app.src.nar_upload import NarUpload, nix_base32
+
+# fixture creating the database and binary cache directory and removing them after each test
+@pytest.fixture()
+def upload_fixture():
+    database = CacheServerDatabase()
+    database.create_database()
+    BinaryCache("cacheuuid", "testcache", "url", "token", "public", 5000, 0).save()
+    cache = BinaryCache.get("testcache")
+    os.makedirs(cache.cache_dir)
+
+    yield NarUpload.create(cache, "xz")
+
+    # teardown
+    database.close()
+    if os.path.exists(database.database_file):
+        os.remove(database.database_file)
+    shutil.rmtree(os.path.dirname(cache.cache_dir), ignore_errors=True)
+
+def receive_parts(upload: NarUpload, parts: list[bytes]) -> list[dict]:
+    return [{'partNumber': part_number, 'eTag': '"%s"' % upload.receive_part(part_number, io.BytesIO(part), len(part))}
+            for part_number, part in enumerate(parts, 1)]
+
+def test_nix_base32() -> None:
+    assert nix_base32(hashlib.sha256(b"").digest()) == "0mdqa9w1p6cmli6976v4wi0sw9r4p5prkj7lzfd1877wk11c9c73"
+    assert nix_base32(bytes(20)) == "0" * 32
+
+def test_upload_matches(upload_fixture) -> None:
+    upload = upload_fixture
+    assert not upload.matches("sha256:" + hashlib.sha256(b"").hexdigest(), 0)
+
+    upload.receive(io.BytesIO(b"nar"), 3)
+    digest = hashlib.sha256(b"nar").digest()
+
+    assert upload.matches("sha256:" + digest.hex(), 3)
+    assert upload.matches("sha256:" + nix_base32(digest), 3)
+    assert upload.matches(nix_base32(digest), 3)
+    assert not upload.matches("sha256:" + nix_base32(digest), 4)
+    assert not upload.matches("sha256:" + nix_base32(hashlib.sha256(b"other").digest()), 3)
+
+def test_upload_assemble_out_of_order(upload_fixture) -> None:
+    upload = upload_fixture
+    parts = receive_parts(upload, [b"first ", b"second ", b"third"])
+
+    assert upload.assemble(list(reversed(parts)))
+    with open(upload.get_file(), 'rb') as file:
+        assert file.read() == b"first second third"
+    assert upload.file_hash == hashlib.sha256(b"first second third").hexdigest()
+    assert upload.file_size == 18
+
+def test_upload_assemble_wrong_etag(upload_fixture) -> None:
+    upload = upload_fixture
+    parts = receive_parts(upload, [b"first ", b"second"])
+    parts[1]['eTag'] = '"%s"' % hashlib.md5(b"other").hexdigest()
+
+    assert not upload.assemble(parts)
+    assert upload.state == 'created'
+    assert upload.has_parts()
+
+def test_upload_parts_removed(upload_fixture) -> None:
+    upload = upload_fixture
+    upload.assemble(receive_parts(upload, [b"first ", b"second"]))
+
+    assert not upload.has_parts()
+    assert not os.path.exists(os.path.join(upload.cache.cache_dir, "parts"))
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3.10
+"""
+test_narinfo_cache
+
+Module created to test the in-process cache of rendered narinfo responses.
+
+Date: 18.10.2026
+"""
+
+import pytest
+import os
+import sqlite3
+from cache_server_app.src.database import CacheServerDatabase
+from cache_server_app.src.binary_cache import BinaryCache
+from cache_server_app.src.store_path import StorePath
+from cache_server_app.src.narinfo_cache import NarinfoCache, narinfo_cache
+
+# fixture creating the database and removing it after each test
+@pytest.fixture()
+def database_fixture():
+    database = CacheServerDatabase()
+    database.create_database()
+    BinaryCache("cacheuuid", "testcache", "url", "token", "public", 5000, 0).save()
+
+    yield BinaryCache.get("testcache")
+
+    # teardown
+    database.close()
+    if os.path.exists(database.database_file):
+        os.remove(database.database_file)
+
+def test_narinfo_cache_hit() -> None:
+    cache = NarinfoCache(10, 60, 3600)
+    cache.put("testcache", "hash1", b"narinfo1")
+
+    assert cache.get("testcache", "hash1") == b"narinfo1"
+    assert cache.get("othercache", "hash1") == None
+    assert cache.stats() == {'narinfo_cache_hits': 1, 'narinfo_cache_misses': 1, 'narinfo_cache_entries': 1}
+
+def test_narinfo_cache_expiry() -> None:
+    cache = NarinfoCache(10, 0, 3600)
+    cache.put("testcache", "hash1", b"narinfo1")
+
+    assert cache.get("testcache", "hash1") == None
+    assert cache.stats()['narinfo_cache_entries'] == 0
+
+def test_narinfo_cache_eviction_order() -> None:
+    cache = NarinfoCache(2, 60, 3600)
+    cache.put("testcache", "hash1", b"narinfo1")
+    cache.put("testcache", "hash2", b"narinfo2")
+    # hash1 was used more recently than hash2
+    cache.get("testcache", "hash1")
+    cache.put("testcache", "hash3", b"narinfo3")
+
+    assert cache.get("testcache", "hash2") == None
+    assert cache.get("testcache", "hash1") == b"narinfo1"
+    assert cache.get("testcache", "hash3") == b"narinfo3"
+
+def test_narinfo_cache_disabled() -> None:
+    cache = NarinfoCache(0, 60, 3600)
+    cache.put("testcache", "hash1", b"narinfo1")
+
+    assert cache.get("testcache", "hash1") == None
+
+def test_narinfo_cache_invalidate_cache() -> None:
+    cache = NarinfoCache(10, 60, 3600)
+    cache.put("testcache", "hash1", b"narinfo1")
+    cache.put("othercache", "hash1", b"narinfo1")
+    cache.invalidate_cache("testcache")
+
+    assert cache.get("testcache", "hash1") == None
+    assert cache.get("othercache", "hash1") == b"narinfo1"
+
+def test_narinfo_cache_reupload(database_fixture) -> None:
+    cache = database_fixture
+    narinfo_cache.put(cache.name, "testhash", b"old narinfo")
+    StorePath("testuuid", "testhash", "testsuffix", "testfilehash", 1, "sha256:testnarhash", 1,
+              "", [], cache).save()
+
+    assert narinfo_cache.get(cache.name, "testhash") == None
+
+def test_narinfo_cache_changed_by_other_process(database_fixture) -> None:
+    cache = database_fixture
+    narinfos = NarinfoCache(10, 60, 0)
+    StorePath("testuuid", "testhash", "testsuffix", "testfilehash", 1, "sha256:testnarhash", 1,
+              "", [], cache).save()
+    # the first lookup reads the push of the store path
+    assert narinfos.get(cache.name, "testhash") == None
+    narinfos.put(cache.name, "testhash", b"old narinfo")
+    assert narinfos.get(cache.name, "testhash") == b"old narinfo"
+
+    # the store path is signed again by another process
+    db_connection = sqlite3.connect(CacheServerDatabase().database_file)
+    db_connection.execute("UPDATE store_path SET signature='newsig' WHERE store_hash='testhash'")
+    db_connection.commit()
+    db_connection.close()
+
+    assert narinfos.get(cache.name, "testhash") == None
+    narinfos.changes.close()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3.10
+"""
+test_store_hash_filter
+
+Module created to test the filter of store hashes present in binary caches.
+
+Date: 18.10.2026
+"""
+
+import pytest
+import os
+import sqlite3
+from cache_server_app.src.database import CacheServerDatabase
+from cache_server_app.src.store_hash_filter import BloomFilter, StoreHashFilter
+
+# fixture creating the database and removing it after each test
+@pytest.fixture()
+def filter_fixture():
+    database = CacheServerDatabase()
+    database.create_database()
+    store_hash_filter = StoreHashFilter(0.01)
+
+    yield database, store_hash_filter
+
+    # teardown
+    store_hash_filter.close()
+    database.close()
+    if os.path.exists(database.database_file):
+        os.remove(database.database_file)
+
+def insert_store_paths(database: CacheServerDatabase, cache_name: str, store_hashes: list[str]) -> None:
+    database.insert_store_paths([("uuid-%s-%s" % (cache_name, store_hash), store_hash, "suffix", "filehash", 1, "narhash", 1, "", "", cache_name, "", "xz")
+                                 for store_hash in store_hashes])
+
+#### Bloom filter tests ####
+
+def test_bloom_filter_error_rate() -> None:
+    bloom_filter = BloomFilter(10000, 0.01)
+    for i in range(10000):
+        bloom_filter.add("present%d" % i)
+
+    assert all("present%d" % i in bloom_filter for i in range(10000))
+    assert sum("missing%d" % i in bloom_filter for i in range(10000)) < 200
+
+#### store hash filter tests ####
+
+def test_filter_load(filter_fixture) -> None:
+    database, store_hash_filter = filter_fixture
+    insert_store_paths(database, "testcache", ["hash1", "hash2"])
+    store_hash_filter.load("testcache")
+
+    assert store_hash_filter.might_contain("testcache", "hash1")
+    assert not store_hash_filter.might_contain("testcache", "hash3")
+    assert not store_hash_filter.might_contain("othercache", "hash1")
+
+def test_filter_pushed_store_path(filter_fixture) -> None:
+    database, store_hash_filter = filter_fixture
+    store_hash_filter.load("testcache")
+    assert not store_hash_filter.might_contain("testcache", "hash1")
+
+    insert_store_paths(database, "testcache", ["hash1"])
+
+    assert store_hash_filter.might_contain("testcache", "hash1")
+
+def test_filter_renamed_cache(filter_fixture) -> None:
+    database, store_hash_filter = filter_fixture
+    insert_store_paths(database, "testcache", ["hash1"])
+    store_hash_filter.load("testcache")
+    store_hash_filter.load("newcache")
+
+    database.update_cache_in_paths("testcache", "newcache")
+
+    assert store_hash_filter.might_contain("newcache", "hash1")
+
+def test_filter_pruned_changes(filter_fixture) -> None:
+    database, store_hash_filter = filter_fixture
+    store_hash_filter.load("testcache")
+    insert_store_paths(database, "testcache", ["hash1", "hash2"])
+    database.execute_statement("DELETE FROM store_path_change")
+    insert_store_paths(database, "testcache", ["hash3"])
+
+    assert store_hash_filter.might_contain("testcache", "hash1")
+    assert store_hash_filter.might_contain("testcache", "hash3")
+
+def test_filter_unreadable_changes(filter_fixture) -> None:
+    database, store_hash_filter = filter_fixture
+    insert_store_paths(database, "testcache", ["hash1"])
+    store_hash_filter.load("testcache")
+    database.execute_statement("ALTER TABLE store_path_change RENAME TO store_path_change_old")
+
+    assert store_hash_filter.might_contain("testcache", "hash1")
+    assert not store_hash_filter.might_contain("testcache", "hash2")
+
+def test_filter_pushed_through_other_connection(filter_fixture) -> None:
+    database, store_hash_filter = filter_fixture
+    store_hash_filter.load("testcache")
+    assert not store_hash_filter.might_contain("testcache", "hash1")
+
+    # pushed by another process and looked up right away
+    connection = sqlite3.connect(database.database_file)
+    connection.execute("INSERT INTO store_path (id, store_hash, store_suffix, file_hash, file_size, nar_hash, nar_size, deriver, refs, cache_name, signature, compression) VALUES ('uuid', 'hash1', 'suffix', 'filehash', 1, 'narhash', 1, '', '', 'testcache', '', 'xz')")
+    connection.commit()
+    connection.close()
+
+    assert store_hash_filter.might_contain("testcache", "hash1")
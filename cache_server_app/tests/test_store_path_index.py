@@ -0,0 +1,88 @@
+#!/usr/bin/env python3.10
+"""
+test_store_path_index
+
+Module created to test the in-memory index of store paths.
+
+Date: 18.10.2026
+"""
+
+import pytest
+import os
+from cache_server_app.src.database import CacheServerDatabase
+from cache_server_app.src.binary_cache import BinaryCache
+from cache_server_app.src.store_path import StorePath
+from cache_server_app.src.store_path_index import StorePathIndex
+
+# fixture creating the database and removing it after each test
+@pytest.fixture()
+def index_fixture():
+    database = CacheServerDatabase()
+    database.create_database()
+    store_path_index = StorePathIndex(0)
+    cache = BinaryCache("cacheuuid", "testcache", "url", "token", "public", 5000, 0)
+
+    yield database, store_path_index, cache
+
+    # teardown
+    store_path_index.close()
+    database.close()
+    if os.path.exists(database.database_file):
+        os.remove(database.database_file)
+
+def insert_store_path(database: CacheServerDatabase, store_hash: str, file_hash: str) -> None:
+    database.insert_store_path("uuid-" + store_hash, store_hash, "suffix", file_hash, 1, "narhash", 1, "", "ref1 ref2", "testcache", "sig", "xz")
+
+def test_index_load(index_fixture) -> None:
+    database, store_path_index, cache = index_fixture
+    insert_store_path(database, "hash1", "filehash1")
+    store_path_index.load("testcache")
+
+    path = store_path_index.get(cache, store_hash="hash1")
+    assert path.file_hash == "filehash1"
+    assert path.references == ["ref1", "ref2"]
+    assert store_path_index.get(cache, file_hash="filehash1").store_hash == "hash1"
+    assert store_path_index.get(cache, store_hash="hash2") is None
+
+def test_index_live_changes(index_fixture) -> None:
+    database, store_path_index, cache = index_fixture
+    insert_store_path(database, "hash1", "filehash1")
+    store_path_index.load("testcache")
+
+    insert_store_path(database, "hash2", "filehash2")
+    database.update_store_path_signatures("testcache", [("hash1", "newsig")])
+    assert store_path_index.get(cache, store_hash="hash2").file_hash == "filehash2"
+    assert store_path_index.get(cache, store_hash="hash1").signature == "newsig"
+
+    database.delete_store_paths("testcache", ["hash1"])
+    assert store_path_index.get(cache, store_hash="hash1") is None
+    assert store_path_index.get(cache, file_hash="filehash1") is None
+
+def test_index_packed_store_path(index_fixture) -> None:
+    database, store_path_index, cache = index_fixture
+    database.insert_store_path("7c9e6679-7425-40de-944b-e07fc1f90ae7", "0mdqa9w1p6cmli6976v4wi0sw9r4p5pr", "hello-2.12.1",
+                               "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855", 5, "sha256:0mdqa9w1p6cmli6976v4wi0sw9r4p5prkj7lzfd1877wk11c9c73", 10,
+                               None, "0mdqa9w1p6cmli6976v4wi0sw9r4p5pr-hello-2.12.1 1b8m03r63zqhnjf7l5wnldhh7c134ap5-glibc-2.38",
+                               "testcache", "cache-1:" + "A" * 86 + "==", "zst")
+    store_path_index.load("testcache")
+    path = store_path_index.get(cache, file_hash="e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855")
+
+    assert path.get_narinfo() == StorePath.get("testcache", store_hash="0mdqa9w1p6cmli6976v4wi0sw9r4p5pr").get_narinfo()
+    assert path.id == "7c9e6679-7425-40de-944b-e07fc1f90ae7"
+    assert path.deriver is None
+
+def test_index_refresh_interval(index_fixture) -> None:
+    database, _, cache = index_fixture
+    store_path_index = StorePathIndex(3600)
+    insert_store_path(database, "hash1", "filehash1")
+    store_path_index.load("testcache")
+
+    # pushed store paths are found right away, other changes within the refresh interval
+    insert_store_path(database, "hash2", "filehash2")
+    assert store_path_index.get(cache, store_hash="hash2").file_hash == "filehash2"
+    database.update_store_path_signatures("testcache", [("hash2", "newsig")])
+    assert store_path_index.get(cache, store_hash="hash2").signature == "sig"
+
+    store_path_index.refreshed -= 3600
+    assert store_path_index.get(cache, store_hash="hash2").signature == "newsig"
+    store_path_index.close()